@@ -54,15 +54,32 @@ export const checkAllServicesHealth = async () => {
 };
 
 // ============ Features API (via Gateway) ============
+// Only the NLP columns used by the insights panel are fetched, page by page
+const NLP_FIELDS = [
+  'nlp_num_conditions', 'nlp_has_diabetes', 'nlp_has_hypertension', 'nlp_has_chf',
+  'nlp_has_copd', 'nlp_has_ckd', 'nlp_num_medications', 'nlp_polypharmacy',
+  'nlp_num_symptoms', 'nlp_has_pain', 'nlp_has_dyspnea',
+].join(',');
+
 export const getFeatures = async () => {
   const cacheKey = 'features';
   const cached = getCached(cacheKey);
   if (cached) return cached;
 
   try {
-    const response = await gatewayApi.get('/api/v1/features/features');
-    setCache(cacheKey, response.data);
-    return response.data;
+    const features = [];
+    let cursor = null;
+    do {
+      const response = await gatewayApi.get('/api/v1/features/features', {
+        params: { fields: NLP_FIELDS, limit: 2000, ...(cursor ? { cursor } : {}) },
+      });
+      features.push(...response.data.features);
+      cursor = response.data.next_cursor;
+    } while (cursor);
+
+    const data = { total: features.length, features };
+    setCache(cacheKey, data);
+    return data;
   } catch (error) {
     console.error('Failed to get features:', error);
     return [];
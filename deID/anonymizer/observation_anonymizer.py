@@ -46,7 +46,8 @@ class ObservationAnonymizer:
             
             logger.info(f"Anonymized observation {original_id} -> {observation['id']}")
             
-            return json.dumps(observation, indent=2)
+            # JSON compact : resource_data est stocké en TEXT, l'indentation ne fait que grossir la table
+            return json.dumps(observation, separators=(',', ':'))
             
         except Exception as e:
             logger.error(f"Error anonymizing observation: {e}")
@@ -58,7 +58,8 @@ class PatientAnonymizer:
             
             logger.info(f"Anonymized patient {original_id} -> {patient['id']}")
             
-            return json.dumps(patient, indent=2)
+            # JSON compact : resource_data est stocké en TEXT, l'indentation ne fait que grossir la table
+            return json.dumps(patient, separators=(',', ':'))
             
         except Exception as e:
             logger.error(f"Error anonymizing patient: {e}")
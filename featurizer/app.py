@@ -25,6 +25,11 @@ def create_app(config_name='development'):
     app.register_blueprint(health_bp)
     app.register_blueprint(feature_bp, url_prefix='/api/v1')
     
+    # Préchargement du modèle NLP (partagé en copy-on-write après fork)
+    if app.config.get('NLP_PRELOAD'):
+        from services.model_registry import warm_up
+        warm_up()
+    
     logger.info("Featurizer microservice started successfully")
     
     return app
@@ -32,6 +32,12 @@ class Config:
     PORT = int(os.getenv('PORT', 5001))
     DEBUG = os.getenv('FLASK_DEBUG', 'True').lower() == 'true'
     
+    # NLP : précharger le modèle au démarrage (avant fork des workers)
+    NLP_PRELOAD = os.getenv('NLP_PRELOAD', 'False').lower() == 'true'
+    
+    # Durée de vie (s) du cache mémoire des stats
+    STATS_CACHE_TTL = int(os.getenv('STATS_CACHE_TTL', 30))
+    
     # Configuration des features
     FEATURE_CONFIG = {
         'age_bins': [0, 18, 30, 40, 50, 60, 70, 100],
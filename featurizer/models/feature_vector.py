@@ -63,48 +63,53 @@ class PatientFeatures(Base):
     
     def to_dict(self):
         """Convertit en dictionnaire"""
+        return self.serialize(self)
+    
+    @staticmethod
+    def serialize(record):
+        """Sérialise un enregistrement (objet ORM ou Row SQLAlchemy) sans features_json"""
         return {
-            'patient_id': self.patient_id,
+            'patient_id': record.patient_id,
             'demographics': {
-                'age': self.age,
-                'gender': self.gender
+                'age': record.age,
+                'gender': record.gender
             },
             'vitals': {
-                'bmi': self.bmi,
-                'avg_systolic_bp': self.avg_systolic_bp,
-                'avg_diastolic_bp': self.avg_diastolic_bp,
-                'avg_heart_rate': self.avg_heart_rate,
-                'height_cm': self.height_cm,
-                'weight_kg': self.weight_kg
+                'bmi': record.bmi,
+                'avg_systolic_bp': record.avg_systolic_bp,
+                'avg_diastolic_bp': record.avg_diastolic_bp,
+                'avg_heart_rate': record.avg_heart_rate,
+                'height_cm': record.height_cm,
+                'weight_kg': record.weight_kg
             },
             'labs': {
-                'avg_cholesterol': self.avg_cholesterol,
-                'avg_hdl': self.avg_hdl,
-                'avg_ldl': self.avg_ldl,
-                'avg_triglycerides': self.avg_triglycerides,
-                'avg_hemoglobin': self.avg_hemoglobin
+                'avg_cholesterol': record.avg_cholesterol,
+                'avg_hdl': record.avg_hdl,
+                'avg_ldl': record.avg_ldl,
+                'avg_triglycerides': record.avg_triglycerides,
+                'avg_hemoglobin': record.avg_hemoglobin
             },
             'clinical_history': {
-                'total_observations': self.total_observations,
-                'observation_span_days': self.observation_span_days,
-                'consultation_frequency': self.consultation_frequency
+                'total_observations': record.total_observations,
+                'observation_span_days': record.observation_span_days,
+                'consultation_frequency': record.consultation_frequency
             },
             # NLP Features (flat structure for consistency)
-            'nlp_num_conditions': self.nlp_num_conditions,
-            'nlp_has_diabetes': self.nlp_has_diabetes,
-            'nlp_has_hypertension': self.nlp_has_hypertension,
-            'nlp_has_chf': self.nlp_has_chf,
-            'nlp_has_copd': self.nlp_has_copd,
-            'nlp_has_ckd': self.nlp_has_ckd,
-            'nlp_num_medications': self.nlp_num_medications,
-            'nlp_polypharmacy': self.nlp_polypharmacy,
-            'nlp_num_symptoms': self.nlp_num_symptoms,
-            'nlp_has_pain': self.nlp_has_pain,
-            'nlp_has_dyspnea': self.nlp_has_dyspnea,
-            'nlp_note_length': self.nlp_note_length,
-            'nlp_note_count': self.nlp_note_count,
-            'nlp_avg_note_length': self.nlp_avg_note_length,
+            'nlp_num_conditions': record.nlp_num_conditions,
+            'nlp_has_diabetes': record.nlp_has_diabetes,
+            'nlp_has_hypertension': record.nlp_has_hypertension,
+            'nlp_has_chf': record.nlp_has_chf,
+            'nlp_has_copd': record.nlp_has_copd,
+            'nlp_has_ckd': record.nlp_has_ckd,
+            'nlp_num_medications': record.nlp_num_medications,
+            'nlp_polypharmacy': record.nlp_polypharmacy,
+            'nlp_num_symptoms': record.nlp_num_symptoms,
+            'nlp_has_pain': record.nlp_has_pain,
+            'nlp_has_dyspnea': record.nlp_has_dyspnea,
+            'nlp_note_length': record.nlp_note_length,
+            'nlp_note_count': record.nlp_note_count,
+            'nlp_avg_note_length': record.nlp_avg_note_length,
             
-            'extraction_date': self.extraction_date.isoformat() if self.extraction_date else None
+            'extraction_date': record.extraction_date.isoformat() if record.extraction_date else None
         }
  
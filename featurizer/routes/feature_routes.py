@@ -1,11 +1,12 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from models.feature_vector import PatientFeatures, Base
 from extractors.patient_features import PatientFeatureExtractor
 from extractors.vital_signs_features import VitalSignsFeatureExtractor
 from extractors.lab_results_features import LabResultsFeatureExtractor
-from services.clinical_nlp import ClinicalNLPExtractor
+from services.feature_stats import FeatureStatsCache
+from services.feature_listing import build_listing_query, parse_listing_args, stream_listing
 from config import Config
 from datetime import datetime
 import logging
@@ -20,11 +21,14 @@ engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
 Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
 
+# Synthèse des stats maintenue par triggers, servie depuis la mémoire
+stats_cache = FeatureStatsCache(engine, ttl_seconds=Config.STATS_CACHE_TTL)
+stats_cache.install()
+
 # Initialisation des extracteurs
 patient_extractor = PatientFeatureExtractor()
 vitals_extractor = VitalSignsFeatureExtractor()
 labs_extractor = LabResultsFeatureExtractor()
-nlp_extractor = ClinicalNLPExtractor()
 
 @feature_bp.route('/health', methods=['GET'])
 def health():
@@ -65,19 +69,9 @@ def extract_all_features():
         patients = session.execute(query).fetchall()
         session.close()
         
-        results = []
-        errors = []
-        
-        for patient in patients:
-            patient_id = patient[0]
-            try:
-                features, status = extraction_service.extract_features(patient_id)
-                if features:
-                    results.append(patient_id)
-                else:
-                    errors.append({'patient_id': patient_id, 'error': status})
-            except Exception as e:
-                errors.append({'patient_id': patient_id, 'error': str(e)})
+        # Extraction par lots : un upsert + un commit par lot
+        patient_ids = [patient[0] for patient in patients]
+        results, errors = extraction_service.extract_features_bulk(patient_ids)
         
         return jsonify({
             'status': 'success',
@@ -110,45 +104,51 @@ def get_patient_features(patient_id):
 
 @feature_bp.route('/stats', methods=['GET'])
 def get_stats():
-    """Statistiques sur les features extraites"""
+    """Statistiques sur les features extraites (synthèse feature_stats, cache mémoire)"""
     try:
-        session = Session()
-        
-        from sqlalchemy import func
-        
-        total = session.query(func.count(PatientFeatures.id)).scalar()
-        
-        avg_age = session.query(func.avg(PatientFeatures.age)).scalar()
-        avg_bmi = session.query(func.avg(PatientFeatures.bmi)).scalar()
-        avg_cholesterol = session.query(func.avg(PatientFeatures.avg_cholesterol)).scalar()
-        
-        session.close()
-        
-        return jsonify({
-            'total_patients': total,
-            'average_age': round(avg_age, 1) if avg_age else None,
-            'average_bmi': round(avg_bmi, 2) if avg_bmi else None,
-            'average_cholesterol': round(avg_cholesterol, 2) if avg_cholesterol else None
-        }), 200
+        return jsonify(stats_cache.get()), 200
         
     except Exception as e:
         logger.error(f"Error getting stats: {e}")
         return jsonify({'error': str(e)}), 500
 
+@feature_bp.route('/stats/refresh', methods=['POST'])
+def refresh_stats():
+    """Recalcule entièrement la synthèse feature_stats"""
+    try:
+        stats_cache.refresh()
+        return jsonify(stats_cache.get()), 200
+        
+    except Exception as e:
+        logger.error(f"Error refreshing stats: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @feature_bp.route('/features', methods=['GET'])
 def list_all_features():
-    """Liste toutes les features extraites"""
+    """
+    Liste paginée des features extraites
+
+    Query params:
+        limit: taille de page (défaut 500, max 5000)
+        cursor: valeur next_cursor de la page précédente
+        fields: projection, ex. ?fields=age,bmi (features_json seulement si demandé)
+        <colonne>=valeur, min_<colonne>, max_<colonne>: filtres côté serveur
+    """
     try:
+        params = parse_listing_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        stmt = build_listing_query(
+            params['limit'], params['cursor'], params['fields'], params['filters']
+        )
         session = Session()
-        all_features = session.query(PatientFeatures).all()
-        session.close()
-        
-        return jsonify({
-            'total': len(all_features),
-            'features': [f.to_dict() for f in all_features]
-        }), 200
+        return Response(
+            stream_with_context(stream_listing(session, stmt, params['limit'], params['fields'])),
+            mimetype='application/json'
+        )
         
     except Exception as e:
         logger.error(f"Error listing features: {e}")
         return jsonify({'error': str(e)}), 500
- 
@@ -1,4 +1,5 @@
 from flask import Blueprint, jsonify
+from services import model_registry
 import logging
 
 health_bp = Blueprint('health', __name__)
@@ -11,7 +12,7 @@ def health_check():
         return jsonify({
             'status': 'healthy',
             'service': 'featurizer',
-            'nlp_models': 'loaded'
+            'nlp_models': 'loaded' if model_registry.is_loaded() else 'lazy'
         }), 200
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
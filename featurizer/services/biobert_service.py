@@ -1,5 +1,7 @@
 from transformers import AutoTokenizer, AutoModelForTokenClassification, pipeline
+from .inference_batcher import InferenceBatcher
 import logging
+import os
 from typing import List, Dict
 
 logger = logging.getLogger(__name__)
@@ -10,6 +12,7 @@ class BioBERTService:
     def __init__(self, model_name: str = "dmis-lab/biobert-base-cased-v1.1"):
         self.model_name = model_name
         self.ner_pipeline = None
+        self.batcher = None
         self.load_model()
 
     def load_model(self):
@@ -41,6 +44,14 @@ class BioBERTService:
                 device=device
             )
 
+            # Shared inference queue: concurrent requests are coalesced into
+            # one batched forward pass instead of fighting over CPU threads
+            self.batcher = InferenceBatcher(
+                self._run_ner_batch,
+                max_batch_size=int(os.getenv('NLP_BATCH_MAX_SIZE', 16)),
+                max_wait_ms=float(os.getenv('NLP_BATCH_MAX_WAIT_MS', 5))
+            )
+
             logger.info("OpenMed NER model loaded successfully")
 
         except Exception as e:
@@ -48,6 +59,15 @@ class BioBERTService:
             logger.info("Falling back to keyword-based extraction")
             # Fallback to simple extraction if model fails
             self.ner_pipeline = None
+            self.batcher = None
+
+    def _run_ner_batch(self, texts: List[str]) -> List[List[Dict]]:
+        """Run the NER pipeline on a batch of texts (one entity list per text)"""
+        results = self.ner_pipeline(texts, batch_size=len(texts))
+        # A single input makes the pipeline return the entity list unwrapped
+        if len(texts) == 1 and results and isinstance(results[0], dict):
+            return [results]
+        return results
 
     def extract_medical_entities(self, clinical_text: str) -> Dict[str, List[str]]:
         """
@@ -71,8 +91,8 @@ class BioBERTService:
             if self.ner_pipeline is None:
                 return keyword_entities
 
-            # Run OpenMed NER for disease detection
-            ner_results = self.ner_pipeline(clinical_text)
+            # Run OpenMed NER for disease detection (via the shared microbatcher)
+            ner_results = self.batcher.infer(clinical_text)
 
             # Combine OpenMed diseases with keyword results
             combined_entities = keyword_entities.copy()
@@ -0,0 +1,141 @@
+from datetime import date, datetime
+import json
+import logging
+
+from sqlalchemy import select
+
+from models.feature_vector import PatientFeatures
+from services import json_codec
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+STREAM_CHUNK_ROWS = 500
+
+# Columns a client may project or filter on (features_json only when asked for)
+LISTABLE_COLUMNS = {
+    column.name: column for column in PatientFeatures.__table__.columns
+    if column.name != 'id'
+}
+DEFAULT_COLUMNS = [name for name in LISTABLE_COLUMNS if name != 'features_json']
+NUMERIC_TYPES = (int, float)
+RESERVED_ARGS = {'limit', 'cursor', 'fields'}
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _coerce(column, raw):
+    """Convert a query-string value to the column's Python type"""
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(raw)
+    return python_type(raw)
+
+
+def parse_listing_args(args):
+    """
+    Parse and validate GET /features query arguments.
+
+    Args:
+        args: request.args (or any mapping of str -> str)
+
+    Returns:
+        Dict with limit, cursor, fields (None = default layout) and filters
+
+    Raises:
+        ValueError: on unknown fields/filters or malformed values
+    """
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    cursor = args.get('cursor')
+    cursor = int(cursor) if cursor else None
+
+    fields = None
+    if args.get('fields'):
+        fields = [f.strip() for f in args['fields'].split(',') if f.strip()]
+        unknown = [f for f in fields if f not in LISTABLE_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+    filters = []
+    for name, raw in args.items():
+        if name in RESERVED_ARGS:
+            continue
+        op = 'eq'
+        column_name = name
+        if name.startswith('min_') or name.startswith('max_'):
+            op, column_name = name[:3], name[4:]
+        column = LISTABLE_COLUMNS.get(column_name)
+        if column is None or column_name == 'features_json':
+            raise ValueError(f"Unknown filter: {name}")
+        if op != 'eq' and column.type.python_type not in NUMERIC_TYPES + (datetime,):
+            raise ValueError(f"Range filter not supported on {column_name}")
+        filters.append((column, op, _coerce(column, raw)))
+
+    return {'limit': limit, 'cursor': cursor, 'fields': fields, 'filters': filters}
+
+
+def build_listing_query(limit, cursor=None, fields=None, filters=()):
+    """Keyset-paginated SELECT of the projected columns only (one extra row to detect a next page)"""
+    names = fields or DEFAULT_COLUMNS
+    columns = [PatientFeatures.__table__.c.id] + [LISTABLE_COLUMNS[name] for name in names]
+    if 'patient_id' not in names:
+        columns.append(LISTABLE_COLUMNS['patient_id'])
+
+    stmt = select(*columns)
+    if cursor is not None:
+        stmt = stmt.where(PatientFeatures.__table__.c.id > cursor)
+    for column, op, value in filters:
+        if op == 'min':
+            stmt = stmt.where(column >= value)
+        elif op == 'max':
+            stmt = stmt.where(column <= value)
+        else:
+            stmt = stmt.where(column == value)
+
+    return stmt.order_by(PatientFeatures.__table__.c.id).limit(limit + 1)
+
+
+def stream_listing(session, stmt, limit, fields=None):
+    """
+    Encode a listing page as a JSON document, row by row.
+
+    Rows are fetched from a server-side cursor and written as they arrive,
+    so memory is bounded by STREAM_CHUNK_ROWS rather than by the page.
+    The session is closed once the document is complete.
+    """
+    try:
+        result = session.execute(stmt.execution_options(yield_per=STREAM_CHUNK_ROWS))
+        yield '{"features": ['
+        count = 0
+        last_id = None
+        has_more = False
+        for row in result:
+            if count == limit:
+                has_more = True
+                break
+            if fields:
+                record = {'patient_id': row.patient_id}
+                record.update({name: getattr(row, name) for name in fields})
+            else:
+                record = PatientFeatures.serialize(row)
+            yield (',' if count else '') + json_codec.dumps(record, default=_json_default)
+            count += 1
+            last_id = row.id
+        result.close()
+
+        next_cursor = str(last_id) if has_more else None
+        yield '], "count": %d, "next_cursor": %s}' % (count, json.dumps(next_cursor))
+    except Exception as e:
+        logger.error(f"Error streaming features: {e}")
+        raise
+    finally:
+        session.close()
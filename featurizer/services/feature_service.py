@@ -1,19 +1,20 @@
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine, text
 from config import Config
-from models.feature_vector import PatientFeatures
 from extractors.patient_features import PatientFeatureExtractor
 from extractors.vital_signs_features import VitalSignsFeatureExtractor
 from extractors.lab_results_features import LabResultsFeatureExtractor
 from services.clinical_nlp import ClinicalNLPExtractor
+from services.feature_writer import upsert_patient_features
+from services import json_codec
 from datetime import datetime
-import json
 import logging
 
 logger = logging.getLogger(__name__)
 
 class FeatureExtractionService:
     def __init__(self):
+        json_codec.register_psycopg2()
         self.engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
         self.Session = sessionmaker(bind=self.engine)
         self.patient_extractor = PatientFeatureExtractor()
@@ -24,122 +25,12 @@ class FeatureExtractionService:
     def extract_features(self, patient_id):
         session = self.Session()
         try:
-            # Check existing records
-            existing = session.query(PatientFeatures).filter_by(patient_id=patient_id).first()
-            
-            # Fetch FHIR data
-            query = text("""
-                SELECT resource_data 
-                FROM fhir_resources_anonymized 
-                WHERE anonymized_fhir_id = :patient_id 
-                AND resource_type = 'Patient'
-            """)
-            patient_result = session.execute(query, {'patient_id': patient_id}).fetchone()
-            
-            all_features = {}
-            
-            if patient_result:
-                # Full extraction from FHIR
-                patient_data = json.loads(patient_result[0]) if isinstance(patient_result[0], str) else patient_result[0]
-                
-                obs_query = text("""
-                    SELECT resource_data 
-                    FROM fhir_resources_anonymized 
-                    WHERE resource_data::json->'subject'->>'reference' = :patient_ref
-                    AND resource_type = 'Observation'
-                """)
-                obs_results = session.execute(obs_query, {'patient_ref': f'Patient/{patient_id}'}).fetchall()
-                observations = [json.loads(row[0]) if isinstance(row[0], str) else row[0] for row in obs_results]
-                
-                patient_features = self.patient_extractor.extract(patient_data)
-                vitals_features = self.vitals_extractor.extract(observations)
-                labs_features = self.labs_extractor.extract(observations)
-                
-                # Clinical features calculation
-                clinical_features = {}
-                if observations:
-                    clinical_features['total_observations'] = len(observations)
-                    dates = []
-                    for obs in observations:
-                        if 'effectiveDateTime' in obs:
-                            try:
-                                date = datetime.fromisoformat(obs['effectiveDateTime'].replace('Z', '+00:00'))
-                                dates.append(date)
-                            except:
-                                pass
-                    if len(dates) > 1:
-                        dates.sort()
-                        span = (dates[-1] - dates[0]).days
-                        clinical_features['observation_span_days'] = span
-                        clinical_features['consultation_frequency'] = round(len(observations) / max(span, 1), 4)
-                
-                all_features.update({**patient_features, **vitals_features, **labs_features, **clinical_features})
-                
-            elif existing:
-                # Fallback to existing data
-                all_features = existing.features_json or {}
-            else:
-                return None, "Patient not found and no existing record"
+            all_features, status = self._compute_features(session, patient_id)
+            if all_features is None:
+                return None, status
 
-            # Fetch clinical notes
-            notes_query = text("SELECT note_text FROM clinical_notes WHERE patient_id = :patient_id")
-            try:
-                notes_results = session.execute(notes_query, {'patient_id': patient_id}).fetchall()
-                clinical_notes = [row[0] for row in notes_results if row[0]]
-            except Exception as e:
-                logger.warning(f"Could not fetch notes: {e}")
-                clinical_notes = []
-            
-            # NLP Extraction
-            nlp_features = self.nlp_extractor.extract_clinical_features(clinical_notes)
-            all_features.update(nlp_features)
-            
-            # Save/Update
-            if existing:
-                for key, value in all_features.items():
-                    if hasattr(existing, key):
-                        setattr(existing, key, value)
-                existing.features_json = all_features
-                existing.extraction_date = datetime.utcnow()
-            else:
-                feature_record = PatientFeatures(
-                    patient_id=patient_id,
-                    age=all_features.get('age'),
-                    gender=all_features.get('gender'),
-                    bmi=all_features.get('bmi'),
-                    avg_systolic_bp=all_features.get('avg_systolic_bp'),
-                    avg_diastolic_bp=all_features.get('avg_diastolic_bp'),
-                    height_cm=all_features.get('height_cm'),
-                    weight_kg=all_features.get('weight_kg'),
-                    avg_cholesterol=all_features.get('avg_cholesterol'),
-                    avg_hdl=all_features.get('avg_hdl'),
-                    avg_ldl=all_features.get('avg_ldl'),
-                    avg_triglycerides=all_features.get('avg_triglycerides'),
-                    avg_hemoglobin=all_features.get('avg_hemoglobin'),
-                    total_observations=all_features.get('total_observations'),
-                    observation_span_days=all_features.get('observation_span_days'),
-                    consultation_frequency=all_features.get('consultation_frequency'),
-                    
-                    # NLP Features
-                    nlp_num_conditions=all_features.get('nlp_num_conditions'),
-                    nlp_has_diabetes=all_features.get('nlp_has_diabetes'),
-                    nlp_has_hypertension=all_features.get('nlp_has_hypertension'),
-                    nlp_has_chf=all_features.get('nlp_has_chf'),
-                    nlp_has_copd=all_features.get('nlp_has_copd'),
-                    nlp_has_ckd=all_features.get('nlp_has_ckd'),
-                    nlp_num_medications=all_features.get('nlp_num_medications'),
-                    nlp_polypharmacy=all_features.get('nlp_polypharmacy'),
-                    nlp_num_symptoms=all_features.get('nlp_num_symptoms'),
-                    nlp_has_pain=all_features.get('nlp_has_pain'),
-                    nlp_has_dyspnea=all_features.get('nlp_has_dyspnea'),
-                    nlp_note_length=all_features.get('nlp_note_length'),
-                    nlp_note_count=all_features.get('nlp_note_count'),
-                    nlp_avg_note_length=all_features.get('nlp_avg_note_length'),
-                    
-                    features_json=all_features
-                )
-                session.add(feature_record)
-            
+            # Save/Update (single upsert, features_json in the same statement)
+            upsert_patient_features(session, [(patient_id, all_features)])
             session.commit()
             return all_features, "success"
             
@@ -149,3 +40,117 @@ class FeatureExtractionService:
             return None, str(e)
         finally:
             session.close()
+
+    def extract_features_bulk(self, patient_ids, batch_size=200):
+        """
+        Extract features for many patients, upserting them batch by batch.
+
+        Returns:
+            Tuple of (extracted patient ids, list of {'patient_id', 'error'})
+        """
+        results = []
+        errors = []
+        session = self.Session()
+        try:
+            for start in range(0, len(patient_ids), batch_size):
+                batch = []
+                for patient_id in patient_ids[start:start + batch_size]:
+                    try:
+                        all_features, status = self._compute_features(session, patient_id)
+                    except Exception as e:
+                        session.rollback()
+                        all_features, status = None, str(e)
+                    if all_features is None:
+                        errors.append({'patient_id': patient_id, 'error': status})
+                    else:
+                        batch.append((patient_id, all_features))
+
+                try:
+                    upsert_patient_features(session, batch)
+                    session.commit()
+                    results.extend(patient_id for patient_id, _ in batch)
+                except Exception as e:
+                    session.rollback()
+                    logger.error(f"Bulk upsert error: {e}")
+                    errors.extend({'patient_id': patient_id, 'error': str(e)} for patient_id, _ in batch)
+
+                logger.info(f"Bulk extraction progress: {len(results)} extracted, {len(errors)} errors")
+        finally:
+            session.close()
+
+        return results, errors
+
+    def _compute_features(self, session, patient_id):
+        """Compute the full feature dict of a patient without writing it"""
+        # Fetch FHIR data
+        query = text("""
+            SELECT resource_data 
+            FROM fhir_resources_anonymized 
+            WHERE anonymized_fhir_id = :patient_id 
+            AND resource_type = 'Patient'
+        """)
+        patient_result = session.execute(query, {'patient_id': patient_id}).fetchone()
+        
+        all_features = {}
+        
+        if patient_result:
+            # Full extraction from FHIR
+            patient_data = json_codec.loads(patient_result[0]) if isinstance(patient_result[0], str) else patient_result[0]
+            
+            obs_query = text("""
+                SELECT resource_data 
+                FROM fhir_resources_anonymized 
+                WHERE resource_data::json->'subject'->>'reference' = :patient_ref
+                AND resource_type = 'Observation'
+            """)
+            obs_results = session.execute(obs_query, {'patient_ref': f'Patient/{patient_id}'}).fetchall()
+            observations = [json_codec.loads(row[0]) if isinstance(row[0], str) else row[0] for row in obs_results]
+            
+            patient_features = self.patient_extractor.extract(patient_data)
+            vitals_features = self.vitals_extractor.extract(observations)
+            labs_features = self.labs_extractor.extract(observations)
+            
+            # Clinical features calculation
+            clinical_features = {}
+            if observations:
+                clinical_features['total_observations'] = len(observations)
+                dates = []
+                for obs in observations:
+                    if 'effectiveDateTime' in obs:
+                        try:
+                            date = datetime.fromisoformat(obs['effectiveDateTime'].replace('Z', '+00:00'))
+                            dates.append(date)
+                        except:
+                            pass
+                if len(dates) > 1:
+                    dates.sort()
+                    span = (dates[-1] - dates[0]).days
+                    clinical_features['observation_span_days'] = span
+                    clinical_features['consultation_frequency'] = round(len(observations) / max(span, 1), 4)
+            
+            all_features.update({**patient_features, **vitals_features, **labs_features, **clinical_features})
+            
+        else:
+            # Fallback to existing data
+            existing_query = text("SELECT features_json FROM patient_features WHERE patient_id = :patient_id")
+            existing = session.execute(existing_query, {'patient_id': patient_id}).fetchone()
+            if existing is None:
+                return None, "Patient not found and no existing record"
+            existing_json = existing[0]
+            all_features = (json_codec.loads(existing_json) if isinstance(existing_json, str) else existing_json) or {}
+
+        # Fetch clinical notes
+        notes_query = text("SELECT note_text FROM clinical_notes WHERE patient_id = :patient_id")
+        try:
+            notes_results = session.execute(notes_query, {'patient_id': patient_id}).fetchall()
+            clinical_notes = [row[0] for row in notes_results if row[0]]
+        except Exception as e:
+            logger.warning(f"Could not fetch notes: {e}")
+            session.rollback()
+            clinical_notes = []
+        
+        # NLP Extraction
+        nlp_features = self.nlp_extractor.extract_clinical_features(clinical_notes)
+        all_features.update(nlp_features)
+
+        return all_features, "success"
@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Aggregated columns of the summary: stat name -> patient_features column
+STAT_COLUMNS = {
+    'age': 'age',
+    'bmi': 'bmi',
+    'cholesterol': 'avg_cholesterol',
+}
+
+_sum_cols = ',\n    '.join(
+    f"{name}_sum DOUBLE PRECISION NOT NULL DEFAULT 0,\n    {name}_count BIGINT NOT NULL DEFAULT 0"
+    for name in STAT_COLUMNS
+)
+_delta_select = ', '.join(
+    f"COALESCE(SUM({col}), 0) AS {name}_sum, COUNT({col}) AS {name}_count"
+    for name, col in STAT_COLUMNS.items()
+)
+
+
+def _apply(sign, rows_table):
+    assignments = ', '.join(
+        f"{name}_sum = s.{name}_sum {sign} d.{name}_sum, "
+        f"{name}_count = s.{name}_count {sign} d.{name}_count"
+        for name in STAT_COLUMNS
+    )
+    return (
+        f"UPDATE feature_stats s SET total_patients = s.total_patients {sign} d.n, "
+        f"{assignments}, updated_at = now() "
+        f"FROM (SELECT COUNT(*) AS n, {_delta_select} FROM {rows_table}) d "
+        f"WHERE s.id = 1 AND d.n > 0;"
+    )
+
+
+# Single-row summary kept up to date by statement-level triggers: each
+# INSERT / UPDATE / DELETE (including the bulk upsert) applies its delta
+# from the transition tables, so readers never scan patient_features.
+DDL = [
+    f"""
+CREATE TABLE IF NOT EXISTS feature_stats (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    total_patients BIGINT NOT NULL DEFAULT 0,
+    {_sum_cols},
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+)
+""",
+    f"""
+CREATE OR REPLACE FUNCTION feature_stats_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        {_apply('-', 'old_rows')}
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        {_apply('+', 'new_rows')}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+""",
+    """
+CREATE OR REPLACE TRIGGER feature_stats_on_insert
+    AFTER INSERT ON patient_features
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION feature_stats_apply()
+""",
+    """
+CREATE OR REPLACE TRIGGER feature_stats_on_update
+    AFTER UPDATE ON patient_features
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION feature_stats_apply()
+""",
+    """
+CREATE OR REPLACE TRIGGER feature_stats_on_delete
+    AFTER DELETE ON patient_features
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION feature_stats_apply()
+""",
+]
+
+REFRESH_SQL = f"""
+INSERT INTO feature_stats (id, total_patients, {', '.join(f'{n}_sum, {n}_count' for n in STAT_COLUMNS)}, updated_at)
+SELECT 1, COUNT(*), {', '.join(f'COALESCE(SUM({c}), 0), COUNT({c})' for c in STAT_COLUMNS.values())}, now()
+FROM patient_features
+ON CONFLICT (id) DO UPDATE SET
+    total_patients = EXCLUDED.total_patients,
+    {', '.join(f'{n}_sum = EXCLUDED.{n}_sum, {n}_count = EXCLUDED.{n}_count' for n in STAT_COLUMNS)},
+    updated_at = EXCLUDED.updated_at
+"""
+
+
+class FeatureStatsCache:
+    """Feature stats served from memory, re-read at most once per TTL"""
+
+    def __init__(self, engine, ttl_seconds=30):
+        self.engine = engine
+        self.ttl = ttl_seconds
+        self._value = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def install(self):
+        """Create the summary table and its triggers; backfill it when empty"""
+        with self.engine.begin() as conn:
+            # Transaction-level lock: one worker runs the DDL at a time
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('feature_stats'))"))
+            for statement in DDL:
+                conn.execute(text(statement))
+            if conn.execute(text("SELECT 1 FROM feature_stats WHERE id = 1")).first() is None:
+                conn.execute(text(REFRESH_SQL))
+                logger.info("feature_stats summary initialized from patient_features")
+
+    def refresh(self):
+        """Recompute the whole summary (repairs any drift)"""
+        with self.engine.begin() as conn:
+            conn.execute(text(REFRESH_SQL))
+        self.invalidate()
+
+    def invalidate(self):
+        self._expires_at = 0
+
+    def get(self):
+        """Return the stats: zero queries within the TTL, one otherwise"""
+        now = time.monotonic()
+        if self._value is not None and now < self._expires_at:
+            return self._value
+        with self._lock:
+            if self._value is None or time.monotonic() >= self._expires_at:
+                self._value = self._load()
+                self._expires_at = time.monotonic() + self.ttl
+        return self._value
+
+    def _load(self):
+        with self.engine.connect() as conn:
+            row = conn.execute(text("SELECT * FROM feature_stats WHERE id = 1")).mappings().first()
+
+        if row is None:
+            return {'total_patients': 0, 'average_age': None,
+                    'average_bmi': None, 'average_cholesterol': None}
+
+        def average(name, digits):
+            count = row[f'{name}_count']
+            return round(row[f'{name}_sum'] / count, digits) if count else None
+
+        return {
+            'total_patients': row['total_patients'],
+            'average_age': average('age', 1),
+            'average_bmi': average('bmi', 2),
+            'average_cholesterol': average('cholesterol', 2),
+            'updated_at': row['updated_at'].isoformat() if row['updated_at'] else None,
+        }
@@ -0,0 +1,72 @@
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+import logging
+
+from psycopg2.extras import Json, execute_values
+
+from models.feature_vector import PatientFeatures
+from services import json_codec
+
+logger = logging.getLogger(__name__)
+
+# Typed patient_features columns filled from the features dict
+FEATURE_COLUMNS = [
+    column.name for column in PatientFeatures.__table__.columns
+    if column.name not in ('id', 'patient_id', 'features_json', 'extraction_date')
+]
+INSERT_COLUMNS = ['patient_id'] + FEATURE_COLUMNS + ['features_json', 'extraction_date']
+
+# A key missing from the dict keeps the stored value (like the old setattr loop)
+UPSERT_SQL = (
+    f"INSERT INTO {PatientFeatures.__tablename__} ({', '.join(INSERT_COLUMNS)}) VALUES %s "
+    f"ON CONFLICT (patient_id) DO UPDATE SET "
+    + ', '.join(
+        f"{col} = COALESCE(EXCLUDED.{col}, {PatientFeatures.__tablename__}.{col})"
+        for col in FEATURE_COLUMNS
+    )
+    + ", features_json = EXCLUDED.features_json"
+    + ", extraction_date = EXCLUDED.extraction_date"
+)
+
+
+def build_feature_row(patient_id: str, features: Dict, extraction_date: datetime = None) -> Tuple:
+    """Build one row in INSERT_COLUMNS order, JSON column included"""
+    extraction_date = extraction_date or datetime.utcnow()
+    return (
+        (patient_id,)
+        + tuple(features.get(col) for col in FEATURE_COLUMNS)
+        + (Json(features, dumps=json_codec.dumps), extraction_date)
+    )
+
+
+def upsert_patient_features(session, batch: Iterable[Tuple[str, Dict]], page_size: int = 500) -> int:
+    """
+    Write a batch of feature vectors with one INSERT ... ON CONFLICT DO UPDATE.
+
+    Args:
+        session: SQLAlchemy session (the caller commits)
+        batch: (patient_id, features) pairs
+        page_size: Rows per execute_values statement
+
+    Returns:
+        Number of rows written
+    """
+    extraction_date = datetime.utcnow()
+    # Postgres refuses to update the same row twice in one statement: last one wins
+    latest = dict(batch)
+    rows: List[Tuple] = [
+        build_feature_row(patient_id, features, extraction_date)
+        for patient_id, features in latest.items()
+    ]
+    if not rows:
+        return 0
+
+    # DBAPI cursor on the session's connection: same transaction
+    cursor = session.connection().connection.cursor()
+    try:
+        execute_values(cursor, UPSERT_SQL, rows, page_size=page_size)
+    finally:
+        cursor.close()
+
+    logger.info(f"Upserted {len(rows)} patient feature rows")
+    return len(rows)
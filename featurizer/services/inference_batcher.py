@@ -0,0 +1,96 @@
+from concurrent.futures import Future
+import logging
+import os
+import queue
+import threading
+import time
+import weakref
+from typing import Any, Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceBatcher:
+    """
+    Coalesce concurrent inference requests into a single batched call.
+
+    Callers submit an item and get a Future back. One inference thread collects
+    submissions for up to max_wait_ms or max_batch_size items, runs infer_fn on
+    the whole batch, then resolves each caller's Future with its own result.
+    """
+
+    def __init__(self, infer_fn: Callable[[List[Any]], List[Any]],
+                 max_batch_size: int = 16, max_wait_ms: float = 5):
+        self.infer_fn = infer_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # The thread does not survive a fork, and the queue and lock
+            # inherited from the parent may be mid-use: reset them in the child
+            ref = weakref.ref(self)
+            os.register_at_fork(after_in_child=lambda: ref() and ref()._reset())
+
+    def _reset(self):
+        """Fresh queue and lock, no worker thread (at init and in a forked child)"""
+        self._queue = queue.Queue()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, item: Any) -> Future:
+        """Submit an item; the Future resolves once its batch has run"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def infer(self, item: Any, timeout: float = None) -> Any:
+        """Blocking submit returning the result directly"""
+        return self.submit(item).result(timeout=timeout)
+
+    def _ensure_worker(self):
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                # Published only once started, so the check above never sees a half-set worker
+                thread = threading.Thread(
+                    target=self._run, name='nlp-inference-batcher', daemon=True
+                )
+                thread.start()
+                self._thread = thread
+
+    def _collect_batch(self):
+        """Block for a first item, then fill the batch until the deadline"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            items = [item for item, _ in batch]
+            try:
+                results = self.infer_fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(
+                        f"Batch inference returned {len(results)} results for {len(items)} inputs"
+                    )
+            except Exception as e:
+                logger.error(f"Batched inference failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Pluggable JSON codec, shared by the service and the bundle-heavy scripts
+# (scripts/ put featurizer/ on sys.path). Picks the fastest backend available:
+# orjson, then pysimdjson (parsing only), then the standard library. Force one
+# with HEALTHFLOW_JSON=orjson|simdjson|stdlib; backend= overrides it per call.
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:  # optional dependency
+    simdjson = None
+
+BACKENDS = ('orjson', 'simdjson', 'stdlib')
+
+
+def _select_backend() -> str:
+    """Fastest available backend, unless forced with HEALTHFLOW_JSON"""
+    forced = os.getenv('HEALTHFLOW_JSON')
+    if forced:
+        if forced not in BACKENDS:
+            raise ValueError(f"Unknown HEALTHFLOW_JSON backend {forced!r} (expected one of {', '.join(BACKENDS)})")
+        return forced
+    if orjson is not None:
+        return 'orjson'
+    if simdjson is not None:
+        return 'simdjson'
+    return 'stdlib'
+
+
+BACKEND = _select_backend()
+
+
+def available_backends():
+    """Backends importable in this environment (used by the benchmark)"""
+    return [name for name, module in (('orjson', orjson), ('simdjson', simdjson)) if module] + ['stdlib']
+
+
+def loads(data, *, backend: str = None) -> Any:
+    """Parse JSON from str or bytes"""
+    backend = backend or BACKEND
+    if backend == 'orjson':
+        return orjson.loads(data)
+    if backend == 'simdjson':
+        return simdjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, default=None, *, backend: str = None) -> str:
+    """Serialize to a compact JSON str"""
+    return dumps_bytes(obj, default, backend=backend).decode('utf-8')
+
+
+def dumps_bytes(obj, default=None, *, backend: str = None) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes (simdjson has no encoder: stdlib is used)"""
+    backend = backend or BACKEND
+    if backend == 'orjson':
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, default=default, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def load_file(path) -> Any:
+    """Parse a JSON file with the selected backend"""
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def register_psycopg2():
+    """Decode json/jsonb columns returned by psycopg2 with the selected backend"""
+    from psycopg2.extras import register_default_json, register_default_jsonb
+
+    register_default_json(globally=True, loads=loads)
+    register_default_jsonb(globally=True, loads=loads)
+    logger.info(f"JSON codec: {BACKEND}")
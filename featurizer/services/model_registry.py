@@ -0,0 +1,53 @@
+import gc
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Registre process-wide des modèles NLP (un seul chargement par process)
+_biobert_service = None
+_lock = threading.Lock()
+
+
+def get_biobert_service():
+    """Retourne le BioBERTService partagé, chargé au premier appel"""
+    global _biobert_service
+    if _biobert_service is None:
+        with _lock:
+            if _biobert_service is None:
+                from .biobert_service import BioBERTService
+                logger.info(f"Loading shared NLP model (pid={os.getpid()})")
+                _biobert_service = BioBERTService()
+    return _biobert_service
+
+
+def is_loaded():
+    """Indique si le modèle NLP est déjà en mémoire"""
+    return _biobert_service is not None
+
+
+def warm_up():
+    """
+    Charge le modèle avant le fork des workers.
+
+    Appelé depuis create_app (NLP_PRELOAD) ou le hook de pré-fork du serveur :
+    les poids chargés dans le process parent sont partagés en copy-on-write
+    par les workers forkés. gc.freeze() évite que le GC des workers ne
+    touche (et donc ne copie) les pages des objets déjà chargés.
+    """
+    service = get_biobert_service()
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+    return service
+
+
+def _reset_lock_after_fork():
+    """Un lock hérité du parent peut être dans un état verrouillé"""
+    global _lock
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_lock_after_fork)
@@ -0,0 +1,163 @@
+import re
+from typing import Dict, Iterable, List, Set
+
+# Flags derived from the affirmed entity set: feature -> (entity category, keywords)
+FLAG_KEYWORDS = {
+    'nlp_has_diabetes': ('conditions', ('diabetes', 'dm2', 'diabetic')),
+    'nlp_has_hypertension': ('conditions', ('hypertension', 'htn', 'high blood pressure')),
+    'nlp_has_chf': ('conditions', ('chf', 'heart failure', 'congestive')),
+    'nlp_has_copd': ('conditions', ('copd', 'chronic obstructive')),
+    'nlp_has_ckd': ('conditions', ('ckd', 'chronic kidney', 'renal')),
+    'nlp_has_pain': ('symptoms', ('pain', 'ache', 'discomfort')),
+    'nlp_has_dyspnea': ('symptoms', ('dyspnea', 'shortness of breath', 'sob')),
+}
+
+# Fixed NLP feature vector, identical for the Featurizer service and the scripts
+NLP_FEATURE_NAMES = [
+    'nlp_num_conditions',
+    'nlp_has_diabetes',
+    'nlp_has_hypertension',
+    'nlp_has_chf',
+    'nlp_has_copd',
+    'nlp_has_ckd',
+    'nlp_num_medications',
+    'nlp_polypharmacy',
+    'nlp_note_length',
+    'nlp_note_count',
+    'nlp_avg_note_length',
+    'nlp_num_symptoms',
+    'nlp_has_pain',
+    'nlp_has_dyspnea',
+]
+
+ENTITY_CATEGORIES = ('conditions', 'medications', 'symptoms')
+
+# NegEx-style cues: a mention is negated when a cue precedes it in the same
+# clause and within NEGATION_WINDOW characters
+NEGATION_CUES = (
+    'no', 'not', 'denies', 'denied', 'deny', 'without', 'negative for',
+    'free of', 'absence of', 'no evidence of', 'no signs of', 'ruled out',
+)
+CLAUSE_BREAKS = r'[.;\n]|\bbut\b|\bhowever\b'
+NEGATION_WINDOW = 60
+
+
+def empty_nlp_features() -> Dict[str, int]:
+    """Feature vector for a patient without notes"""
+    return {name: 0 for name in NLP_FEATURE_NAMES}
+
+
+def combine_notes(notes: Iterable[str]) -> List[str]:
+    """Keep only non-empty notes"""
+    return [note for note in (notes or []) if note and note.strip()]
+
+
+def _normalize(entity: str) -> str:
+    return ' '.join(entity.lower().split())
+
+
+def _negated_terms(text_lower: str, terms: Set[str]) -> Set[str]:
+    """
+    Return the terms whose every mention in the text is negated.
+
+    Cues, clause breaks and terms are matched in a single regex scan.
+    Terms never found as whole words (e.g. NER sub-word spans) are
+    considered affirmed.
+    """
+    if not terms:
+        return set()
+
+    ordered_terms = sorted(terms, key=len, reverse=True)
+    ordered_cues = sorted(NEGATION_CUES, key=len, reverse=True)
+    pattern = re.compile(
+        r'(?P<brk>' + CLAUSE_BREAKS + r')'
+        r'|(?P<term>\b(?:' + '|'.join(re.escape(t) for t in ordered_terms) + r')\b)'
+        r'|(?P<neg>\b(?:' + '|'.join(re.escape(c) for c in ordered_cues) + r')\b)'
+    )
+
+    affirmed = set()
+    negated = set()
+    last_cue_end = None
+    for match in pattern.finditer(text_lower):
+        kind = match.lastgroup
+        if kind == 'brk':
+            last_cue_end = None
+        elif kind == 'neg':
+            last_cue_end = match.end()
+        else:
+            term = ' '.join(match.group().split())
+            if last_cue_end is not None and match.start() - last_cue_end <= NEGATION_WINDOW:
+                negated.add(term)
+            else:
+                affirmed.add(term)
+
+    # A term hidden inside a longer match ("pain" in "chest pain") shares its status
+    for term in terms - affirmed - negated:
+        if any(term in longer for longer in affirmed):
+            affirmed.add(term)
+        elif any(term in longer for longer in negated):
+            negated.add(term)
+
+    return negated - affirmed
+
+
+def normalize_entities(entities: Dict[str, List[str]], text: str) -> Dict[str, Set[str]]:
+    """
+    Build the normalized, negation-aware entity set.
+
+    Entities are lower-cased and deduplicated per category, then mentions
+    only ever seen in a negated context ("denies chest pain") are dropped.
+    """
+    normalized = {
+        category: {_normalize(e) for e in entities.get(category, []) if e and e.strip()}
+        for category in ENTITY_CATEGORIES
+    }
+    all_terms = set().union(*normalized.values())
+    negated = _negated_terms(text.lower(), all_terms)
+    return {category: terms - negated for category, terms in normalized.items()}
+
+
+def derive_nlp_features(entities: Dict[str, List[str]], notes: List[str],
+                        include_mentions: bool = False) -> Dict[str, any]:
+    """
+    Derive the NLP feature vector from extracted entities.
+
+    Args:
+        entities: Raw entities from BioBERTService.extract_medical_entities
+        notes: Clinical notes the entities were extracted from
+        include_mentions: Also return the affirmed condition/medication lists
+
+    Returns:
+        Dictionary with every NLP_FEATURE_NAMES entry
+    """
+    notes = combine_notes(notes)
+    if not notes:
+        features = empty_nlp_features()
+        if include_mentions:
+            features['nlp_conditions_mentioned'] = []
+            features['nlp_medications_mentioned'] = []
+        return features
+
+    combined_text = " ".join(notes)
+    affirmed = normalize_entities(entities, combined_text)
+
+    # One joined string per category, searched once per keyword
+    category_text = {category: ' | '.join(sorted(terms)) for category, terms in affirmed.items()}
+
+    features = {
+        'nlp_num_conditions': len(affirmed['conditions']),
+        'nlp_num_medications': len(affirmed['medications']),
+        'nlp_polypharmacy': int(len(affirmed['medications']) >= 5),
+        'nlp_note_length': len(combined_text),
+        'nlp_note_count': len(notes),
+        'nlp_avg_note_length': len(combined_text) / len(notes),
+        'nlp_num_symptoms': len(affirmed['symptoms']),
+    }
+    for name, (category, keywords) in FLAG_KEYWORDS.items():
+        features[name] = int(any(keyword in category_text[category] for keyword in keywords))
+
+    features = {name: features[name] for name in NLP_FEATURE_NAMES}
+    if include_mentions:
+        features['nlp_conditions_mentioned'] = sorted(affirmed['conditions'])
+        features['nlp_medications_mentioned'] = sorted(affirmed['medications'])
+    return features
@@ -0,0 +1,63 @@
+import os
+import threading
+import pytest
+from services.inference_batcher import InferenceBatcher
+
+def test_batcher_coalesces_concurrent_requests():
+    """Les requêtes concurrentes sont regroupées en un seul lot"""
+    batch_sizes = []
+    release = threading.Event()
+
+    def infer(items):
+        release.wait(timeout=5)
+        batch_sizes.append(len(items))
+        return [item.upper() for item in items]
+
+    batcher = InferenceBatcher(infer, max_batch_size=8, max_wait_ms=200)
+    futures = [batcher.submit(text) for text in ['a', 'b', 'c', 'd']]
+    release.set()
+
+    assert [f.result(timeout=5) for f in futures] == ['A', 'B', 'C', 'D']
+    assert sum(batch_sizes) == 4
+    assert max(batch_sizes) > 1
+
+def test_batcher_respects_max_batch_size():
+    """Un lot ne dépasse jamais max_batch_size"""
+    batch_sizes = []
+
+    def infer(items):
+        batch_sizes.append(len(items))
+        return items
+
+    batcher = InferenceBatcher(infer, max_batch_size=2, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(5)]
+
+    assert [f.result(timeout=5) for f in futures] == [0, 1, 2, 3, 4]
+    assert max(batch_sizes) <= 2
+
+def test_batcher_propagates_errors():
+    """Une erreur d'inférence est propagée à chaque appelant du lot"""
+    def infer(items):
+        raise ValueError("model failure")
+
+    batcher = InferenceBatcher(infer, max_batch_size=4, max_wait_ms=1)
+
+    with pytest.raises(ValueError):
+        batcher.infer('text', timeout=5)
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="fork unavailable")
+def test_batcher_restarts_after_fork():
+    """Un processus forké obtient son propre thread d'inférence"""
+    batcher = InferenceBatcher(lambda items: [item * 2 for item in items], max_wait_ms=1)
+    assert batcher.infer(1, timeout=5) == 2
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os._exit(0 if batcher.infer(3, timeout=5) == 6 else 1)
+        except BaseException:
+            os._exit(1)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.WEXITSTATUS(status) == 0
+    assert batcher.infer(2, timeout=5) == 4
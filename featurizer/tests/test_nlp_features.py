@@ -0,0 +1,48 @@
+from services.nlp_features import NLP_FEATURE_NAMES, derive_nlp_features, normalize_entities
+
+def test_derive_nlp_features_vector():
+    """Le vecteur NLP contient toutes les features, y compris les symptômes"""
+    entities = {
+        'conditions': ['Diabetes', 'hypertension', 'Heart Failure'],
+        'medications': ['metformin', 'lisinopril'],
+        'symptoms': ['pain', 'shortness of breath'],
+    }
+    notes = ["Patient with diabetes, hypertension and heart failure.",
+             "Reports chest pain and shortness of breath. On metformin and lisinopril."]
+
+    features = derive_nlp_features(entities, notes)
+
+    assert list(features) == NLP_FEATURE_NAMES
+    assert features['nlp_num_conditions'] == 3
+    assert features['nlp_has_diabetes'] == 1
+    assert features['nlp_has_chf'] == 1
+    assert features['nlp_has_copd'] == 0
+    assert features['nlp_num_symptoms'] == 2
+    assert features['nlp_has_pain'] == 1
+    assert features['nlp_has_dyspnea'] == 1
+    assert features['nlp_note_count'] == 2
+
+def test_negated_mentions_are_dropped():
+    """Les mentions niées ('denies chest pain') ne comptent pas"""
+    entities = {'conditions': ['copd'], 'symptoms': ['pain', 'dyspnea']}
+    text = "Patient denies chest pain. No evidence of copd. Reports dyspnea on exertion."
+
+    affirmed = normalize_entities(entities, text)
+
+    assert affirmed['symptoms'] == {'dyspnea'}
+    assert affirmed['conditions'] == set()
+
+def test_negation_stops_at_clause_break():
+    """La négation ne dépasse pas la fin de la proposition"""
+    entities = {'symptoms': ['fever', 'cough']}
+    text = "Denies fever but reports cough"
+
+    affirmed = normalize_entities(entities, text)
+
+    assert affirmed['symptoms'] == {'cough'}
+
+def test_empty_notes():
+    """Sans notes, toutes les features valent 0"""
+    features = derive_nlp_features({}, ['', None])
+
+    assert all(features[name] == 0 for name in NLP_FEATURE_NAMES)
@@ -32,6 +32,9 @@ class Config:
     PORT = int(os.getenv('PORT', 5002))
     DEBUG = os.getenv('FLASK_DEBUG', 'True').lower() == 'true'
     
+    # Durée de vie (s) du cache mémoire des stats
+    STATS_CACHE_TTL = int(os.getenv('STATS_CACHE_TTL', 30))
+    
     # Seuils de risque
     RISK_THRESHOLDS = {
         'low': 7.5,      # < 7.5%
@@ -8,6 +8,7 @@ from calculators.ascvd_calculator import ASCVDCalculator
 from services.xgboost_service import XGBoostPredictionService
 from config import Config
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +31,9 @@ Session = sessionmaker(bind=engine)
 # Initialisation du modèle
 cvd_model = CVDRiskModel()
 
+# Cache mémoire des stats (le dashboard les interroge en boucle)
+_stats_cache = {'value': None, 'expires_at': 0}
+
 @prediction_bp.route('/health', methods=['GET'])
 def health():
     """Health check"""
@@ -142,6 +146,7 @@ def predict_risk(patient_id):
         
         session.commit()
         session.close()
+        _stats_cache['expires_at'] = 0
         
         return jsonify({
             'status': 'success',
@@ -216,34 +221,48 @@ def get_risk_prediction(patient_id):
 
 @prediction_bp.route('/stats', methods=['GET'])
 def get_stats():
-    """Statistiques sur les prédictions"""
+    """Statistiques sur les prédictions (une requête, cache mémoire de STATS_CACHE_TTL s)"""
     try:
+        now = time.monotonic()
+        if _stats_cache['value'] is not None and now < _stats_cache['expires_at']:
+            return jsonify(_stats_cache['value']), 200
+        
         session = Session()
         
         from sqlalchemy import func
         
-        total = session.query(func.count(RiskPrediction.id)).scalar()
-        
-        # Compter par catégorie de risque
-        risk_counts = session.query(
+        # Une seule agrégation groupée : les totaux et moyennes sont recombinés en Python
+        rows = session.query(
             RiskPrediction.risk_category,
-            func.count(RiskPrediction.id)
+            func.count(RiskPrediction.id),
+            func.sum(RiskPrediction.framingham_score),
+            func.count(RiskPrediction.framingham_score),
+            func.sum(RiskPrediction.ascvd_10year_risk),
+            func.count(RiskPrediction.ascvd_10year_risk)
         ).group_by(RiskPrediction.risk_category).all()
         
-        risk_distribution = {category: count for category, count in risk_counts}
+        session.close()
         
-        # Moyennes
-        avg_framingham = session.query(func.avg(RiskPrediction.framingham_score)).scalar()
-        avg_ascvd = session.query(func.avg(RiskPrediction.ascvd_10year_risk)).scalar()
+        risk_distribution = {category: count for category, count, *_ in rows}
+        total = sum(risk_distribution.values())
+        framingham_sum = sum(row[2] or 0 for row in rows)
+        framingham_count = sum(row[3] for row in rows)
+        ascvd_sum = sum(row[4] or 0 for row in rows)
+        ascvd_count = sum(row[5] for row in rows)
         
-        session.close()
+        avg_framingham = framingham_sum / framingham_count if framingham_count else None
+        avg_ascvd = ascvd_sum / ascvd_count if ascvd_count else None
         
-        return jsonify({
+        stats = {
             'total_predictions': total,
             'risk_distribution': risk_distribution,
             'average_framingham_score': round(avg_framingham, 2) if avg_framingham else None,
             'average_ascvd_risk': round(avg_ascvd, 2) if avg_ascvd else None
-        }), 200
+        }
+        _stats_cache['value'] = stats
+        _stats_cache['expires_at'] = now + Config.STATS_CACHE_TTL
+        
+        return jsonify(stats), 200
         
     except Exception as e:
         logger.error(f"Error getting stats: {e}")
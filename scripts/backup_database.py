@@ -2,76 +2,144 @@
 """
 PostgreSQL Database Backup Script (Cross-platform)
 Works on Mac, Linux, and Windows
+
+Default: directory-format dump written by parallel pg_dump jobs (-j), one
+compressed file per table, restorable in parallel by restore_database.py.
+--format plain keeps the single .sql.gz file. --incremental exports only
+the rows added to the append-only FHIR tables since the last run (see
+incremental_backup.py).
 """
 
-import subprocess
+import argparse
+import gzip
+import json
 import os
-from datetime import datetime
+import shlex
+import shutil
+import subprocess
 import sys
+import time
+from datetime import datetime
+from multiprocessing import cpu_count
 
-# Configuration
-DB_NAME = "healthflow_fhir"
-DB_USER = "postgres"
-DB_PASSWORD = "qwerty"
-CONTAINER_NAME = "postgres"  # Docker Compose service name
-BACKUP_DIR = "database_backups"
+from incremental_backup import (
+    BASE_DIR_NAME, CHAIN_DIR, chain_layout, connect, end_snapshot, ensure_write_time_defaults,
+    export_increment, snapshot_marks, write_manifest
+)
+from pg_backup_utils import (
+    BACKUP_DIR, BACKUP_INFO_FILE, CONTAINER_NAME, DB_NAME, DB_USER,
+    dir_size, find_container, format_size, pg_env, psql_value, run_command,
+    run_with_progress, tool_major_version
+)
 
-def run_command(cmd, check=True):
-    """Run shell command and return output"""
-    try:
-        result = subprocess.run(
-            cmd, 
-            shell=True, 
-            check=check, 
-            capture_output=True, 
-            text=True
-        )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Error: {e.stderr}")
-        sys.exit(1)
+# Dump directory inside the container, copied out once complete
+CONTAINER_DUMP_DIR = "/tmp/healthflow_dump"
 
-def main():
-    print("📦 HealthFlow PostgreSQL Database Backup")
-    print("=" * 50)
-    
-    # Create backup directory
-    os.makedirs(BACKUP_DIR, exist_ok=True)
-    
-    # Generate backup filename (no timestamp for simpler sharing)
+
+def table_flags(tables, exclude_tables) -> str:
+    """pg_dump per-table selection flags"""
+    flags = [f"--table={shlex.quote(t)}" for t in tables]
+    flags += [f"--exclude-table={shlex.quote(t)}" for t in exclude_tables]
+    return " ".join(flags)
+
+
+def compression_flag(container_name: str, method: str, level: int) -> str:
+    """
+    pg_dump --compress value for the container's pg_dump.
+
+    zstd needs pg_dump 16+; older versions (the compose image is
+    postgres:15) fall back to gzip.
+    """
+    if method == 'none':
+        return "--compress=0"
+    if method == 'zstd':
+        if tool_major_version(container_name, 'pg_dump') >= 16:
+            return f"--compress=zstd:{level}"
+        print("⚠️  zstd needs pg_dump 16+, using gzip")
+        level = min(level, 9)
+    return f"--compress={level}"
+
+
+def selection_stats(container_name: str, tables) -> tuple:
+    """(table count, on-disk bytes) of the tables to dump, for progress and throughput"""
+    if tables:
+        names = ", ".join(f"'{t}'" for t in tables)
+        where = f"c.oid IN (SELECT to_regclass(t) FROM unnest(ARRAY[{names}]) AS t)"
+    else:
+        where = "n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname NOT LIKE 'pg_toast%'"
+    output = psql_value(container_name, f"""
+        SELECT COUNT(*), COALESCE(SUM(pg_total_relation_size(c.oid)), 0)
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p') AND {where}
+    """)
+    count, size = output.split('|')
+    return int(count), int(size)
+
+
+def backup_directory(container_name: str, args, backup_dir: str = None) -> str:
+    """Parallel directory-format dump, copied out of the container"""
+    backup_dir = backup_dir or os.path.join(BACKUP_DIR, "healthflow_db.dir")
+    compress = compression_flag(container_name, args.compress, args.level)
+    total_tables, total_bytes = selection_stats(container_name, args.table)
+
+    print(f"\n📤 Dumping {total_tables} tables ({format_size(total_bytes)}) "
+          f"with {args.jobs} parallel jobs ({compress})...")
+    run_command(f"docker exec {container_name} rm -rf {CONTAINER_DUMP_DIR}")
+    dump_cmd = (
+        f"docker exec {container_name} "
+        f"pg_dump -U {DB_USER} -d {DB_NAME} "
+        f"--format=directory --jobs={args.jobs} {compress} --verbose "
+        f"{table_flags(args.table, args.exclude_table)} "
+        f"--file={CONTAINER_DUMP_DIR}"
+    )
+    dump_seconds = run_with_progress(dump_cmd, "Dump", total_tables, total_bytes)
+
+    print("\n📦 Copying dump out of the container...")
+    start = time.time()
+    if os.path.exists(backup_dir):
+        shutil.rmtree(backup_dir)
+    os.makedirs(os.path.dirname(backup_dir), exist_ok=True)
+    run_command(f"docker cp {container_name}:{CONTAINER_DUMP_DIR} {backup_dir}")
+    run_command(f"docker exec {container_name} rm -rf {CONTAINER_DUMP_DIR}", check=False)
+    dump_bytes = dir_size(backup_dir)
+    print(f"📈 Copy: {format_size(dump_bytes)} in {time.time() - start:.1f}s")
+
+    # Read by restore_database.py: a per-table dump restores into the existing database
+    info = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'database': DB_NAME,
+        'format': 'directory',
+        'tables': args.table,
+        'exclude_tables': args.exclude_table,
+        'compression': compress,
+        'jobs': args.jobs,
+        'source_bytes': total_bytes,
+        'dump_bytes': dump_bytes,
+        'dump_seconds': round(dump_seconds, 1),
+    }
+    with open(os.path.join(backup_dir, BACKUP_INFO_FILE), 'w') as f:
+        json.dump(info, f, indent=2)
+
+    return backup_dir
+
+
+def backup_plain(container_name: str, args) -> str:
+    """Single-threaded plain SQL dump, gzipped (one file, easiest to share)"""
     backup_file = os.path.join(BACKUP_DIR, "healthflow_db.sql")
-    
-    print(f"\n🔧 Configuration:")
-    print(f"   Database: {DB_NAME}")
-    print(f"   Container: {CONTAINER_NAME}")
-    print(f"   Backup file: {backup_file}")
-    print()
-    
-    # Find Docker container name
-    print("🔍 Finding PostgreSQL container...")
-    container_cmd = f"docker ps --filter name={CONTAINER_NAME} --format '{{{{.Names}}}}'"
-    container_name = run_command(container_cmd).strip()
-    
-    if not container_name:
-        print(f"❌ Error: PostgreSQL container '{CONTAINER_NAME}' not found")
-        print("   Make sure Docker is running: docker-compose up -d")
-        sys.exit(1)
-    
-    print(f"   Found: {container_name}")
-    
+
     # Export database using Docker
     print("\n📤 Exporting database from Docker container...")
+    selection = table_flags(args.table, args.exclude_table)
     dump_cmd = (
         f"docker exec {container_name} "
         f"pg_dump -U {DB_USER} -d {DB_NAME} "
-        f"--clean --if-exists --create --format=plain"
+        f"--clean --if-exists --format=plain {selection}"
     )
-    
-    # Set password environment variable
-    env = os.environ.copy()
-    env['PGPASSWORD'] = DB_PASSWORD
-    
+    if not selection:
+        dump_cmd += " --create"
+
     # Run pg_dump and save to file
+    start = time.time()
     try:
         with open(backup_file, 'w') as f:
             subprocess.run(
@@ -81,36 +149,125 @@ def main():
                 stdout=f,
                 stderr=subprocess.PIPE,
                 text=True,
-                env=env
+                env=pg_env()
             )
     except subprocess.CalledProcessError as e:
         print(f"❌ Backup failed: {e.stderr}")
         sys.exit(1)
-    
+    elapsed = time.time() - start
+    print(f"📈 Dump: {format_size(os.path.getsize(backup_file))} in {elapsed:.1f}s")
+
     # Compress backup
     print("🗜️  Compressing backup...")
-    import gzip
-    import shutil
-    
     backup_file_gz = f"{backup_file}.gz"
     with open(backup_file, 'rb') as f_in:
         with gzip.open(backup_file_gz, 'wb') as f_out:
             shutil.copyfileobj(f_in, f_out)
-    
+
     # Remove uncompressed file
     os.remove(backup_file)
-    
-    # Get file size
-    file_size = os.path.getsize(backup_file_gz) / (1024 * 1024)  # MB
-    
+    return backup_file_gz
+
+
+def backup_incremental(container_name: str, args) -> str:
+    """
+    First run: base snapshot (directory dump) of the chain. Later runs: one
+    increment with the rows added since the previous run.
+    """
+    base, increments = chain_layout(CHAIN_DIR)
+    conn = connect()
+    try:
+        ensure_write_time_defaults(conn)
+        marks, writers = snapshot_marks(conn)
+        if writers and not args.force:
+            end_snapshot(conn)
+            print("❌ Transactions are writing to the database:")
+            for pid, state in writers:
+                print(f"   pid {pid or '-'}: {state}")
+            print("   Their rows could commit below the recorded marks. Retry when idle, or pass --force.")
+            sys.exit(1)
+
+        if base is None:
+            # Marks taken before the dump: rows added meanwhile are in both
+            # the base and the next increment, and replay skips duplicates
+            end_snapshot(conn)
+            print(f"\n🧱 No base snapshot in {CHAIN_DIR}: taking one")
+            base_dir = backup_directory(container_name, args, os.path.join(CHAIN_DIR, BASE_DIR_NAME))
+            write_manifest(base_dir, {
+                'kind': 'base',
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'database': DB_NAME,
+                'marks': marks,
+            })
+            return base_dir
+
+        print(f"\n➕ Exporting rows added since increment {len(increments)} of {CHAIN_DIR}...")
+        increment = export_increment(conn, CHAIN_DIR, args.chunk_mb * 1024 * 1024, args.level, marks)
+        if increment is None:
+            print("   No new rows since the last backup")
+            return increments[-1] if increments else base
+        return increment
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Back up the HealthFlow PostgreSQL database")
+    parser.add_argument("--format", choices=["directory", "plain"], default="directory",
+                        help="directory: parallel per-table dump (default); plain: single .sql.gz")
+    parser.add_argument("--jobs", "-j", type=int, default=min(cpu_count(), 8),
+                        help="Parallel pg_dump jobs (directory format)")
+    parser.add_argument("--table", "-t", action="append", default=[],
+                        help="Only dump this table (repeatable, pg_dump patterns allowed)")
+    parser.add_argument("--exclude-table", "-T", action="append", default=[],
+                        help="Skip this table (repeatable)")
+    parser.add_argument("--compress", choices=["zstd", "gzip", "none"], default="zstd",
+                        help="Per-table compression (zstd needs pg_dump 16+, else gzip)")
+    parser.add_argument("--level", type=int, default=3, help="Compression level")
+    parser.add_argument("--incremental", action="store_true",
+                        help=f"Base snapshot on first run, then only new rows of the FHIR tables ({CHAIN_DIR})")
+    parser.add_argument("--chunk-mb", type=int, default=64, help="Uncompressed COPY MB per increment chunk")
+    parser.add_argument("--force", action="store_true", help="Run --incremental even while loaders are writing")
+    args = parser.parse_args()
+
+    print("📦 HealthFlow PostgreSQL Database Backup")
+    print("=" * 50)
+
+    # Create backup directory
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+
+    print(f"\n🔧 Configuration:")
+    print(f"   Database: {DB_NAME}")
+    print(f"   Container: {CONTAINER_NAME}")
+    print(f"   Format: {'incremental' if args.incremental else args.format}"
+          + (f" ({args.jobs} jobs)" if args.format == "directory" else ""))
+    if args.table:
+        print(f"   Tables: {', '.join(args.table)}")
+    if args.exclude_table:
+        print(f"   Excluded: {', '.join(args.exclude_table)}")
+    print()
+
+    container_name = find_container()
+
+    start = time.time()
+    if args.incremental:
+        backup_path = backup_incremental(container_name, args)
+    elif args.format == "directory":
+        backup_path = backup_directory(container_name, args)
+    else:
+        backup_path = backup_plain(container_name, args)
+
+    backup_size = dir_size(backup_path)
+
     print(f"\n✅ Backup complete!")
-    print(f"   File: {backup_file_gz}")
-    print(f"   Size: {file_size:.2f} MB")
-    
+    print(f"   Path: {backup_path}")
+    print(f"   Size: {format_size(backup_size)}")
+    print(f"   Time: {time.time() - start:.1f}s")
+
     # Show database statistics
     print("\n📊 Database Statistics:")
     stats_cmd = f"""docker exec {container_name} psql -U {DB_USER} -d {DB_NAME} -c "
-SELECT 
+SELECT
     'Patients' as table_name, COUNT(*) as records FROM raw_patients
 UNION ALL
 SELECT 'Encounters', COUNT(*) FROM raw_encounters
@@ -125,12 +282,13 @@ SELECT 'Readmissions', COUNT(*) FROM patient_readmissions
 UNION ALL
 SELECT 'FHIR Bundles', COUNT(*) FROM fhir_bundles;
 " """
-    
-    print(run_command(stats_cmd))
-    
+
+    print(run_command(stats_cmd, check=False))
+
     print("\n🎉 Ready to share!")
     print(f"\n💡 To restore on another machine:")
-    print(f"   python restore_database.py {backup_file_gz}")
+    restore_path = CHAIN_DIR if args.incremental else backup_path
+    print(f"   python restore_database.py {restore_path}" + (f" --jobs {args.jobs}" if args.format == "directory" else ""))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark the JSON codec backends on Synthea bundles
+
+Compares, per available backend (orjson, simdjson, stdlib):
+  - parse:     bytes -> dict (what every loader/exporter pays per bundle)
+  - serialize: dict -> JSON (the old json.dumps round trip before INSERT)
+  - load path: old 'parse + re-serialize' vs new 'parse + raw passthrough'
+
+Usage:
+    python benchmark_json_codec.py synthea_output/fhir --limit 50
+    python benchmark_json_codec.py --synthetic-mb 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+# Shared JSON codec (featurizer/services/json_codec.py)
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'featurizer'))
+from services import json_codec
+
+
+def synthetic_bundle(target_mb: float) -> bytes:
+    """Synthea-shaped bundle (Patient + Observations) of roughly target_mb"""
+    entries = [{'resource': {'resourceType': 'Patient', 'id': str(uuid.uuid4()),
+                             'birthDate': '1960-01-01', 'gender': 'female'}}]
+    observation = {
+        'resourceType': 'Observation', 'status': 'final',
+        'category': [{'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/observation-category',
+                                  'code': 'vital-signs', 'display': 'vital-signs'}]}],
+        'code': {'coding': [{'system': 'http://loinc.org', 'code': '8867-4', 'display': 'Heart rate'}],
+                 'text': 'Heart rate'},
+        'effectiveDateTime': '2020-01-01T10:00:00+00:00',
+        'valueQuantity': {'value': 72.5, 'unit': '/min', 'system': 'http://unitsofmeasure.org', 'code': '/min'},
+    }
+    entry_size = len(json.dumps(observation))
+    for _ in range(int(target_mb * 1024 * 1024 / entry_size)):
+        entries.append({'fullUrl': f'urn:uuid:{uuid.uuid4()}',
+                        'resource': dict(observation, id=str(uuid.uuid4()))})
+    return json.dumps({'resourceType': 'Bundle', 'type': 'transaction', 'entry': entries}).encode('utf-8')
+
+
+def _timed(fn, payloads, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for payload in payloads:
+            fn(payload)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(payloads, repeat=3):
+    total_mb = sum(len(p) for p in payloads) / 1024 / 1024
+    print(f"📦 {len(payloads)} bundle(s), {total_mb:.1f} MB total "
+          f"(avg {total_mb / len(payloads):.2f} MB), best of {repeat}")
+    print(f"{'backend':<10} {'parse MB/s':>11} {'dumps MB/s':>11} {'old load':>10} {'new load':>10}")
+
+    for backend in json_codec.available_backends():
+        parsed = [json_codec.loads(p, backend=backend) for p in payloads]
+        parse_s = _timed(lambda p: json_codec.loads(p, backend=backend), payloads, repeat)
+        dumps_s = _timed(lambda d: json_codec.dumps_bytes(d, backend=backend), parsed, repeat)
+        old_s = _timed(lambda p: json.dumps(json_codec.loads(p, backend=backend)), payloads, repeat)
+        new_s = _timed(lambda p: (p.decode('utf-8'), json_codec.loads(p, backend=backend)), payloads, repeat)
+        print(f"{backend:<10} {total_mb / parse_s:>11.1f} {total_mb / dumps_s:>11.1f} "
+              f"{old_s:>9.3f}s {new_s:>9.3f}s")
+
+    print(f"\n💡 Selected backend: {json_codec.BACKEND} (override with HEALTHFLOW_JSON)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON backends on FHIR bundles")
+    parser.add_argument("fhir_dir", nargs="?", help="Directory of Synthea bundle files")
+    parser.add_argument("--limit", type=int, default=20, help="Max bundles read from fhir_dir")
+    parser.add_argument("--synthetic-mb", type=float, default=None,
+                        help="Benchmark one generated bundle of this size instead")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.synthetic_mb:
+        payloads = [synthetic_bundle(args.synthetic_mb)]
+    elif args.fhir_dir:
+        files = sorted(Path(args.fhir_dir).glob('*.json'), key=lambda p: p.stat().st_size, reverse=True)
+        payloads = [f.read_bytes() for f in files[:args.limit]]
+        if not payloads:
+            print(f"❌ No JSON files found in {args.fhir_dir}")
+            sys.exit(1)
+    else:
+        parser.error("give a bundle directory or --synthetic-mb")
+
+    run(payloads, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
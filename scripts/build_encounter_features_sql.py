@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+SQL-Pushdown Encounter Feature Builder
+Builds the encounter-level feature matrix entirely inside PostgreSQL and
+streams only the final rows back with COPY ... TO STDOUT.
+
+Resources are read from bundle_resources (written by the loaders) when present, else
+bundles are unnested server-side (jsonb_array_elements); encounters,
+observations (including blood-pressure components), conditions and
+medication requests are merged into one event stream per patient, and each
+feature is a window aggregate over the events strictly before the encounter
+start (point-in-time, same semantics as build_point_in_time_dataset.py).
+
+No bundle JSON ever leaves the database: a full build transfers a CSV of
+one row per encounter instead of gigabytes of JSONB.
+
+Usage:
+    python build_encounter_features_sql.py --output ../dataset_encounters.csv
+    python build_encounter_features_sql.py --lookback-days 365 --classes imp,emer,amb
+"""
+
+import argparse
+import sys
+import time
+
+import psycopg2
+
+from build_point_in_time_dataset import CONDITION_FLAGS, MEDICATION_FLAGS, OBSERVATION_FEATURES
+
+# Database configuration
+DB_CONFIG = {
+    'host': 'localhost',
+    'port': 5433,
+    'database': 'healthflow_fhir',
+    'user': 'postgres',
+    'password': 'qwerty'
+}
+
+DEFAULT_CLASSES = ['imp', 'emer']
+OUTPUT_CSV = "../dataset_encounters.csv"
+
+# ---------------------------------------------------------------------------
+# SQL library: each CTE is a parameterized fragment (psycopg2 %(name)s style)
+# ---------------------------------------------------------------------------
+
+RESOURCE_TYPES = "('Patient', 'Encounter', 'Observation', 'Condition', 'MedicationRequest')"
+
+RESOURCES_CTE = """
+resources AS MATERIALIZED (
+    SELECT b.patient_id, e->'resource' AS r, e->'resource'->>'resourceType' AS resource_type
+    FROM fhir_bundles b
+    CROSS JOIN LATERAL jsonb_array_elements(b.bundle_data::jsonb->'entry') e
+    WHERE e->'resource'->>'resourceType' IN """ + RESOURCE_TYPES + """
+)"""
+
+# Same relation read from the per-resource table filled by the loaders:
+# an index scan on resource_type instead of unnesting every bundle. Bundles
+# loaded without it (load_synthea_ultra_fast.sh, older loads) are still
+# unnested, for the patients that have no bundle_resources rows.
+RESOURCES_TABLE_CTE = """
+resources AS MATERIALIZED (
+    SELECT patient_id, resource AS r, resource_type
+    FROM bundle_resources
+    WHERE resource_type IN """ + RESOURCE_TYPES + """
+    UNION ALL
+    SELECT b.patient_id, e->'resource' AS r, e->'resource'->>'resourceType' AS resource_type
+    FROM fhir_bundles b
+    CROSS JOIN LATERAL jsonb_array_elements(b.bundle_data::jsonb->'entry') e
+    WHERE NOT EXISTS (SELECT 1 FROM bundle_resources br WHERE br.patient_id = b.patient_id)
+      AND e->'resource'->>'resourceType' IN """ + RESOURCE_TYPES + """
+)"""
+
+PATIENTS_CTE = """
+patients AS (
+    SELECT DISTINCT ON (patient_id)
+        patient_id,
+        (r->>'birthDate')::date AS birthdate,
+        r->>'gender' AS gender,
+        LOWER(COALESCE(jsonb_path_query_first(
+            r, '$.extension[*] ? (@.url like_regex "race").extension[*] ? (@.url == "text").valueString'
+        ) #>> '{}', '')) AS race,
+        LOWER(COALESCE(jsonb_path_query_first(
+            r, '$.extension[*] ? (@.url like_regex "ethnicity").extension[*] ? (@.url == "text").valueString'
+        ) #>> '{}', '')) AS ethnicity
+    FROM resources
+    WHERE resource_type = 'Patient'
+)"""
+
+# Readmission label: next admission of the same classes within 30 days of discharge
+ENCOUNTERS_CTE = """
+encounters AS (
+    SELECT
+        patient_id,
+        encounter_id,
+        start_ts,
+        CASE
+            WHEN LEAD(start_ts) OVER (PARTITION BY patient_id ORDER BY start_ts) - stop_ts
+                 <= INTERVAL '30 days' THEN 1
+            ELSE 0
+        END AS label_readmission
+    FROM (
+        SELECT
+            patient_id,
+            r->>'id' AS encounter_id,
+            (r->'period'->>'start')::timestamptz AS start_ts,
+            (r->'period'->>'end')::timestamptz AS stop_ts
+        FROM resources
+        WHERE resource_type = 'Encounter'
+          AND r->'class'->>'code' = ANY(%(classes)s)
+          AND r->'period'->>'start' IS NOT NULL
+          AND r->'period'->>'end' IS NOT NULL
+    ) e
+)"""
+
+# One row per event: kind 0 = encounter (feature rows), 1 = observation value,
+# 2 = condition, 3 = medication request
+EVENTS_CTE = """
+events AS (
+    SELECT patient_id, start_ts AS ts, 0 AS kind, encounter_id, label_readmission,
+           NULL::text AS code, NULL::float AS value, NULL::text AS description
+    FROM encounters
+    UNION ALL
+    SELECT o.patient_id, (o.r->>'effectiveDateTime')::timestamptz, 1, NULL, NULL,
+           c->'code'->'coding'->0->>'code', (c->'valueQuantity'->>'value')::float, NULL
+    FROM resources o
+    CROSS JOIN LATERAL jsonb_array_elements(
+        jsonb_build_array(o.r) || COALESCE(o.r->'component', '[]'::jsonb)
+    ) c
+    WHERE o.resource_type = 'Observation'
+      AND o.r->>'effectiveDateTime' IS NOT NULL
+      AND c->'valueQuantity'->>'value' IS NOT NULL
+      AND c->'code'->'coding'->0->>'code' = ANY(%(codes)s)
+    UNION ALL
+    SELECT patient_id, COALESCE(r->>'onsetDateTime', r->>'recordedDate')::timestamptz, 2, NULL, NULL,
+           NULL, NULL, LOWER(COALESCE(r->'code'->>'text', r->'code'->'coding'->0->>'display'))
+    FROM resources
+    WHERE resource_type = 'Condition'
+      AND COALESCE(r->>'onsetDateTime', r->>'recordedDate') IS NOT NULL
+    UNION ALL
+    SELECT patient_id, (r->>'authoredOn')::timestamptz, 3, NULL, NULL,
+           NULL, NULL, LOWER(COALESCE(r->'medicationCodeableConcept'->>'text',
+                                      r->'medicationCodeableConcept'->'coding'->0->>'display'))
+    FROM resources
+    WHERE resource_type = 'MedicationRequest'
+      AND r->>'authoredOn' IS NOT NULL
+)"""
+
+# EXCLUDE GROUP drops the encounter row and every event at the same instant:
+# only events strictly before the admission contribute
+WINDOWS = """
+WINDOW
+    w_obs AS (PARTITION BY patient_id ORDER BY ts
+              RANGE BETWEEN {obs_start} PRECEDING AND CURRENT ROW EXCLUDE GROUP),
+    w_hist AS (PARTITION BY patient_id ORDER BY ts
+               RANGE BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW EXCLUDE GROUP)"""
+
+
+def _observation_columns(params):
+    columns = []
+    for feature, codes in OBSERVATION_FEATURES.items():
+        params[f'codes_{feature}'] = codes
+        columns.append(
+            f"AVG(value) FILTER (WHERE kind = 1 AND code = ANY(%(codes_{feature})s)) OVER w_obs AS {feature}"
+        )
+    return columns
+
+
+def _flag_columns(flags, kind, count_col, params):
+    columns = []
+    for flag, pattern in flags.items():
+        params[f'pattern_{flag}'] = pattern
+        columns.append(
+            f"COALESCE(MAX(CASE WHEN description ~ %(pattern_{flag})s THEN 1 ELSE 0 END) "
+            f"FILTER (WHERE kind = {kind}) OVER w_hist, 0) AS {flag}"
+        )
+    columns.append(f"COUNT(*) FILTER (WHERE kind = {kind}) OVER w_hist AS {count_col}")
+    return columns
+
+
+def build_feature_query(classes=None, lookback_days=None, from_resources=False):
+    """
+    Assemble the encounter feature query.
+
+    Args:
+        classes: encounter class codes to keep (default: inpatient + emergency)
+        lookback_days: observation window before each admission (None = all history)
+        from_resources: read bundle_resources, unnesting fhir_bundles only for
+            patients it does not cover
+
+    Returns:
+        (sql, params) ready for cursor.mogrify / cursor.execute
+    """
+    params = {
+        'classes': list(classes or DEFAULT_CLASSES),
+        'codes': [code for codes in OBSERVATION_FEATURES.values() for code in codes],
+    }
+    if lookback_days is None:
+        obs_start = "UNBOUNDED"
+    else:
+        params['lookback'] = f"{int(lookback_days)} days"
+        obs_start = "%(lookback)s::interval"
+
+    window_columns = (
+        _observation_columns(params)
+        + _flag_columns(CONDITION_FLAGS, 2, 'num_conditions', params)
+        + _flag_columns(MEDICATION_FLAGS, 3, 'num_medications', params)
+    )
+    windowed_cte = (
+        "\nwindowed AS (\n    SELECT kind, patient_id, encounter_id, ts, label_readmission,\n        "
+        + ",\n        ".join(window_columns)
+        + "\n    FROM events"
+        + WINDOWS.format(obs_start=obs_start)
+        + "\n)"
+    )
+
+    vitals = [f for f in OBSERVATION_FEATURES if f.startswith('vit_')]
+    labs = [f for f in OBSERVATION_FEATURES if f.startswith('lab_')]
+    select_columns = (
+        [
+            "w.encounter_id", "w.patient_id", "w.ts AS start_date",
+            "COALESCE(EXTRACT(YEAR FROM age(w.ts::date, p.birthdate))::int, 0) AS age",
+            "CASE WHEN p.gender = 'male' THEN 1 ELSE 0 END AS gender_male",
+            "CASE WHEN p.gender = 'female' THEN 1 ELSE 0 END AS gender_female",
+            "CASE WHEN p.race LIKE '%%white%%' THEN 1 ELSE 0 END AS race_white",
+            "CASE WHEN p.race ~ 'black|african' THEN 1 ELSE 0 END AS race_black",
+            "CASE WHEN p.race LIKE '%%asian%%' THEN 1 ELSE 0 END AS race_asian",
+            "CASE WHEN p.ethnicity ~ 'hispanic|latino' THEN 1 ELSE 0 END AS ethnicity_hispanic",
+            "w.label_readmission",
+        ]
+        + [f"COALESCE(w.{f}, 0) AS {f}" for f in vitals]
+        + [f"w.{f}" for f in list(CONDITION_FLAGS) + ['num_conditions']]
+        + [f"w.{f}" for f in list(MEDICATION_FLAGS) + ['num_medications']]
+        + ["CASE WHEN w.num_medications >= 5 THEN 1 ELSE 0 END AS polypharmacy"]
+        + [f"COALESCE(w.{f}, 0) AS {f}" for f in labs]
+    )
+
+    sql = (
+        "WITH"
+        + ",".join([RESOURCES_TABLE_CTE if from_resources else RESOURCES_CTE, PATIENTS_CTE, ENCOUNTERS_CTE, EVENTS_CTE, windowed_cte])
+        + "\nSELECT\n    " + ",\n    ".join(select_columns)
+        + "\nFROM windowed w\nLEFT JOIN patients p ON p.patient_id = w.patient_id"
+        + "\nWHERE w.kind = 0\nORDER BY w.patient_id, w.ts"
+    )
+    return sql, params
+
+
+def copy_feature_matrix(conn, out, classes=None, lookback_days=None, work_mem='1GB'):
+    """
+    Run the feature query server-side and stream the CSV result into `out`.
+
+    Returns:
+        Number of bytes written
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('bundle_resources') IS NOT NULL")
+        sql, params = build_feature_query(classes, lookback_days, from_resources=cur.fetchone()[0])
+        cur.execute("SET LOCAL work_mem = %s", (work_mem,))
+        # COPY does not take bind parameters: render them client-side first
+        query = cur.mogrify(sql, params).decode()
+        start = out.tell() if out.seekable() else 0
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", out)
+        written = (out.tell() - start) if out.seekable() else 0
+    conn.commit()
+    return written
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Build encounter-level features inside PostgreSQL")
+    parser.add_argument("--output", default=OUTPUT_CSV, help="Output CSV path ('-' for stdout)")
+    parser.add_argument("--classes", default=",".join(DEFAULT_CLASSES),
+                        help="Comma-separated encounter class codes")
+    parser.add_argument("--lookback-days", type=int, default=None,
+                        help="Only use observations from the N days before admission")
+    parser.add_argument("--work-mem", default="1GB")
+    parser.add_argument("--print-sql", action="store_true", help="Print the generated SQL and exit")
+    args = parser.parse_args()
+
+    classes = [c.strip() for c in args.classes.split(",") if c.strip()]
+
+    if args.print_sql:
+        sql, params = build_feature_query(classes, args.lookback_days)
+        print(sql)
+        print(f"-- params: {params}")
+        return
+
+    print("🚀 SQL-Pushdown Encounter Feature Builder", file=sys.stderr)
+    print("=" * 50, file=sys.stderr)
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    start = time.time()
+    try:
+        if args.output == "-":
+            written = copy_feature_matrix(conn, sys.stdout, classes, args.lookback_days, args.work_mem)
+        else:
+            with open(args.output, "w", newline="") as out:
+                written = copy_feature_matrix(conn, out, classes, args.lookback_days, args.work_mem)
+    finally:
+        conn.close()
+
+    elapsed = time.time() - start
+    print(f"\n✅ Feature matrix built in {elapsed:.1f}s", file=sys.stderr)
+    if written:
+        print(f"   {written / 1024 / 1024:.1f} MB written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
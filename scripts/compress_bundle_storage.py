@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Compact the storage of FHIR bundles and resources in PostgreSQL
+
+Three independent steps, each rewriting rows in committed chunks (id ranges,
+key order for document_payloads), resumable: rows already migrated are
+skipped on the next run:
+
+  --lz4          ALTER COLUMN ... SET COMPRESSION lz4 (PostgreSQL 14+ built
+                 with lz4) and rewrite existing pglz-compressed values.
+                 SET COMPRESSION alone only affects new values, and
+                 VACUUM FULL does not recompress.
+  --externalize  Move DocumentReference base64 payloads out of the bundles
+                 into document_payloads (decoded bytes, one row per content
+                 hash); attachments keep a urn:healthflow:document-payload:<sha256>
+                 url and their size. restore_document_payloads(bundle) puts
+                 them back for consumers that need the original bundle.
+  --minify       Re-serialize pretty-printed TEXT JSON (fhir_resources_anonymized)
+
+Table sizes (heap, TOAST, indexes) are reported before and after.
+
+Usage:
+    python compress_bundle_storage.py --report
+    python compress_bundle_storage.py --lz4 --externalize --minify --vacuum-full
+"""
+
+import argparse
+import sys
+import time
+
+import psycopg2
+
+# Database configuration
+DB_CONFIG = {
+    'host': 'localhost',
+    'port': 5433,
+    'database': 'healthflow_fhir',
+    'user': 'postgres',
+    'password': 'qwerty'
+}
+
+CHUNK_ROWS = 500
+PAYLOAD_URN = 'urn:healthflow:document-payload:'
+
+# (table, column, chunking key) holding large documents; tables keyed on
+# id are rewritten in id ranges, the others by keyset on their key
+LZ4_TARGETS = [
+    ('fhir_bundles', 'bundle_data', 'id'),
+    ('bundle_resources', 'resource', 'id'),
+    ('fhir_resources_anonymized', 'resource_data', 'id'),
+    ('document_payloads', 'data', 'sha256'),
+]
+
+# table -> (column, SQL expression externalizing it, WHERE clause selecting rows that still carry payloads)
+EXTERNALIZE_TARGETS = {
+    'fhir_bundles': (
+        'bundle_data',
+        "externalize_document_payloads(bundle_data)",
+        "bundle_data @? '$.entry[*].resource ? (@.resourceType == \"DocumentReference\")"
+        ".content[*].attachment.data'",
+    ),
+    'bundle_resources': (
+        'resource',
+        "externalize_resource_payloads(resource)",
+        "resource_type = 'DocumentReference' AND resource @? '$.content[*].attachment.data'",
+    ),
+}
+
+DOCUMENT_PAYLOADS_DDL = """
+    CREATE TABLE IF NOT EXISTS document_payloads (
+        sha256 CHAR(64) PRIMARY KEY,
+        content_type VARCHAR(100),
+        size INTEGER NOT NULL,
+        data BYTEA NOT NULL
+    );
+
+    -- Attachment with its base64 data replaced by a payload reference
+    CREATE OR REPLACE FUNCTION externalize_attachment(attachment jsonb) RETURNS jsonb
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE WHEN attachment ? 'data' THEN
+            (attachment - 'data') || jsonb_build_object(
+                'url', '""" + PAYLOAD_URN + """' || encode(sha256(decode(attachment->>'data', 'base64')), 'hex'),
+                'size', length(decode(attachment->>'data', 'base64')))
+        ELSE attachment END
+    $$;
+
+    CREATE OR REPLACE FUNCTION externalize_resource_payloads(resource jsonb) RETURNS jsonb
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE
+            WHEN resource->>'resourceType' = 'DocumentReference' AND jsonb_typeof(resource->'content') = 'array'
+            THEN jsonb_set(resource, '{content}', (
+                SELECT COALESCE(jsonb_agg(
+                    CASE WHEN c ? 'attachment'
+                         THEN jsonb_set(c, '{attachment}', externalize_attachment(c->'attachment'))
+                         ELSE c END
+                    ORDER BY i), '[]'::jsonb)
+                FROM jsonb_array_elements(resource->'content') WITH ORDINALITY AS x(c, i)))
+            ELSE resource END
+    $$;
+
+    CREATE OR REPLACE FUNCTION externalize_document_payloads(bundle jsonb) RETURNS jsonb
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE
+            WHEN jsonb_typeof(bundle->'entry') = 'array'
+            THEN jsonb_set(bundle, '{entry}', (
+                SELECT COALESCE(jsonb_agg(
+                    CASE WHEN e ? 'resource'
+                         THEN jsonb_set(e, '{resource}', externalize_resource_payloads(e->'resource'))
+                         ELSE e END
+                    ORDER BY i), '[]'::jsonb)
+                FROM jsonb_array_elements(bundle->'entry') WITH ORDINALITY AS x(e, i)))
+            ELSE bundle END
+    $$;
+
+    -- Inverse: inline the payload back as base64 data
+    CREATE OR REPLACE FUNCTION restore_attachment(attachment jsonb) RETURNS jsonb
+    LANGUAGE sql STABLE AS $$
+        SELECT CASE WHEN attachment->>'url' LIKE '""" + PAYLOAD_URN + """%' THEN
+            (attachment - 'url' - 'size') || jsonb_build_object(
+                'data', (SELECT translate(encode(p.data, 'base64'), E'\\n', '')
+                         FROM document_payloads p
+                         WHERE p.sha256 = substr(attachment->>'url', """ + str(len(PAYLOAD_URN) + 1) + """)))
+        ELSE attachment END
+    $$;
+
+    CREATE OR REPLACE FUNCTION restore_resource_payloads(resource jsonb) RETURNS jsonb
+    LANGUAGE sql STABLE AS $$
+        SELECT CASE
+            WHEN resource->>'resourceType' = 'DocumentReference' AND jsonb_typeof(resource->'content') = 'array'
+            THEN jsonb_set(resource, '{content}', (
+                SELECT COALESCE(jsonb_agg(
+                    CASE WHEN c ? 'attachment'
+                         THEN jsonb_set(c, '{attachment}', restore_attachment(c->'attachment'))
+                         ELSE c END
+                    ORDER BY i), '[]'::jsonb)
+                FROM jsonb_array_elements(resource->'content') WITH ORDINALITY AS x(c, i)))
+            ELSE resource END
+    $$;
+
+    CREATE OR REPLACE FUNCTION restore_document_payloads(bundle jsonb) RETURNS jsonb
+    LANGUAGE sql STABLE AS $$
+        SELECT CASE
+            WHEN jsonb_typeof(bundle->'entry') = 'array'
+            THEN jsonb_set(bundle, '{entry}', (
+                SELECT COALESCE(jsonb_agg(
+                    CASE WHEN e ? 'resource'
+                         THEN jsonb_set(e, '{resource}', restore_resource_payloads(e->'resource'))
+                         ELSE e END
+                    ORDER BY i), '[]'::jsonb)
+                FROM jsonb_array_elements(bundle->'entry') WITH ORDINALITY AS x(e, i)))
+            ELSE bundle END
+    $$;
+"""
+
+# Payloads of the rows about to be rewritten; {path} selects their attachments
+PAYLOADS_INSERT_SQL = """
+    INSERT INTO document_payloads (sha256, content_type, size, data)
+    SELECT encode(sha256(p.bytes), 'hex'), p.content_type, length(p.bytes), p.bytes
+    FROM (
+        SELECT decode(a->>'data', 'base64') AS bytes, a->>'contentType' AS content_type
+        FROM {table} t
+        CROSS JOIN LATERAL jsonb_path_query(t.{column}, '{path}') a
+        WHERE t.id >= %s AND t.id < %s AND {where}
+    ) p
+    ON CONFLICT (sha256) DO NOTHING
+"""
+
+ATTACHMENT_PATHS = {
+    'fhir_bundles': '$.entry[*].resource ? (@.resourceType == "DocumentReference").content[*].attachment ? (exists(@.data))',
+    'bundle_resources': '$.content[*].attachment ? (exists(@.data))',
+}
+
+
+def connect_db():
+    """Connect to PostgreSQL database"""
+    try:
+        return psycopg2.connect(**DB_CONFIG)
+    except Exception as e:
+        print(f"❌ Database connection failed: {e}")
+        sys.exit(1)
+
+
+def existing_tables(cursor, tables):
+    """Subset of tables present in the database"""
+    cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'r' AND relname = ANY(%s)", (list(tables),))
+    present = {row[0] for row in cursor.fetchall()}
+    return [t for t in tables if t in present]
+
+
+def table_sizes(cursor, tables):
+    """table -> (heap bytes, TOAST bytes, index bytes)"""
+    sizes = {}
+    for table in existing_tables(cursor, tables):
+        cursor.execute("""
+            SELECT pg_relation_size(c.oid),
+                   COALESCE(pg_total_relation_size(NULLIF(c.reltoastrelid, 0)), 0),
+                   pg_indexes_size(c.oid)
+            FROM pg_class c WHERE c.oid = %s::regclass
+        """, (table,))
+        sizes[table] = cursor.fetchone()
+    return sizes
+
+
+def _mb(n):
+    return f"{n / 1024 / 1024:,.1f} MB"
+
+
+def print_sizes(title, sizes, baseline=None):
+    print(f"\n📊 {title}")
+    print(f"   {'table':<28} {'heap':>12} {'toast':>12} {'indexes':>12} {'total':>12}")
+    for table, (heap, toast, indexes) in sizes.items():
+        total = heap + toast + indexes
+        line = f"   {table:<28} {_mb(heap):>12} {_mb(toast):>12} {_mb(indexes):>12} {_mb(total):>12}"
+        if baseline and table in baseline:
+            before = sum(baseline[table])
+            if before:
+                line += f"  ({(before - total) * 100 / before:+.1f}% saved)"
+        print(line)
+    if baseline:
+        before = sum(sum(v) for v in baseline.values())
+        after = sum(sum(v) for v in sizes.values())
+        print(f"   {'TOTAL':<28} {_mb(before):>12} -> {_mb(after)}  ({_mb(before - after)} saved)")
+
+
+def id_chunks(cursor, table, chunk_rows):
+    """Half-open [low, high) id ranges covering the table"""
+    cursor.execute(f"SELECT MIN(id), MAX(id) FROM {table}")
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        return []
+    return [(low, min(low + chunk_rows, max_id + 1)) for low in range(min_id, max_id + 1, chunk_rows)]
+
+
+def rewrite_in_chunks(conn, table, set_clause, where, chunk_rows, before_update=None):
+    """
+    UPDATE table SET <set_clause> WHERE <where>, one committed id range at a time.
+
+    before_update(cursor, low, high) runs in the same transaction first.
+    Returns the number of rows rewritten.
+    """
+    cursor = conn.cursor()
+    chunks = id_chunks(cursor, table, chunk_rows)
+    rewritten = 0
+    start = time.time()
+    for done, (low, high) in enumerate(chunks, 1):
+        if before_update:
+            before_update(cursor, low, high)
+        cursor.execute(f"UPDATE {table} SET {set_clause} WHERE id >= %s AND id < %s AND {where}", (low, high))
+        rewritten += cursor.rowcount
+        conn.commit()
+        if done % 20 == 0 or done == len(chunks):
+            print(f"   {table}: {done}/{len(chunks)} chunks, {rewritten} rows rewritten, {time.time() - start:.1f}s")
+    return rewritten
+
+
+def rewrite_by_key(conn, table, key, set_clause, where, chunk_rows):
+    """
+    rewrite_in_chunks for tables without an id column: batches of chunk_rows
+    rows in key order (keyset pagination), one commit per batch.
+    """
+    cursor = conn.cursor()
+    rewritten = 0
+    last = None
+    start = time.time()
+    while True:
+        after = f"AND {key} > %s" if last is not None else ""
+        cursor.execute(f"""
+            UPDATE {table} SET {set_clause}
+            WHERE {key} IN (
+                SELECT {key} FROM {table} WHERE {where} {after}
+                ORDER BY {key} LIMIT %s
+            )
+            RETURNING {key}
+        """, ((last,) if last is not None else ()) + (chunk_rows,))
+        keys = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        if not keys:
+            break
+        rewritten += len(keys)
+        last = max(keys)
+        print(f"   {table}: {rewritten} rows rewritten, {time.time() - start:.1f}s")
+    return rewritten
+
+
+def apply_lz4(conn, chunk_rows):
+    """Switch the large columns to lz4 and recompress existing pglz values"""
+    cursor = conn.cursor()
+    cursor.execute("SHOW server_version_num")
+    if int(cursor.fetchone()[0]) < 140000:
+        conn.commit()
+        print("⚠️  Column compression needs PostgreSQL 14+, skipping --lz4")
+        return
+
+    for table, column, key in LZ4_TARGETS:
+        if not existing_tables(cursor, [table]):
+            conn.commit()
+            continue
+        try:
+            cursor.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET COMPRESSION lz4")
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"⚠️  lz4 unavailable on this server ({e.pgerror or e}), skipping --lz4")
+            return
+
+        # A fresh value (not the stored TOAST pointer) is needed to force recompression
+        cursor.execute(f"SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+                       f"WHERE attrelid = %s::regclass AND attname = %s", (table, column))
+        column_type = cursor.fetchone()[0]
+        conn.commit()
+        fresh = {'jsonb': f"{column} || '{{}}'::jsonb", 'bytea': f"{column} || ''::bytea"}.get(
+            column_type, f"{column} || ''")
+
+        print(f"🗜️  {table}.{column}: recompressing pglz values with lz4...")
+        where = f"pg_column_compression({column}) = 'pglz'"
+        if key == 'id':
+            rewrite_in_chunks(conn, table, f"{column} = {fresh}", where, chunk_rows)
+        else:
+            rewrite_by_key(conn, table, key, f"{column} = {fresh}", where, chunk_rows)
+
+
+def externalize_payloads(conn, chunk_rows):
+    """Move DocumentReference base64 payloads into document_payloads"""
+    cursor = conn.cursor()
+    cursor.execute(DOCUMENT_PAYLOADS_DDL)
+    conn.commit()
+
+    for table in existing_tables(cursor, EXTERNALIZE_TARGETS):
+        column, expression, where = EXTERNALIZE_TARGETS[table]
+        insert_sql = PAYLOADS_INSERT_SQL.format(table=table, column=column, path=ATTACHMENT_PATHS[table],
+                                                where=where)
+
+        def store_payloads(cur, low, high):
+            cur.execute(insert_sql, (low, high))
+
+        print(f"📎 {table}.{column}: moving DocumentReference payloads out of line...")
+        rewrite_in_chunks(conn, table, f"{column} = {expression}", where, chunk_rows, store_payloads)
+
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM document_payloads")
+    count, total = cursor.fetchone()
+    conn.commit()
+    print(f"✅ document_payloads: {count} distinct payloads, {_mb(total)} decoded")
+
+
+def minify_text_json(conn, chunk_rows):
+    """Re-serialize pretty-printed JSON stored as TEXT"""
+    cursor = conn.cursor()
+    present = existing_tables(cursor, ['fhir_resources_anonymized'])
+    conn.commit()
+    if not present:
+        return
+    print("✂️  fhir_resources_anonymized.resource_data: removing indentation...")
+    rewrite_in_chunks(conn, 'fhir_resources_anonymized', "resource_data = (resource_data::jsonb)::text",
+                      "resource_data LIKE E'%%\\n%%'", chunk_rows)
+
+
+def vacuum(conn, tables, full):
+    """Reclaim the space of rewritten rows (FULL returns it to the OS, under an exclusive lock)"""
+    # autocommit can only change outside a transaction (VACUUM cannot run in one)
+    conn.commit()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    for table in existing_tables(cursor, tables):
+        print(f"🧹 VACUUM {'FULL ' if full else ''}{table}...")
+        cursor.execute(f"VACUUM {'FULL ' if full else ''}ANALYZE {table}")
+    conn.autocommit = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact FHIR bundle storage (lz4, out-of-line payloads)")
+    parser.add_argument("--lz4", action="store_true", help="Use lz4 TOAST compression and recompress")
+    parser.add_argument("--externalize", action="store_true",
+                        help="Move DocumentReference payloads to document_payloads")
+    parser.add_argument("--minify", action="store_true", help="Minify pretty-printed TEXT JSON")
+    parser.add_argument("--vacuum-full", action="store_true",
+                        help="VACUUM FULL afterwards so the report shows reclaimed space (locks tables)")
+    parser.add_argument("--report", action="store_true", help="Only print table sizes")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="Rows per committed chunk")
+    args = parser.parse_args()
+
+    print("🏥 HealthFlow-MS: Bundle Storage Compaction")
+    print("=" * 50)
+
+    conn = connect_db()
+    tables = [table for table, _, _ in LZ4_TARGETS]
+    before = table_sizes(conn.cursor(), tables)
+    print_sizes("Current sizes", before)
+    conn.commit()
+
+    if args.report or not (args.lz4 or args.externalize or args.minify):
+        conn.close()
+        return
+
+    start = time.time()
+    try:
+        # Externalize first: lz4 then only recompresses the slimmer documents
+        if args.externalize:
+            externalize_payloads(conn, args.chunk_rows)
+        if args.minify:
+            minify_text_json(conn, args.chunk_rows)
+        if args.lz4:
+            apply_lz4(conn, args.chunk_rows)
+        vacuum(conn, tables, args.vacuum_full)
+
+        after = table_sizes(conn.cursor(), tables)
+        conn.commit()
+        print_sizes("Sizes after compaction", after, before)
+        if not args.vacuum_full:
+            print("💡 Space of rewritten rows is reusable but not returned to the OS; "
+                  "run with --vacuum-full to shrink the files")
+    finally:
+        conn.close()
+
+    print(f"\n🎉 Storage compaction complete in {time.time() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -23,14 +23,29 @@ def detect_readmissions():
     
     engine = create_engine(DB_URI)
     
-    # SQL query to detect readmissions from FHIR bundles
-    query = """
-    WITH encounters_raw AS (
+    # Per-resource rows (filled by the loaders) avoid unnesting every bundle;
+    # bundles loaded without them are unnested for the patients not covered
+    has_resources = pd.read_sql(
+        "SELECT to_regclass('bundle_resources') IS NOT NULL AS present", engine
+    )['present'][0]
+    encounters_raw = """
+        SELECT patient_id, jsonb_build_object('resource', resource) as entry
+        FROM bundle_resources
+        WHERE resource_type = 'Encounter'
+        UNION ALL
+        SELECT b.patient_id, jsonb_array_elements(b.bundle_data::jsonb->'entry') as entry
+        FROM fhir_bundles b
+        WHERE NOT EXISTS (SELECT 1 FROM bundle_resources r WHERE r.patient_id = b.patient_id)
+    """ if has_resources else """
         SELECT 
             patient_id,
             jsonb_array_elements(bundle_data::jsonb->'entry') as entry
         FROM fhir_bundles
-    ),
+    """
+    
+    # SQL query to detect readmissions from FHIR bundles
+    query = f"""
+    WITH encounters_raw AS ({encounters_raw}),
     encounters_parsed AS (
         SELECT 
             patient_id,
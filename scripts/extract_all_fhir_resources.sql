@@ -26,7 +26,7 @@ WITH obs_resources AS (
 SELECT 
     patient_id,
     entry->'resource'->>'id' as observation_id,
-    (entry->'resource'->'effectiveDateTime')::text as observation_date,
+    entry->'resource'->>'effectiveDateTime' as observation_date,
     entry->'resource'->'code'->>'text' as code_text,
     entry->'resource'->'code'->'coding'->0->>'code' as code,
     (entry->'resource'->'valueQuantity'->>'value')::float as value,
@@ -52,7 +52,7 @@ SELECT
     entry->'resource'->>'id' as condition_id,
     entry->'resource'->'code'->>'text' as description,
     entry->'resource'->'code'->'coding'->0->>'code' as code,
-    (entry->'resource'->'onsetDateTime')::text as onset_date
+    entry->'resource'->>'onsetDateTime' as onset_date
 FROM cond_resources
 WHERE entry->'resource'->>'resourceType' = 'Condition';
 
@@ -71,7 +71,8 @@ SELECT
     patient_id,
     entry->'resource'->>'id' as medication_id,
     entry->'resource'->'medicationCodeableConcept'->>'text' as description,
-    entry->'resource'->'medicationCodeableConcept'->'coding'->0->>'code' as code
+    entry->'resource'->'medicationCodeableConcept'->'coding'->0->>'code' as code,
+    entry->'resource'->>'authoredOn' as authored_on
 FROM med_resources
 WHERE entry->'resource'->>'resourceType' = 'MedicationRequest';
 
@@ -16,7 +16,8 @@ from tqdm import tqdm
 # Add featurizer to path to use BioBERT service
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'featurizer'))
 
-from services.biobert_service import BioBERTService
+from services.model_registry import get_biobert_service
+from services.nlp_features import combine_notes, derive_nlp_features, empty_nlp_features
 
 logging.basicConfig(
     level=logging.INFO,
@@ -32,7 +33,7 @@ class ClinicalNLPExtractor:
     
     def __init__(self):
         logger.info("Initializing BioBERT service...")
-        self.biobert = BioBERTService()
+        self.biobert = get_biobert_service()
         logger.info("BioBERT service loaded successfully")
     
     def extract_features_from_notes(self, notes: List[str]) -> Dict:
@@ -43,91 +44,54 @@ class ClinicalNLPExtractor:
             notes: List of clinical note texts
             
         Returns:
-            Dictionary of NLP-derived features
+            Dictionary of NLP-derived features (same vector as the Featurizer service)
         """
-        if not notes:
-            return self._empty_features()
-        
-        # Combine all notes for the patient
-        combined_text = " ".join([note for note in notes if note])
+        notes = combine_notes(notes)
         
-        if not combined_text.strip():
-            return self._empty_features()
+        if not notes:
+            return empty_nlp_features()
         
         # Extract medical entities using BioBERT
-        entities = self.biobert.extract_medical_entities(combined_text)
-        
-        # Extract features from entities
-        features = {
-            # Comorbidity features
-            'nlp_num_conditions': len(entities.get('conditions', [])),
-            'nlp_has_chf': int(self._has_condition(entities, ['chf', 'heart failure', 'congestive'])),
-            'nlp_has_copd': int(self._has_condition(entities, ['copd', 'chronic obstructive'])),
-            'nlp_has_ckd': int(self._has_condition(entities, ['ckd', 'chronic kidney', 'renal'])),
-            'nlp_has_diabetes': int(self._has_condition(entities, ['diabetes', 'dm2', 'diabetic'])),
-            'nlp_has_hypertension': int(self._has_condition(entities, ['hypertension', 'htn', 'high blood pressure'])),
-            
-            # Medication features
-            'nlp_num_medications': len(entities.get('medications', [])),
-            'nlp_polypharmacy': int(len(entities.get('medications', [])) >= 5),
-            
-            # Complexity indicators
-            'nlp_note_length': len(combined_text),
-            'nlp_note_count': len(notes),
-            'nlp_avg_note_length': len(combined_text) / len(notes) if notes else 0,
-            
-            # Symptom indicators
-            'nlp_num_symptoms': len(entities.get('symptoms', [])),
-            'nlp_has_pain': int(self._has_symptom(entities, ['pain', 'ache', 'discomfort'])),
-            'nlp_has_dyspnea': int(self._has_symptom(entities, ['dyspnea', 'shortness of breath', 'sob'])),
-        }
-        
-        return features
-    
-    def _has_condition(self, entities: Dict, keywords: List[str]) -> bool:
-        """Check if any keyword appears in conditions"""
-        conditions_text = ' '.join(entities.get('conditions', [])).lower()
-        return any(keyword in conditions_text for keyword in keywords)
-    
-    def _has_symptom(self, entities: Dict, keywords: List[str]) -> bool:
-        """Check if any keyword appears in symptoms"""
-        symptoms_text = ' '.join(entities.get('symptoms', [])).lower()
-        return any(keyword in symptoms_text for keyword in keywords)
-    
-    def _empty_features(self) -> Dict:
-        """Return empty feature dict when no notes available"""
-        return {
-            'nlp_num_conditions': 0,
-            'nlp_has_chf': 0,
-            'nlp_has_copd': 0,
-            'nlp_has_ckd': 0,
-            'nlp_has_diabetes': 0,
-            'nlp_has_hypertension': 0,
-            'nlp_num_medications': 0,
-            'nlp_polypharmacy': 0,
-            'nlp_note_length': 0,
-            'nlp_note_count': 0,
-            'nlp_avg_note_length': 0,
-            'nlp_num_symptoms': 0,
-            'nlp_has_pain': 0,
-            'nlp_has_dyspnea': 0,
-        }
+        entities = self.biobert.extract_medical_entities(" ".join(notes))
+        
+        # Shared, negation-aware derivation (featurizer/services/nlp_features.py)
+        return derive_nlp_features(entities, notes)
 
 
 def load_clinical_notes(engine) -> pd.DataFrame:
-    """Load clinical notes from database"""
-    logger.info("Loading clinical notes from database...")
+    """
+    Load clinical notes from database
     
-    query = """
-    SELECT patient_id, note_text
-    FROM clinical_notes
-    ORDER BY patient_id, note_date
+    With the deduplicated note tables, each distinct text is fetched once
+    (note_bodies) and shared by all its references; body_hash identifies it.
     """
+    logger.info("Loading clinical notes from database...")
     
-    df = pd.read_sql(query, engine)
-    logger.info(f"Loaded {len(df)} clinical notes for {df['patient_id'].nunique()} patients")
+    with engine.connect() as conn:
+        deduplicated = conn.execute(text("SELECT to_regclass('note_bodies')")).scalar() is not None
     
-    return df
+    if not deduplicated:
+        df = pd.read_sql("""
+        SELECT patient_id, note_text, md5(note_text) AS body_hash
+        FROM clinical_notes
+        ORDER BY patient_id, note_date
+        """, engine)
+        logger.info(f"Loaded {len(df)} clinical notes for {df['patient_id'].nunique()} patients")
+        return df
+    
+    refs = pd.read_sql("""
+    SELECT patient_id, body_hash
+    FROM clinical_note_refs
+    ORDER BY patient_id, note_date, id
+    """, engine)
+    bodies = pd.read_sql("SELECT body_hash, note_text FROM note_bodies", engine)
+    texts = dict(zip(bodies['body_hash'], bodies['note_text']))
+    refs['note_text'] = refs['body_hash'].map(texts)
+    
+    logger.info(f"Loaded {len(refs)} clinical notes ({len(texts)} distinct texts) "
+                f"for {refs['patient_id'].nunique()} patients")
+    
+    return refs
 
 
 def load_structured_features(csv_path: str) -> pd.DataFrame:
@@ -145,8 +109,15 @@ def extract_nlp_features(notes_df: pd.DataFrame, extractor: ClinicalNLPExtractor
     logger.info("Extracting NLP features from clinical notes...")
     
     # Group notes by patient
-    patient_notes = notes_df.groupby('patient_id')['note_text'].apply(list).reset_index()
-    
+    grouped = notes_df.groupby('patient_id')
+    patient_notes = pd.DataFrame({
+        'note_text': grouped['note_text'].apply(list),
+        'body_hash': grouped['body_hash'].apply(tuple),
+    }).reset_index()
+    
+    # Patients with the same sequence of note texts get the same features:
+    # BioBERT runs once per distinct sequence
+    cache = {}
     nlp_features_list = []
     
     for _, row in tqdm(patient_notes.iterrows(), total=len(patient_notes), desc="Processing patients"):
@@ -154,11 +125,16 @@ def extract_nlp_features(notes_df: pd.DataFrame, extractor: ClinicalNLPExtractor
         notes = row['note_text']
         
         # Extract NLP features
-        nlp_features = extractor.extract_features_from_notes(notes)
+        if row['body_hash'] not in cache:
+            cache[row['body_hash']] = extractor.extract_features_from_notes(notes)
+        nlp_features = dict(cache[row['body_hash']])
         nlp_features['patient_id'] = patient_id
         
         nlp_features_list.append(nlp_features)
     
+    if len(cache) < len(patient_notes):
+        logger.info(f"Reused NLP features for {len(patient_notes) - len(cache)} patients with identical notes")
+    
     nlp_df = pd.DataFrame(nlp_features_list)
     logger.info(f"Extracted NLP features for {len(nlp_df)} patients")
     
@@ -0,0 +1,519 @@
+"""
+Shared ingestion helpers for the Synthea loaders
+(load_synthea_to_db.py, load_synthea_to_db_parallel.py, load_synthea_sql_bulk.py)
+
+Derived tables are filled at load time, while each bundle is already parsed,
+so downstream consumers query typed columns instead of walking bundle JSON.
+"""
+
+import base64
+import hashlib
+import io
+import os
+import sys
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+# Shared JSON codec (featurizer/services/json_codec.py)
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'featurizer'))
+from services import json_codec
+
+try:
+    import ijson
+except ImportError:  # optional dependency: bundles are then parsed whole
+    ijson = None
+
+# One row per source file: unchanged loaded files are skipped on re-runs
+INGEST_MANIFEST_DDL = """
+    CREATE TABLE IF NOT EXISTS ingest_manifest (
+        file_path TEXT PRIMARY KEY,
+        size BIGINT NOT NULL,
+        mtime DOUBLE PRECISION NOT NULL,
+        sha1 CHAR(40),
+        status VARCHAR(16) NOT NULL,
+        patient_id VARCHAR(255),
+        updated_at TIMESTAMP DEFAULT clock_timestamp()
+    );
+"""
+
+MANIFEST_COLUMNS = ('file_path', 'size', 'mtime', 'sha1', 'status', 'patient_id')
+
+MANIFEST_ON_CONFLICT = """
+    ON CONFLICT (file_path) DO UPDATE SET
+        size = EXCLUDED.size,
+        mtime = EXCLUDED.mtime,
+        sha1 = EXCLUDED.sha1,
+        status = EXCLUDED.status,
+        patient_id = COALESCE(EXCLUDED.patient_id, ingest_manifest.patient_id),
+        updated_at = clock_timestamp()
+"""
+
+MANIFEST_UPSERT_SQL = (
+    f"INSERT INTO ingest_manifest ({', '.join(MANIFEST_COLUMNS)}) VALUES %s" + MANIFEST_ON_CONFLICT
+)
+
+# Re-loading a patient replaces its bundle instead of duplicating it.
+# Load timestamps use clock_timestamp() (time of the write, not of the
+# transaction start): incremental_backup.py uses them as high-water marks.
+BUNDLE_UPSERT_SQL = """
+    INSERT INTO fhir_bundles (patient_id, bundle_data) VALUES (%s, %s)
+    ON CONFLICT (patient_id) DO UPDATE SET
+        bundle_data = EXCLUDED.bundle_data,
+        loaded_at = clock_timestamp()
+"""
+
+# Rows derived from a bundle, rebuilt whenever the bundle is (re)loaded
+DERIVED_TABLES = ('clinical_note_refs', 'observation_facts', 'bundle_resources')
+
+# Clinical notes, deduplicated: each distinct text is stored once in
+# note_bodies (key: sha256 of the decoded attachment, the same key as
+# document_payloads); clinical_note_refs holds one row per note.
+# clinical_notes is a view joining both, so readers are unchanged.
+NOTE_BODIES_COLUMNS = ('body_hash', 'note_text')
+NOTE_REFS_COLUMNS = ('patient_id', 'encounter_id', 'note_date', 'note_type', 'body_hash')
+
+NOTE_TABLES_DDL = """
+    CREATE TABLE IF NOT EXISTS note_bodies (
+        body_hash CHAR(64) PRIMARY KEY,
+        note_text TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT clock_timestamp()
+    );
+
+    CREATE TABLE IF NOT EXISTS clinical_note_refs (
+        id BIGSERIAL PRIMARY KEY,
+        patient_id VARCHAR(255) NOT NULL,
+        encounter_id VARCHAR(255),
+        note_date TIMESTAMP,
+        note_type VARCHAR(100),
+        body_hash CHAR(64) NOT NULL REFERENCES note_bodies(body_hash),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_clinical_note_refs_patient
+    ON clinical_note_refs(patient_id);
+
+    CREATE INDEX IF NOT EXISTS idx_clinical_note_refs_body
+    ON clinical_note_refs(body_hash);
+"""
+
+CLINICAL_NOTES_VIEW_DDL = """
+    CREATE OR REPLACE VIEW clinical_notes AS
+    SELECT r.id, r.patient_id, r.encounter_id, r.note_date, r.note_type,
+           b.note_text, r.created_at, r.body_hash
+    FROM clinical_note_refs r
+    JOIN note_bodies b ON b.body_hash = r.body_hash
+"""
+
+# Narrow fact table: one row per numeric observation value (panel components included)
+OBSERVATION_FACTS_COLUMNS = ('patient_id', 'encounter_id', 'loinc_code', 'ts', 'value', 'unit')
+
+OBSERVATION_FACTS_DDL = """
+    CREATE TABLE IF NOT EXISTS observation_facts (
+        patient_id VARCHAR(255) NOT NULL,
+        encounter_id VARCHAR(255),
+        loinc_code VARCHAR(32) NOT NULL,
+        ts TIMESTAMPTZ NOT NULL,
+        value DOUBLE PRECISION NOT NULL,
+        unit VARCHAR(64)
+    );
+
+    -- Rows arrive roughly in load order, not time order per page; BRIN stays
+    -- tiny and still prunes most blocks for time-range scans
+    CREATE INDEX IF NOT EXISTS idx_observation_facts_ts
+    ON observation_facts USING BRIN (ts);
+
+    CREATE INDEX IF NOT EXISTS idx_observation_facts_patient_code
+    ON observation_facts(patient_id, loinc_code);
+"""
+
+# One row per bundle entry, so consumers read only the resource types they need
+# instead of unnesting whole bundles with jsonb_array_elements. Not to be
+# confused with fhir_resources, owned by proxy-fhir and the DeID service.
+BUNDLE_RESOURCES_COLUMNS = ('patient_id', 'resource_type', 'resource_id', 'resource')
+
+BUNDLE_RESOURCES_DDL = """
+    CREATE TABLE IF NOT EXISTS bundle_resources (
+        id BIGSERIAL PRIMARY KEY,
+        patient_id VARCHAR(255) NOT NULL,
+        resource_type VARCHAR(64) NOT NULL,
+        resource_id VARCHAR(255),
+        resource JSONB NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_bundle_resources_type_patient
+    ON bundle_resources(resource_type, patient_id);
+
+    CREATE INDEX IF NOT EXISTS idx_bundle_resources_patient
+    ON bundle_resources(patient_id);
+
+    CREATE INDEX IF NOT EXISTS idx_bundle_resources_type_id
+    ON bundle_resources(resource_type, resource_id);
+"""
+
+# Server-side equivalent of resource_fact_rows, for loaders whose bundles are
+# already in the database. {source} is a relation of already-expanded entries
+# exposing patient_id and resource (one FHIR resource per row).
+OBSERVATION_FACTS_INSERT_SQL = """
+    INSERT INTO observation_facts (patient_id, encounter_id, loinc_code, ts, value, unit)
+    SELECT
+        src.patient_id,
+        NULLIF(split_part(obs->'encounter'->>'reference', ':', -1), ''),
+        c->'code'->'coding'->0->>'code',
+        COALESCE(obs->>'effectiveDateTime', obs->'effectivePeriod'->>'start', obs->>'issued')::timestamptz,
+        (c->'valueQuantity'->>'value')::float,
+        COALESCE(c->'valueQuantity'->>'unit', c->'valueQuantity'->>'code')
+    FROM {source} src
+    CROSS JOIN LATERAL (SELECT src.resource AS obs) o
+    CROSS JOIN LATERAL jsonb_array_elements(
+        jsonb_build_array(obs) || COALESCE(obs->'component', '[]'::jsonb)
+    ) c
+    WHERE obs->>'resourceType' = 'Observation'
+      AND jsonb_typeof(c->'valueQuantity'->'value') = 'number'
+      AND c->'code'->'coding'->0->>'code' IS NOT NULL
+      AND COALESCE(obs->>'effectiveDateTime', obs->'effectivePeriod'->>'start', obs->>'issued') IS NOT NULL
+"""
+
+
+def manifest_key(path) -> str:
+    """Manifest identity of a file: its absolute path"""
+    return str(Path(path).resolve())
+
+
+def read_raw_file(path) -> Tuple[Tuple, bytes]:
+    """((file_path, size, mtime, sha1), raw bytes) of a file, without parsing it"""
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return (manifest_key(path), stat.st_size, stat.st_mtime, hashlib.sha1(raw).hexdigest()), raw
+
+
+def ensure_note_tables(cursor):
+    """
+    Create the deduplicated note tables and the clinical_notes view.
+
+    A clinical_notes table left by an earlier version is migrated once:
+    its texts move to note_bodies, its rows to clinical_note_refs, and the
+    table is replaced by the view.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('clinical_notes')")
+    existing = cursor.fetchone()
+    cursor.execute(NOTE_TABLES_DDL)
+    if existing and existing[0] == 'r':
+        body_hash = "encode(sha256(convert_to(note_text, 'UTF8')), 'hex')"
+        cursor.execute(f"""
+            INSERT INTO note_bodies (body_hash, note_text)
+            SELECT {body_hash}, note_text FROM clinical_notes WHERE note_text IS NOT NULL
+            ON CONFLICT (body_hash) DO NOTHING
+        """)
+        bodies = cursor.rowcount
+        cursor.execute(f"""
+            INSERT INTO clinical_note_refs (patient_id, encounter_id, note_date, note_type, body_hash, created_at)
+            SELECT patient_id, encounter_id, note_date, note_type, {body_hash}, created_at
+            FROM clinical_notes WHERE note_text IS NOT NULL ORDER BY id
+        """)
+        print(f"🔁 Migrated {cursor.rowcount} clinical notes to {bodies} distinct note bodies")
+        cursor.execute("DROP TABLE clinical_notes")
+    cursor.execute(CLINICAL_NOTES_VIEW_DDL)
+
+
+def copy_note_rows(cursor, bodies: Dict[str, str], refs: Iterable[Tuple]) -> Tuple[int, int]:
+    """
+    COPY note bodies (skipping texts already stored) then note references.
+
+    Hashes already in note_bodies are looked up first, so only texts the
+    database does not have are sent. Bodies are inserted in hash order, so
+    concurrent loaders sharing texts lock them in the same order instead of
+    deadlocking (ON CONFLICT covers texts another loader stored meanwhile).
+
+    Returns:
+        (new bodies, references)
+    """
+    if not bodies:
+        return 0, 0
+    cursor.execute("SELECT body_hash FROM note_bodies WHERE body_hash = ANY(%s)", (list(bodies),))
+    stored = {row[0] for row in cursor.fetchall()}
+    missing = [(body_hash, text) for body_hash, text in bodies.items() if body_hash not in stored]
+
+    new_bodies = 0
+    if missing:
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS tmp_note_bodies (
+                body_hash CHAR(64),
+                note_text TEXT
+            ) ON COMMIT DELETE ROWS
+        """)
+        copy_rows(cursor, 'tmp_note_bodies', NOTE_BODIES_COLUMNS, missing)
+        cursor.execute("""
+            INSERT INTO note_bodies (body_hash, note_text)
+            SELECT body_hash, note_text FROM tmp_note_bodies
+            ORDER BY body_hash
+            ON CONFLICT (body_hash) DO NOTHING
+        """)
+        new_bodies = cursor.rowcount
+    return new_bodies, copy_rows(cursor, 'clinical_note_refs', NOTE_REFS_COLUMNS, refs)
+
+
+def ensure_bundle_upsert_key(cursor):
+    """
+    Make fhir_bundles.patient_id unique (needed by ON CONFLICT).
+
+    Duplicates left by earlier non-idempotent runs are removed first,
+    keeping the most recent row per patient.
+    """
+    cursor.execute("SELECT to_regclass('uq_fhir_bundles_patient') IS NOT NULL")
+    if cursor.fetchone()[0]:
+        return
+    cursor.execute("""
+        DELETE FROM fhir_bundles a USING fhir_bundles b
+        WHERE a.patient_id = b.patient_id AND a.id < b.id
+    """)
+    if cursor.rowcount:
+        print(f"🧹 Removed {cursor.rowcount} duplicate bundles from earlier runs")
+    cursor.execute("CREATE UNIQUE INDEX uq_fhir_bundles_patient ON fhir_bundles(patient_id)")
+
+
+def load_manifest(cursor) -> Dict[str, Tuple]:
+    """file_path -> (size, mtime, sha1, status)"""
+    cursor.execute("SELECT file_path, size, mtime, sha1, status FROM ingest_manifest")
+    return {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+
+def is_loaded(path, manifest: Dict[str, Tuple]) -> bool:
+    """True when the file is recorded as loaded with its current size and mtime (one stat(), no read)"""
+    entry = manifest.get(manifest_key(path))
+    if not entry or entry[3] != 'loaded':
+        return False
+    stat = os.stat(path)
+    return entry[0] == stat.st_size and entry[1] == stat.st_mtime
+
+
+def pending_files(files: Iterable[Path], manifest: Dict[str, Tuple]) -> Tuple[List[Path], int]:
+    """
+    Files still to load: anything not recorded as loaded with the same size
+    and mtime.
+
+    Returns:
+        (files to process, number skipped)
+    """
+    todo = []
+    skipped = 0
+    for path in files:
+        if is_loaded(path, manifest):
+            skipped += 1
+        else:
+            todo.append(path)
+    return todo, skipped
+
+
+def unchanged_content(manifest: Dict[str, Tuple], fingerprint: Sequence) -> bool:
+    """
+    True when a file whose stat changed still has the loaded content (e.g. touched).
+
+    fingerprint is (file_path, size, mtime, sha1), as returned by read_raw_file.
+    """
+    entry = manifest.get(fingerprint[0])
+    return bool(entry and entry[3] == 'loaded' and entry[2] == fingerprint[3])
+
+
+def record_manifest(cursor, rows: Sequence[Tuple]):
+    """Upsert (file_path, size, mtime, sha1, status, patient_id) rows"""
+    if rows:
+        from psycopg2.extras import execute_values
+        execute_values(cursor, MANIFEST_UPSERT_SQL, rows)
+
+
+def upsert_bundles_copy(cursor, rows: Iterable[Tuple[str, str]]) -> int:
+    """
+    Upsert (patient_id, bundle text) rows into fhir_bundles through COPY.
+
+    COPY cannot resolve conflicts itself: rows land in a session temp table
+    (emptied at commit) and are merged with one INSERT ... ON CONFLICT, the
+    last row of a patient winning.
+
+    Returns:
+        Number of bundles written
+    """
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS tmp_bundle_upsert (
+            seq BIGSERIAL,
+            patient_id VARCHAR(255),
+            bundle_data JSONB
+        ) ON COMMIT DELETE ROWS
+    """)
+    if not copy_rows(cursor, 'tmp_bundle_upsert', ('patient_id', 'bundle_data'), rows):
+        return 0
+    cursor.execute("""
+        INSERT INTO fhir_bundles (patient_id, bundle_data)
+        SELECT DISTINCT ON (patient_id) patient_id, bundle_data
+        FROM tmp_bundle_upsert
+        ORDER BY patient_id, seq DESC
+        ON CONFLICT (patient_id) DO UPDATE SET
+            bundle_data = EXCLUDED.bundle_data,
+            loaded_at = clock_timestamp()
+    """)
+    return cursor.rowcount
+
+
+def clear_derived_rows(cursor, patient_ids: Sequence[str]):
+    """Delete notes/facts of patients about to be (re)loaded"""
+    if patient_ids:
+        for table in DERIVED_TABLES:
+            cursor.execute(f"DELETE FROM {table} WHERE patient_id = ANY(%s)", (list(patient_ids),))
+
+
+def _reference_id(reference: Optional[str]) -> Optional[str]:
+    """'urn:uuid:abc' / 'Encounter/abc' -> 'abc'"""
+    if not reference:
+        return None
+    return reference.rsplit(':', 1)[-1].rsplit('/', 1)[-1] or None
+
+
+def resource_fact_rows(resource: Dict, patient_id: str) -> Iterator[Tuple]:
+    """Yield observation_facts rows (OBSERVATION_FACTS_COLUMNS order) for one resource"""
+    if resource.get('resourceType') != 'Observation':
+        return
+
+    ts = (resource.get('effectiveDateTime')
+          or resource.get('effectivePeriod', {}).get('start')
+          or resource.get('issued'))
+    if not ts:
+        return
+    encounter_id = _reference_id(resource.get('encounter', {}).get('reference'))
+
+    # Panels (e.g. blood pressure) carry their values in components
+    for part in [resource] + resource.get('component', []):
+        quantity = part.get('valueQuantity')
+        codings = part.get('code', {}).get('coding', [])
+        if not quantity or not codings or not codings[0].get('code'):
+            continue
+        value = quantity.get('value')
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        yield (patient_id, encounter_id, codings[0]['code'], ts, float(value),
+               quantity.get('unit') or quantity.get('code'))
+
+
+def resource_row(resource: Dict, patient_id: str) -> Optional[Tuple]:
+    """bundle_resources row (BUNDLE_RESOURCES_COLUMNS order) of one resource, None if untyped"""
+    resource_type = resource.get('resourceType')
+    if not resource_type:
+        return None
+    return (patient_id, resource_type, resource.get('id'), json_codec.dumps(resource))
+
+
+def resource_notes(resource: Dict, patient_id: str, bodies: Dict[str, str]) -> List[Tuple]:
+    """
+    clinical_note_refs rows (NOTE_REFS_COLUMNS order) of one DocumentReference.
+
+    Texts are added to bodies (body_hash -> text); an attachment whose hash
+    is already there is not decoded to text again.
+    """
+    refs = []
+    if resource.get('resourceType') != 'DocumentReference':
+        return refs
+    for content in resource.get('content', []):
+        attachment = content.get('attachment', {})
+        if 'data' in attachment:
+            try:
+                payload = base64.b64decode(attachment['data'])
+                body_hash = hashlib.sha256(payload).hexdigest()
+                if body_hash not in bodies:
+                    bodies[body_hash] = payload.decode('utf-8')
+            except Exception:
+                continue
+            refs.append((patient_id, resource.get('id'), resource.get('date'),
+                         resource.get('type', {}).get('text', 'Clinical Note'), body_hash))
+    return refs
+
+
+def iter_bundle_resources(raw: bytes) -> Iterator[Dict]:
+    """
+    Yield the resources of a bundle one entry at a time.
+
+    With ijson the bundle is parsed as an event stream: only the current
+    entry is materialized, instead of the whole (possibly 50MB+) bundle as
+    nested dicts. Without ijson the bundle is parsed whole.
+    """
+    if ijson is not None:
+        # use_float: numbers as float (not Decimal), like json.loads
+        yield from ijson.items(io.BytesIO(raw), 'entry.item.resource', use_float=True)
+    else:
+        for entry in json_codec.loads(raw).get('entry', []):
+            yield entry.get('resource', {})
+
+
+class BundleScan(NamedTuple):
+    """Rows extracted from one bundle in a single streamed pass"""
+    patient_id: Optional[str]
+    note_refs: List[Tuple]
+    note_bodies: Dict[str, str]
+    observation_facts: List[Tuple]
+    resources: List[Tuple]
+
+
+def scan_bundle(raw: bytes) -> BundleScan:
+    """
+    Extract the patient id, clinical notes (deduplicated bodies + references),
+    observation facts and bundle_resources rows from a raw bundle in one pass
+    over iter_bundle_resources.
+
+    DocumentReferences are decoded as they stream by. Synthea writes the
+    Patient first; resources seen before it are held until it arrives.
+    """
+    patient_id = None
+    held = []
+    note_refs = []
+    note_bodies = {}
+    facts = []
+    resources = []
+
+    def emit(resource):
+        note_refs.extend(resource_notes(resource, patient_id, note_bodies))
+        facts.extend(resource_fact_rows(resource, patient_id))
+        row = resource_row(resource, patient_id)
+        if row:
+            resources.append(row)
+
+    for resource in iter_bundle_resources(raw):
+        if patient_id is None:
+            if resource.get('resourceType') == 'Patient' and resource.get('id'):
+                patient_id = resource['id']
+                for early in held:
+                    emit(early)
+                held = []
+                emit(resource)
+            else:
+                held.append(resource)
+        else:
+            emit(resource)
+    return BundleScan(patient_id, note_refs, note_bodies, facts, resources)
+
+
+def _copy_text(value) -> str:
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_line(row: Sequence) -> str:
+    """One COPY text-format line (tab separated, escaped, \\N for NULL)"""
+    return '\t'.join(_copy_text(v) for v in row) + '\n'
+
+
+def copy_rows(cursor, table: str, columns: Sequence[str], rows: Iterable[Tuple]) -> int:
+    """
+    Write rows with COPY ... FROM STDIN (text format) through an in-memory buffer.
+
+    Returns:
+        Number of rows copied
+    """
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write(copy_line(row))
+        count += 1
+    if count:
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+    return count
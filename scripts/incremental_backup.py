@@ -0,0 +1,446 @@
+"""
+Incremental backup of the append-only FHIR tables
+
+A chain directory holds one base snapshot (a directory-format pg_dump) and
+numbered increments. Each increment stores the rows added since the previous
+one, found by per-table high-water marks (id or timestamp column), as
+compressed COPY text chunks plus a manifest.json:
+
+    database_backups/incremental/
+        base/                 pg_dump -Fd output + manifest.json (marks at dump time)
+        inc_0001_<stamp>/     manifest.json + fhir_bundles.0000.copy.zst ...
+
+Replaying an increment merges rows the way the loaders write them: bundles
+are upserted on patient_id, re-loaded patients get their derived rows
+replaced, and observation_facts (no id column) is rebuilt from the restored
+bundle_resources of those patients. ingest_manifest travels with the chain,
+so the loaders skip the restored files instead of reloading them.
+
+Timestamp marks are write times (clock_timestamp(), see fhir_ingest.py),
+and marks are only recorded when no other transaction is writing: rows of a
+transaction still in progress could otherwise commit below the mark.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+
+from fhir_ingest import OBSERVATION_FACTS_INSERT_SQL
+from pg_backup_utils import DB_NAME, format_size
+
+try:
+    import zstandard
+except ImportError:  # optional dependency: chunks are then gzipped
+    zstandard = None
+
+DB_CONFIG = {
+    'host': 'localhost',
+    'port': 5433,
+    'database': DB_NAME,
+    'user': 'postgres',
+    'password': 'qwerty'
+}
+
+CHAIN_DIR = os.path.join("database_backups", "incremental")
+BASE_DIR_NAME = "base"
+MANIFEST_FILE = "manifest.json"
+
+# (table, high-water mark column, mark type, merge) in replay order.
+# merge: 'upsert' on the table key, 'insert' skipping existing keys,
+# 'replace' = derived rows of the increment's patients are replaced
+INCREMENTAL_TABLES = (
+    ('fhir_bundles', 'loaded_at', 'timestamp', 'upsert'),
+    ('note_bodies', 'created_at', 'timestamp', 'insert'),
+    ('clinical_note_refs', 'id', 'bigint', 'replace'),
+    ('bundle_resources', 'id', 'bigint', 'replace'),
+    ('ingest_manifest', 'updated_at', 'timestamp', 'upsert'),
+)
+
+# Conflict key of each table (primary key)
+TABLE_KEYS = {
+    'fhir_bundles': 'patient_id',
+    'note_bodies': 'body_hash',
+    'clinical_note_refs': 'id',
+    'bundle_resources': 'id',
+    'ingest_manifest': 'file_path',
+}
+
+# Timestamp mark columns, defaulting to the write time on databases created
+# before the loaders switched from CURRENT_TIMESTAMP
+WRITE_TIME_DEFAULT = 'clock_timestamp()'
+
+
+def connect():
+    """psycopg2 connection to the published PostgreSQL port"""
+    return psycopg2.connect(**DB_CONFIG)
+
+
+class ChunkWriter:
+    """
+    File-like target for COPY ... TO STDOUT that rotates to a new compressed
+    chunk once chunk_bytes of COPY text have been written. psycopg2 writes
+    one row per call, so chunks always end on a row boundary.
+    """
+
+    def __init__(self, directory: str, table: str, chunk_bytes: int, codec: str, level: int = 3):
+        self.directory = directory
+        self.table = table
+        self.chunk_bytes = chunk_bytes
+        self.codec = codec
+        self.level = level
+        self.files = []
+        self._raw = None
+        self._stream = None
+        self._hash = None
+        self._rows = 0
+        self._bytes = 0
+
+    def _open(self):
+        extension = 'zst' if self.codec == 'zstd' else 'gz'
+        name = f"{self.table}.{len(self.files):04d}.copy.{extension}"
+        self._raw = open(os.path.join(self.directory, name), 'wb')
+        if self.codec == 'zstd':
+            self._stream = zstandard.ZstdCompressor(level=self.level).stream_writer(self._raw, closefd=False)
+        else:
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=min(self.level, 9))
+        self._hash = hashlib.sha256()
+        self._rows = self._bytes = 0
+        self.files.append({'name': name})
+
+    def _close(self):
+        if self._stream is None:
+            return
+        self._stream.close()
+        self._raw.close()
+        path = os.path.join(self.directory, self.files[-1]['name'])
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                self._hash.update(block)
+        self.files[-1].update(rows=self._rows, bytes=os.path.getsize(path), sha256=self._hash.hexdigest())
+        self._stream = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self._stream is None:
+            self._open()
+        self._stream.write(data)
+        self._rows += data.count(b'\n')
+        self._bytes += len(data)
+        if self._bytes >= self.chunk_bytes:
+            self._close()
+        return len(data)
+
+    def close(self) -> List[Dict]:
+        """Finish the last chunk and return the chunk list for the manifest"""
+        self._close()
+        return self.files
+
+
+def chain_layout(chain_dir: str) -> Tuple[Optional[str], List[str]]:
+    """(base directory or None, increment directories in replay order)"""
+    if not os.path.isdir(chain_dir):
+        return None, []
+    base = os.path.join(chain_dir, BASE_DIR_NAME)
+    increments = sorted(
+        os.path.join(chain_dir, name) for name in os.listdir(chain_dir)
+        if name.startswith('inc_') and os.path.exists(os.path.join(chain_dir, name, MANIFEST_FILE))
+    )
+    return (base if os.path.exists(os.path.join(base, MANIFEST_FILE)) else None), increments
+
+
+def read_manifest(directory: str) -> Dict:
+    """manifest.json of a base or increment directory"""
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def write_manifest(directory: str, manifest: Dict):
+    """Written last: a directory without manifest is an unfinished export and is ignored"""
+    with open(os.path.join(directory, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def existing_tables(cursor) -> List[Tuple]:
+    """INCREMENTAL_TABLES entries present in the database"""
+    present = []
+    for spec in INCREMENTAL_TABLES:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (spec[0],))
+        if cursor.fetchone()[0]:
+            present.append(spec)
+    return present
+
+
+def current_marks(cursor) -> Dict[str, Optional[str]]:
+    """High-water mark of each incremental table (None when empty)"""
+    marks = {}
+    for table, column, _, _ in existing_tables(cursor):
+        cursor.execute(f"SELECT MAX({column})::text FROM {table}")
+        marks[table] = cursor.fetchone()[0]
+    return marks
+
+
+def active_writers(cursor) -> List[Tuple]:
+    """
+    Write transactions in progress in the current snapshot, as (pid, state).
+
+    Read in the same snapshot as the marks: a transaction listed there can
+    still commit rows (ids, write times) below the marks, which the next
+    increment would miss. A loader counts as soon as it has written
+    anything, e.g. its temp staging COPY, before it touches a FHIR table.
+    Transactions that already ended since the snapshot have no pid left.
+    """
+    cursor.execute("""
+        SELECT a.pid, COALESCE(a.state, 'finished since the snapshot')
+        FROM txid_snapshot_xip(txid_current_snapshot()) AS x(xid)
+        LEFT JOIN pg_stat_activity a ON a.backend_xid::text = (x.xid % 4294967296)::text
+        WHERE a.pid IS NULL OR a.datname = current_database()
+    """)
+    return cursor.fetchall()
+
+
+def snapshot_marks(conn) -> Tuple[Dict[str, Optional[str]], List[Tuple]]:
+    """
+    (current_marks, active_writers) read in one REPEATABLE READ snapshot.
+
+    The transaction is left open for export_increment to read the rows of
+    that same snapshot; the caller ends it.
+    """
+    conn.rollback()
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cursor = conn.cursor()
+    marks = current_marks(cursor)
+    return marks, active_writers(cursor)
+
+
+def end_snapshot(conn):
+    """Close the snapshot_marks transaction and restore the default session"""
+    conn.rollback()
+    conn.set_session(isolation_level='DEFAULT', readonly=False)
+
+
+def ensure_write_time_defaults(conn):
+    """Make the timestamp mark columns default to the write time (older databases)"""
+    cursor = conn.cursor()
+    for table, column, mark_type, _ in existing_tables(cursor):
+        if mark_type != 'timestamp':
+            continue
+        cursor.execute("""
+            SELECT pg_get_expr(d.adbin, d.adrelid)
+            FROM pg_attribute a
+            LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+            WHERE a.attrelid = to_regclass(%s) AND a.attname = %s
+        """, (table, column))
+        if cursor.fetchone()[0] != WRITE_TIME_DEFAULT:
+            cursor.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT {WRITE_TIME_DEFAULT}")
+            print(f"   {table}.{column}: default set to {WRITE_TIME_DEFAULT}")
+    conn.commit()
+
+
+def table_columns(cursor, table: str) -> List[str]:
+    """Column names of table, in order"""
+    cursor.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+    """, (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def default_codec() -> str:
+    """zstd when the zstandard module is installed, gzip otherwise"""
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+def export_increment(conn, chain_dir: str, chunk_bytes: int, level: int = 3,
+                     marks: Dict[str, Optional[str]] = None) -> Optional[str]:
+    """
+    Export the rows added since the last base/increment of the chain.
+
+    Runs in the snapshot opened by snapshot_marks (marks: its result), so
+    the new marks match the exported rows exactly. Ends that snapshot.
+
+    Returns:
+        increment directory, or None if nothing changed
+    """
+    base, increments = chain_layout(chain_dir)
+    previous = read_manifest(increments[-1] if increments else base)['marks']
+
+    if marks is None:
+        marks, _ = snapshot_marks(conn)
+    cursor = conn.cursor()
+    if marks == previous:
+        end_snapshot(conn)
+        return None
+
+    name = f"inc_{len(increments) + 1:04d}_{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+    directory = os.path.join(chain_dir, name)
+    os.makedirs(directory)
+    codec = default_codec()
+    manifest = {
+        'kind': 'increment',
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'database': DB_NAME,
+        'codec': codec,
+        'previous_marks': previous,
+        'marks': marks,
+        'tables': {},
+    }
+
+    total_bytes = 0
+    start = time.time()
+    for table, column, mark_type, _ in existing_tables(cursor):
+        low, high = previous.get(table), marks.get(table)
+        if high is None or low == high:
+            continue
+        columns = table_columns(cursor, table)
+        where = f"{column} <= {cursor.mogrify('%s', (high,)).decode()}::{mark_type}"
+        if low is not None:
+            where += f" AND {column} > {cursor.mogrify('%s', (low,)).decode()}::{mark_type}"
+
+        table_start = time.time()
+        writer = ChunkWriter(directory, table, chunk_bytes, codec, level)
+        cursor.copy_expert(f"COPY (SELECT {', '.join(columns)} FROM {table} WHERE {where}) TO STDOUT", writer)
+        files = writer.close()
+        rows = sum(f['rows'] for f in files)
+        size = sum(f['bytes'] for f in files)
+        total_bytes += size
+        manifest['tables'][table] = {'mark_column': column, 'columns': columns, 'rows': rows, 'files': files}
+        elapsed = time.time() - table_start
+        print(f"   {table}: {rows} rows in {len(files)} chunks, {format_size(size)} "
+              f"({rows / max(elapsed, 1e-6):.0f} rows/s)")
+
+    end_snapshot(conn)
+    write_manifest(directory, manifest)
+    elapsed = time.time() - start
+    print(f"📈 Increment: {format_size(total_bytes)} in {elapsed:.1f}s "
+          f"({format_size(total_bytes / max(elapsed, 1e-6))}/s)")
+    return directory
+
+
+class ChunkReader:
+    """Decompressing, checksum-verifying file-like source for COPY ... FROM STDIN"""
+
+    def __init__(self, path: str, codec: str, sha256: str):
+        self.path = path
+        self.expected = sha256
+        self._raw = open(path, 'rb')
+        self._hash = hashlib.sha256()
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to restore zstd increments (pip install zstandard)")
+            self._stream = zstandard.ZstdDecompressor().stream_reader(_Hashing(self._raw, self._hash))
+        else:
+            self._stream = gzip.GzipFile(fileobj=_Hashing(self._raw, self._hash), mode='rb')
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def close(self):
+        # Drain whatever the decompressor did not need, so the hash covers the file
+        while self._raw.read(1024 * 1024):
+            pass
+        self._raw.close()
+        if self.expected and self._hash.hexdigest() != self.expected:
+            raise RuntimeError(f"Checksum mismatch for {self.path}")
+
+
+class _Hashing:
+    """Raw file wrapper hashing the compressed bytes as they are read"""
+
+    def __init__(self, raw, digest):
+        self._raw = raw
+        self._digest = digest
+
+    def read(self, size=-1):
+        data = self._raw.read(size)
+        self._digest.update(data)
+        return data
+
+
+def replay_increment(conn, directory: str) -> Dict[str, int]:
+    """
+    Merge one increment into the database, in a single transaction.
+
+    Returns:
+        rows loaded per table
+    """
+    manifest = read_manifest(directory)
+    previous = manifest['previous_marks']
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE increment_patients (patient_id VARCHAR(255) PRIMARY KEY) ON COMMIT DROP")
+    loaded = {}
+
+    for table, _, _, merge in INCREMENTAL_TABLES:
+        if merge == 'replace' and previous.get(table) is not None:
+            # Re-loaded patients: their rows older than the increment are
+            # superseded, even when the increment brings none for this table
+            cursor.execute(f"""
+                DELETE FROM {table}
+                WHERE patient_id IN (SELECT patient_id FROM increment_patients)
+                  AND id <= %s
+            """, (int(previous[table]),))
+
+        spec = manifest['tables'].get(table)
+        if not spec:
+            continue
+        columns = ', '.join(spec['columns'])
+        staging = f"increment_{table}"
+        cursor.execute(f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        for chunk in spec['files']:
+            reader = ChunkReader(os.path.join(directory, chunk['name']), manifest['codec'], chunk.get('sha256'))
+            try:
+                cursor.copy_expert(f"COPY {staging} ({columns}) FROM STDIN", reader)
+            finally:
+                reader.close()
+
+        key = TABLE_KEYS[table]
+        if merge == 'upsert':
+            updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in spec['columns'] if c not in ('id', key))
+            cursor.execute(f"""
+                INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging}
+                ON CONFLICT ({key}) DO UPDATE SET {updates}
+            """)
+            loaded[table] = cursor.rowcount
+            if table == 'fhir_bundles':
+                cursor.execute(f"""
+                    INSERT INTO increment_patients SELECT DISTINCT patient_id FROM {staging}
+                    ON CONFLICT DO NOTHING
+                """)
+        else:
+            cursor.execute(f"""
+                INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging}
+                ON CONFLICT ({key}) DO NOTHING
+            """)
+            loaded[table] = cursor.rowcount
+
+    # observation_facts has no mark: rebuilt for the increment's patients
+    if 'fhir_bundles' in manifest['tables']:
+        cursor.execute("""
+            DELETE FROM observation_facts
+            WHERE patient_id IN (SELECT patient_id FROM increment_patients)
+        """)
+        cursor.execute(OBSERVATION_FACTS_INSERT_SQL.format(source="""(
+            SELECT r.patient_id, r.resource
+            FROM bundle_resources r
+            JOIN increment_patients p ON p.patient_id = r.patient_id
+            WHERE r.resource_type = 'Observation'
+        )"""))
+        loaded['observation_facts'] = cursor.rowcount
+
+    # Restored ids came from the source sequences: move them past the maxima
+    for table in manifest['tables']:
+        if 'id' in manifest['tables'][table]['columns']:
+            cursor.execute(f"""
+                SELECT setval(pg_get_serial_sequence(%s, 'id'), MAX(id))
+                FROM {table} HAVING MAX(id) IS NOT NULL
+            """, (table,))
+
+    conn.commit()
+    return loaded
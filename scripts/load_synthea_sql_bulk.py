@@ -4,12 +4,36 @@ Ultra-fast SQL-based FHIR data loader using PostgreSQL COPY and JSON functions
 10-20x faster than Python processing, minimal memory usage
 """
 
+import io
 import os
+import re
 import sys
+import queue
+import threading
+import time
 import psycopg2
 from pathlib import Path
 import subprocess
 
+from fhir_ingest import (
+    DERIVED_TABLES, BUNDLE_RESOURCES_DDL, INGEST_MANIFEST_DDL, MANIFEST_COLUMNS, MANIFEST_ON_CONFLICT, OBSERVATION_FACTS_DDL,
+    OBSERVATION_FACTS_INSERT_SQL, copy_line, ensure_bundle_upsert_key, ensure_note_tables, load_manifest, pending_files,
+    read_raw_file, record_manifest, unchanged_content
+)
+
+# Shared JSON codec (featurizer/services/json_codec.py)
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'featurizer'))
+from services import json_codec
+
+# COPY streaming settings
+COPY_CHUNK_BYTES = 256 * 1024 * 1024   # Bytes per COPY statement (one commit each)
+COPY_READ_SIZE = 1024 * 1024           # Bytes handed to libpq per read
+TRANSFORM_CHUNK_BUNDLES = 200          # Staged bundles per staging -> final transaction
+READ_QUEUE_FILES = 64                  # Files buffered ahead by the reader thread
+
+# Valid JSON that JSONB rejects: the \u0000 escape (not preceded by an escaped backslash)
+JSONB_NUL_ESCAPE = re.compile(rb'(?<!\\)(?:\\\\)*\\u0000')
+
 # Database configuration
 DB_CONFIG = {
     'host': 'localhost',
@@ -34,46 +58,312 @@ def create_tables_and_functions(conn):
 
     print("📋 Creating tables and functions...")
 
-    # Create tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS clinical_notes (
-            id SERIAL PRIMARY KEY,
-            patient_id VARCHAR(255) NOT NULL,
-            encounter_id VARCHAR(255),
-            note_date TIMESTAMP,
-            note_type VARCHAR(100),
-            note_text TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-
-        CREATE INDEX IF NOT EXISTS idx_clinical_notes_patient
-        ON clinical_notes(patient_id);
-    """)
+    # Create tables (clinical notes: deduplicated bodies + references)
+    ensure_note_tables(cursor)
 
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS fhir_bundles (
             id SERIAL PRIMARY KEY,
             patient_id VARCHAR(255) NOT NULL,
             bundle_data JSONB NOT NULL,
-            loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            loaded_at TIMESTAMP DEFAULT clock_timestamp()
         );
 
         CREATE INDEX IF NOT EXISTS idx_fhir_bundles_patient
         ON fhir_bundles(patient_id);
     """)
 
-    # Create temporary table for staging JSON files
+    cursor.execute(OBSERVATION_FACTS_DDL)
+    cursor.execute(BUNDLE_RESOURCES_DDL)
+
+    # Idempotent re-runs: one bundle per patient, one manifest row per file
+    ensure_bundle_upsert_key(cursor)
+    cursor.execute(INGEST_MANIFEST_DDL)
+
+    # Create temporary table for staging JSON files (with their manifest fingerprint)
     cursor.execute("""
         DROP TABLE IF EXISTS temp_json_staging;
         CREATE TEMPORARY TABLE temp_json_staging (
+            id BIGSERIAL PRIMARY KEY,
             file_path TEXT,
+            size BIGINT,
+            mtime DOUBLE PRECISION,
+            sha1 CHAR(40),
             bundle_data JSONB
         );
+
+        -- Entries of the current transform chunk, expanded once
+        DROP TABLE IF EXISTS temp_chunk_entries;
+        CREATE TEMPORARY TABLE temp_chunk_entries (
+            staging_id BIGINT NOT NULL,
+            resource_type TEXT NOT NULL,
+            resource JSONB NOT NULL
+        );
+
+        -- Notes of the current transform chunk, decoded and hashed once
+        DROP TABLE IF EXISTS temp_chunk_notes;
+        CREATE TEMPORARY TABLE temp_chunk_notes (
+            patient_id VARCHAR(255),
+            encounter_id VARCHAR(255),
+            note_date TIMESTAMP,
+            note_type VARCHAR(100),
+            payload BYTEA,
+            body_hash CHAR(64)
+        );
     """)
 
     conn.commit()
     print("✅ Tables and staging area ready")
 
+def read_and_validate(json_files, file_queue, manifest, unstaged):
+    """
+    Reader thread: read each file and validate it with the fast JSON parser
+    (plus the \u0000 escape JSONB refuses), so a bad file is skipped instead
+    of aborting the whole COPY.
+
+    Files whose content is unchanged since they were loaded (only touched) and
+    invalid files are not staged: their manifest rows go to unstaged.
+    Ends the stream with None.
+    """
+    for json_file in json_files:
+        fingerprint = None
+        try:
+            fingerprint, raw = read_raw_file(json_file)
+            if unchanged_content(manifest, fingerprint):
+                unstaged.append(fingerprint + ('loaded', None))
+                continue
+            json_codec.loads(raw)
+            if JSONB_NUL_ESCAPE.search(raw):
+                raise ValueError("\\u0000 escape, not storable as JSONB")
+            file_queue.put((json_file, fingerprint, raw))
+        except Exception as e:
+            print(f"⚠️  Skipped {json_file}: {e}")
+            if fingerprint:
+                unstaged.append(fingerprint + ('failed', None))
+    file_queue.put(None)
+
+
+class CopyStream:
+    """
+    File-like object fed to copy_expert: pulls validated files from the
+    reader queue and yields them as COPY text rows
+    (file_path, size, mtime, sha1, bundle_data).
+
+    Stops after max_bytes of input so each COPY (and its commit) stays bounded;
+    the next CopyStream continues from the same queue. The paths streamed are
+    kept, so a rejected chunk can be staged again file by file.
+    """
+
+    def __init__(self, file_queue, max_bytes):
+        self.file_queue = file_queue
+        self.max_bytes = max_bytes
+        self.paths = []
+        self.files = 0
+        self.bytes_read = 0
+        self.exhausted = False
+        self._buffer = b''
+        self._pos = 0
+
+    def _next_row(self):
+        if self.exhausted or self.bytes_read >= self.max_bytes:
+            return None
+        item = self.file_queue.get()
+        if item is None:
+            self.exhausted = True
+            return None
+        json_file, fingerprint, raw = item
+        self.paths.append(json_file)
+        self.files += 1
+        self.bytes_read += len(raw)
+        return copy_line(fingerprint + (raw.decode('utf-8'),)).encode('utf-8')
+
+    def read(self, size=-1):
+        # Serve slices of the current row without re-copying the remainder
+        if self._pos >= len(self._buffer):
+            row = self._next_row()
+            if row is None:
+                return b''
+            self._buffer, self._pos = row, 0
+        if size < 0:
+            size = len(self._buffer) - self._pos
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+def stage_files_one_by_one(conn, paths, unstaged) -> int:
+    """
+    Stage the files of a rejected COPY chunk one COPY each, so only the
+    culprits are left out (recorded as failed in unstaged).
+
+    Returns:
+        Number of files staged
+    """
+    cursor = conn.cursor()
+    staged = 0
+    for json_file in paths:
+        fingerprint = None
+        try:
+            fingerprint, raw = read_raw_file(json_file)
+            row = copy_line(fingerprint + (raw.decode('utf-8'),)).encode('utf-8')
+            cursor.copy_expert("COPY temp_json_staging (file_path, size, mtime, sha1, bundle_data) FROM STDIN",
+                               io.BytesIO(row))
+            conn.commit()
+            staged += 1
+        except (OSError, UnicodeDecodeError, psycopg2.DataError) as e:
+            conn.rollback()
+            print(f"⚠️  Skipped {json_file}: {getattr(e, 'pgerror', None) or e}")
+            if fingerprint:
+                unstaged.append(fingerprint + ('failed', None))
+    return staged
+
+
+def transform_chunk(cursor, low: int, high: int):
+    """
+    Move staged bundles with low <= id < high into the final tables.
+
+    Entries are expanded once into temp_chunk_entries, which then feeds the
+    bundles, resources, notes and observation facts inserts. Note texts
+    are only converted and stored for hashes not already in note_bodies.
+    Bundles are upserted on patient_id, so re-staging a file replaces its rows.
+
+    Returns:
+        (bundles, resources, notes, new note bodies, observation facts) inserted
+    """
+    cursor.execute("TRUNCATE temp_chunk_entries")
+    cursor.execute("""
+        INSERT INTO temp_chunk_entries (staging_id, resource_type, resource)
+        SELECT s.id, entry->'resource'->>'resourceType', entry->'resource'
+        FROM temp_json_staging s,
+        LATERAL jsonb_array_elements(s.bundle_data->'entry') AS entry
+        WHERE s.id >= %s AND s.id < %s
+          AND entry->'resource'->>'resourceType' IS NOT NULL
+    """, (low, high))
+
+    # One row per staged bundle: its patient id
+    staged_patients = """(
+        SELECT staging_id, (resource->>'id')::varchar(255) AS patient_id
+        FROM temp_chunk_entries
+        WHERE resource_type = 'Patient' AND resource->>'id' IS NOT NULL
+    )"""
+    # One row per patient: the most recently staged bundle wins
+    patients = f"""(
+        SELECT DISTINCT ON (patient_id) staging_id, patient_id
+        FROM {staged_patients} sp
+        ORDER BY patient_id, staging_id DESC
+    )"""
+
+    cursor.execute(f"""
+        INSERT INTO fhir_bundles (patient_id, bundle_data)
+        SELECT p.patient_id, s.bundle_data
+        FROM {patients} p
+        JOIN temp_json_staging s ON s.id = p.staging_id
+        ON CONFLICT (patient_id) DO UPDATE SET
+            bundle_data = EXCLUDED.bundle_data,
+            loaded_at = clock_timestamp()
+    """)
+    bundles = cursor.rowcount
+
+    # Re-loaded patients: their previous notes/facts are replaced
+    for table in DERIVED_TABLES:
+        cursor.execute(f"DELETE FROM {table} WHERE patient_id IN (SELECT patient_id FROM {patients} p)")
+
+    cursor.execute(f"""
+        INSERT INTO bundle_resources (patient_id, resource_type, resource_id, resource)
+        SELECT p.patient_id, e.resource_type, e.resource->>'id', e.resource
+        FROM temp_chunk_entries e
+        JOIN {patients} p ON p.staging_id = e.staging_id
+    """)
+    resources = cursor.rowcount
+
+    cursor.execute("TRUNCATE temp_chunk_notes")
+    cursor.execute(f"""
+        INSERT INTO temp_chunk_notes (patient_id, encounter_id, note_date, note_type, payload)
+        SELECT
+            p.patient_id,
+            d.resource->>'id' as encounter_id,
+            (d.resource->>'date')::timestamp as note_date,
+            COALESCE(d.resource->'type'->>'text', 'Clinical Note') as note_type,
+            decode(content->'attachment'->>'data', 'base64') as payload
+        FROM temp_chunk_entries d
+        JOIN {patients} p ON p.staging_id = d.staging_id,
+        LATERAL jsonb_array_elements(d.resource->'content') AS content
+        WHERE d.resource_type = 'DocumentReference'
+          AND content->'attachment'->>'data' IS NOT NULL
+    """)
+    cursor.execute("UPDATE temp_chunk_notes SET body_hash = encode(sha256(payload), 'hex')")
+
+    cursor.execute("""
+        INSERT INTO note_bodies (body_hash, note_text)
+        SELECT DISTINCT ON (n.body_hash) n.body_hash, convert_from(n.payload, 'UTF8')
+        FROM temp_chunk_notes n
+        WHERE NOT EXISTS (SELECT 1 FROM note_bodies b WHERE b.body_hash = n.body_hash)
+        ORDER BY n.body_hash
+        ON CONFLICT (body_hash) DO NOTHING
+    """)
+    bodies = cursor.rowcount
+
+    cursor.execute("""
+        INSERT INTO clinical_note_refs (patient_id, encounter_id, note_date, note_type, body_hash)
+        SELECT patient_id, encounter_id, note_date, note_type, body_hash
+        FROM temp_chunk_notes
+    """)
+    notes = cursor.rowcount
+
+    cursor.execute(OBSERVATION_FACTS_INSERT_SQL.format(source=f"""(
+        SELECT p.patient_id, o.resource
+        FROM temp_chunk_entries o
+        JOIN {patients} p ON p.staging_id = o.staging_id
+        WHERE o.resource_type = 'Observation'
+    )"""))
+    facts = cursor.rowcount
+
+    # Manifest rows commit with the data: an interrupted run resumes after this chunk.
+    # One row per file (a bundle may hold several Patient entries, and ON
+    # CONFLICT cannot update the same file twice in one statement)
+    cursor.execute(f"""
+        INSERT INTO ingest_manifest ({', '.join(MANIFEST_COLUMNS)})
+        SELECT DISTINCT ON (s.file_path)
+               s.file_path, s.size, s.mtime, s.sha1,
+               CASE WHEN sp.patient_id IS NULL THEN 'failed' ELSE 'loaded' END,
+               sp.patient_id
+        FROM temp_json_staging s
+        LEFT JOIN {staged_patients} sp ON sp.staging_id = s.id
+        WHERE s.id >= %s AND s.id < %s
+        ORDER BY s.file_path, s.id DESC, sp.patient_id
+    """ + MANIFEST_ON_CONFLICT, (low, high))
+
+    return bundles, resources, notes, bodies, facts
+
+
+def transform_staged_bundles(conn, chunk_bundles: int = TRANSFORM_CHUNK_BUNDLES):
+    """
+    Staging -> final tables in id-range chunks, one transaction per chunk,
+    so memory, WAL and lock time stay bounded and progress is visible.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(id), MAX(id) FROM temp_json_staging")
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        return 0, 0, 0, 0, 0
+
+    totals = [0, 0, 0, 0, 0]
+    start = time.time()
+    for low in range(min_id, max_id + 1, chunk_bundles):
+        high = low + chunk_bundles
+        counts = transform_chunk(cursor, low, high)
+        conn.commit()
+        totals = [t + c for t, c in zip(totals, counts)]
+
+        done = min(high, max_id + 1) - min_id
+        total = max_id + 1 - min_id
+        print(f"   Transformed {done}/{total} staged bundles ({done * 100 // total}%) - "
+              f"{totals[0]} bundles, {totals[1]} resources, {totals[2]} notes ({totals[3]} new bodies), {totals[4]} facts, "
+              f"{time.time() - start:.1f}s")
+
+    return tuple(totals)
+
+
 def bulk_load_json_files(conn, fhir_dir: str):
     """Load all JSON files using SQL COPY and bulk processing"""
     cursor = conn.cursor()
@@ -84,109 +374,83 @@ def bulk_load_json_files(conn, fhir_dir: str):
         print(f"❌ No JSON files found in {fhir_dir}")
         return
 
-    total_files = len(json_files)
-    print(f"📂 Found {total_files} FHIR bundle files")
-    print(f"🚀 Starting SQL bulk load (streaming mode)...")
-
-    # Process files in batches to avoid command line length limits
-    batch_size = 1000
-    processed = 0
-
-    for i in range(0, total_files, batch_size):
-        batch_files = json_files[i:i + batch_size]
+    print(f"📂 Found {len(json_files)} FHIR bundle files")
 
-        # Insert files into staging table using streaming
-        print(f"   Loading batch {i//batch_size + 1} ({len(batch_files)} files)...")
-
-        for json_file in batch_files:
-            try:
-                # Read and insert JSON directly
-                with open(json_file, 'r') as f:
-                    json_content = f.read()
-
-                cursor.execute(
-                    "INSERT INTO temp_json_staging (file_path, bundle_data) VALUES (%s, %s::jsonb)",
-                    (str(json_file), json_content)
-                )
-                processed += 1
+    # Resume: skip files already loaded with the same size/mtime (stat only)
+    manifest = load_manifest(cursor)
+    json_files, unchanged = pending_files(json_files, manifest)
+    if unchanged:
+        print(f"⏭️  Skipping {unchanged} unchanged files already loaded")
+    if not json_files:
+        print("✅ Nothing to load")
+        return 0, 0
 
-                if processed % 100 == 0:
-                    print(f"      Staged {processed}/{total_files} files... ({processed*100//total_files}%)")
+    total_files = len(json_files)
+    print(f"🚀 Starting SQL bulk load (streaming mode)...")
 
-            except Exception as e:
-                print(f"⚠️  Skipped {json_file}: {e}")
-                continue
+    # Reader thread: read + validate JSON while the main thread streams COPY
+    file_queue = queue.Queue(maxsize=READ_QUEUE_FILES)
+    unstaged = []
+    reader = threading.Thread(target=read_and_validate, args=(json_files, file_queue, manifest, unstaged),
+                              daemon=True)
+    reader.start()
 
-        conn.commit()
+    processed = 0
+    total_bytes = 0
+    chunk = 0
+    start = time.time()
+
+    while True:
+        chunk += 1
+        stream = CopyStream(file_queue, COPY_CHUNK_BYTES)
+        chunk_start = time.time()
+        try:
+            cursor.copy_expert("COPY temp_json_staging (file_path, size, mtime, sha1, bundle_data) FROM STDIN",
+                               stream, size=COPY_READ_SIZE)
+            conn.commit()
+        except psycopg2.DataError as e:
+            # One file the server refused aborts the whole chunk: retry it file by file
+            conn.rollback()
+            print(f"⚠️  COPY chunk {chunk} rejected ({(e.pgerror or str(e)).strip()}), "
+                  f"staging its {stream.files} files one by one")
+            stream.files = stage_files_one_by_one(conn, stream.paths, unstaged)
+
+        processed += stream.files
+        total_bytes += stream.bytes_read
+        if stream.files:
+            elapsed = time.time() - chunk_start
+            print(f"   COPY chunk {chunk}: {stream.files} files, {stream.bytes_read / 1024 / 1024:.1f} MB "
+                  f"at {stream.bytes_read / 1024 / 1024 / max(elapsed, 1e-6):.1f} MB/s "
+                  f"({processed}/{total_files})")
+        if stream.exhausted:
+            break
+
+    reader.join()
+    elapsed = time.time() - start
+    skipped = total_files - processed
+    print(f"📈 Staging throughput: {total_bytes / 1024 / 1024:.1f} MB in {elapsed:.1f}s "
+          f"({total_bytes / 1024 / 1024 / max(elapsed, 1e-6):.1f} MB/s)")
+    if skipped:
+        touched = sum(1 for row in unstaged if row[4] == 'loaded')
+        if touched:
+            print(f"⏭️  {touched} touched files have unchanged content")
+        if skipped - touched:
+            print(f"⚠️  Skipped {skipped - touched} unreadable or invalid files")
+    record_manifest(cursor, unstaged)
+    conn.commit()
 
     print(f"✅ Staged {processed} files into database")
 
-    # Now process all staged data using pure SQL
+    # Now process all staged data using pure SQL, one committed id range at a time
     print("🔄 Processing staged data with SQL (extracting bundles and notes)...")
-
-    # Extract and insert FHIR bundles
-    cursor.execute("""
-        INSERT INTO fhir_bundles (patient_id, bundle_data)
-        SELECT
-            (patient_entry->>'id')::varchar(255) as patient_id,
-            bundle_data
-        FROM temp_json_staging,
-        LATERAL (
-            SELECT jsonb_array_elements(bundle_data->'entry') as entry
-        ) entries,
-        LATERAL (
-            SELECT entry->'resource' as resource
-            WHERE (entry->'resource'->>'resourceType') = 'Patient'
-        ) patient_entry
-        WHERE (patient_entry->>'id') IS NOT NULL
-    """)
-
-    bundles_inserted = cursor.rowcount
+    bundles_inserted, resources_inserted, notes_inserted, bodies_inserted, facts_inserted = transform_staged_bundles(conn)
     print(f"✅ Inserted {bundles_inserted} FHIR bundles")
+    print(f"✅ Split {resources_inserted} FHIR resources")
+    print(f"✅ Extracted {notes_inserted} clinical notes ({bodies_inserted} new distinct note bodies)")
+    print(f"✅ Extracted {facts_inserted} observation facts")
 
-    # Extract and insert clinical notes using SQL JSON functions
-    cursor.execute("""
-        INSERT INTO clinical_notes (patient_id, encounter_id, note_date, note_type, note_text)
-        SELECT
-            patient_id,
-            doc_entry->>'id' as encounter_id,
-            (doc_entry->>'date')::timestamp as note_date,
-            COALESCE(doc_entry->'type'->>'text', 'Clinical Note') as note_type,
-            convert_from(decode(content->'attachment'->>'data', 'base64'), 'UTF8') as note_text
-        FROM (
-            SELECT
-                (patient_entry->>'id')::varchar(255) as patient_id,
-                bundle_data
-            FROM temp_json_staging,
-            LATERAL (
-                SELECT jsonb_array_elements(bundle_data->'entry') as entry
-            ) entries,
-            LATERAL (
-                SELECT entry->'resource' as resource
-                WHERE (entry->'resource'->>'resourceType') = 'Patient'
-            ) patient_entry
-            WHERE (patient_entry->>'id') IS NOT NULL
-        ) patients,
-        LATERAL (
-            SELECT jsonb_array_elements(bundle_data->'entry') as entry
-        ) doc_entries,
-        LATERAL (
-            SELECT doc_entries.entry->'resource' as resource
-            WHERE (doc_entries.entry->'resource'->>'resourceType') = 'DocumentReference'
-        ) doc_entry,
-        LATERAL (
-            SELECT jsonb_array_elements(doc_entry->'content') as content
-        ) contents
-        WHERE content->'attachment'->>'data' IS NOT NULL
-    """)
-
-    notes_inserted = cursor.rowcount
-    print(f"✅ Extracted {notes_inserted} clinical notes")
-
-    conn.commit()
-
-    # Cleanup staging table
-    cursor.execute("DROP TABLE temp_json_staging")
+    # Cleanup staging tables
+    cursor.execute("DROP TABLE temp_json_staging; DROP TABLE temp_chunk_entries; DROP TABLE temp_chunk_notes")
     conn.commit()
 
     return bundles_inserted, notes_inserted
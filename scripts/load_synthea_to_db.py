@@ -4,15 +4,17 @@ Load Synthea FHIR data into PostgreSQL database
 Extracts clinical notes from DocumentReference resources
 """
 
-import json
 import os
 import sys
-import base64
 from pathlib import Path
-from typing import List, Dict
 import psycopg2
-from psycopg2.extras import execute_batch
-from datetime import datetime
+
+from fhir_ingest import (
+    BUNDLE_UPSERT_SQL, BUNDLE_RESOURCES_COLUMNS, BUNDLE_RESOURCES_DDL, INGEST_MANIFEST_DDL,
+    OBSERVATION_FACTS_COLUMNS, OBSERVATION_FACTS_DDL, clear_derived_rows, copy_note_rows, copy_rows,
+    ensure_bundle_upsert_key, ensure_note_tables, load_manifest, manifest_key,
+    pending_files, read_raw_file, record_manifest, scan_bundle, unchanged_content
+)
 
 # Database configuration
 DB_CONFIG = {
@@ -37,21 +39,8 @@ def create_tables(conn):
     """Create tables for storing FHIR data and clinical notes"""
     cursor = conn.cursor()
     
-    # Table for clinical notes
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS clinical_notes (
-            id SERIAL PRIMARY KEY,
-            patient_id VARCHAR(255) NOT NULL,
-            encounter_id VARCHAR(255),
-            note_date TIMESTAMP,
-            note_type VARCHAR(100),
-            note_text TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        
-        CREATE INDEX IF NOT EXISTS idx_clinical_notes_patient 
-        ON clinical_notes(patient_id);
-    """)
+    # Clinical notes: deduplicated bodies + per-note references (clinical_notes view)
+    ensure_note_tables(cursor)
     
     # Table for raw FHIR bundles
     cursor.execute("""
@@ -59,63 +48,35 @@ def create_tables(conn):
             id SERIAL PRIMARY KEY,
             patient_id VARCHAR(255) NOT NULL,
             bundle_data JSONB NOT NULL,
-            loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            loaded_at TIMESTAMP DEFAULT clock_timestamp()
         );
         
         CREATE INDEX IF NOT EXISTS idx_fhir_bundles_patient 
         ON fhir_bundles(patient_id);
     """)
     
+    # Typed observation values, filled while each bundle is parsed
+    cursor.execute(OBSERVATION_FACTS_DDL)
+    
+    # One row per bundle entry
+    cursor.execute(BUNDLE_RESOURCES_DDL)
+    
+    # Idempotent re-runs: one bundle per patient, one manifest row per file
+    ensure_bundle_upsert_key(cursor)
+    cursor.execute(INGEST_MANIFEST_DDL)
+    
     conn.commit()
     print("✅ Tables created/verified")
 
-def extract_clinical_notes(bundle: Dict) -> List[Dict]:
-    """Extract clinical notes from FHIR bundle"""
-    notes = []
-    patient_id = None
-    
-    # Find patient ID
-    for entry in bundle.get('entry', []):
-        resource = entry.get('resource', {})
-        if resource.get('resourceType') == 'Patient':
-            patient_id = resource.get('id')
-            break
-    
-    if not patient_id:
-        return notes
-    
-    # Extract DocumentReference resources (clinical notes)
-    for entry in bundle.get('entry', []):
-        resource = entry.get('resource', {})
-        
-        if resource.get('resourceType') == 'DocumentReference':
-            note_id = resource.get('id')
-            note_date = resource.get('date')
-            note_type = resource.get('type', {}).get('text', 'Clinical Note')
-            
-            # Extract note content
-            for content in resource.get('content', []):
-                attachment = content.get('attachment', {})
-                
-                # Decode base64 content
-                if 'data' in attachment:
-                    try:
-                        note_text = base64.b64decode(attachment['data']).decode('utf-8')
-                        
-                        notes.append({
-                            'patient_id': patient_id,
-                            'encounter_id': note_id,
-                            'note_date': note_date,
-                            'note_type': note_type,
-                            'note_text': note_text
-                        })
-                    except Exception as e:
-                        print(f"⚠️  Failed to decode note: {e}")
-    
-    return notes
-
 def load_fhir_files(conn, fhir_dir: str):
-    """Load all FHIR JSON files from directory"""
+    """
+    Load all FHIR JSON files from directory
+    
+    Resumable: files recorded as loaded in ingest_manifest with the same
+    size/mtime are skipped without being read. Each file is walked once
+    (scan_bundle) for its notes, facts and resources; these rows are COPYed
+    with the manifest rows at every commit.
+    """
     fhir_path = Path(fhir_dir)
     json_files = list(fhir_path.glob('*.json'))
     
@@ -126,56 +87,85 @@ def load_fhir_files(conn, fhir_dir: str):
     print(f"📂 Found {len(json_files)} FHIR bundle files")
     
     cursor = conn.cursor()
+    manifest = load_manifest(cursor)
+    json_files, skipped = pending_files(json_files, manifest)
+    if skipped:
+        print(f"⏭️  Skipping {skipped} unchanged files already loaded")
+    
     total_notes = 0
+    total_facts = 0
+    total_resources = 0
+    loaded = 0
+    new_bodies = 0
+    # patient_id -> BundleScan of the last file read for that patient: a later
+    # file of the same patient replaces the earlier one's buffered rows
+    scans = {}
+    manifest_rows = []
+    
+    def flush_rows():
+        nonlocal total_notes, total_facts, total_resources, new_bodies
+        note_bodies = {}
+        for scan in scans.values():
+            note_bodies.update(scan.note_bodies)
+        bodies, refs = copy_note_rows(cursor, note_bodies, (ref for scan in scans.values() for ref in scan.note_refs))
+        new_bodies += bodies
+        total_notes += refs
+        total_facts += copy_rows(
+            cursor, 'observation_facts', OBSERVATION_FACTS_COLUMNS,
+            (row for scan in scans.values() for row in scan.observation_facts)
+        )
+        total_resources += copy_rows(
+            cursor, 'bundle_resources', BUNDLE_RESOURCES_COLUMNS,
+            (row for scan in scans.values() for row in scan.resources)
+        )
+        record_manifest(cursor, manifest_rows)
+        scans.clear()
+        manifest_rows.clear()
     
     for i, json_file in enumerate(json_files, 1):
+        cursor.execute("SAVEPOINT bundle_file")
         try:
-            with open(json_file, 'r') as f:
-                bundle = json.load(f)
-            
-            # Extract patient ID
-            patient_id = None
-            for entry in bundle.get('entry', []):
-                resource = entry.get('resource', {})
-                if resource.get('resourceType') == 'Patient':
-                    patient_id = resource.get('id')
-                    break
-            
-            if not patient_id:
-                continue
+            # Raw text goes to Postgres as-is; the entries are walked once for extraction
+            fingerprint, raw = read_raw_file(json_file)
             
-            # Store raw bundle
-            cursor.execute(
-                "INSERT INTO fhir_bundles (patient_id, bundle_data) VALUES (%s, %s)",
-                (patient_id, json.dumps(bundle))
-            )
-            
-            # Extract and store clinical notes
-            notes = extract_clinical_notes(bundle)
-            
-            if notes:
-                execute_batch(
-                    cursor,
-                    """
-                    INSERT INTO clinical_notes 
-                    (patient_id, encounter_id, note_date, note_type, note_text)
-                    VALUES (%(patient_id)s, %(encounter_id)s, %(note_date)s, 
-                            %(note_type)s, %(note_text)s)
-                    """,
-                    notes
-                )
-                total_notes += len(notes)
-            
-            if i % 100 == 0:
-                conn.commit()
-                print(f"   Processed {i}/{len(json_files)} files...")
+            # Touched but identical: only refresh the recorded stat
+            if unchanged_content(manifest, fingerprint):
+                manifest_rows.append(fingerprint + ('loaded', None))
+            else:
+                scan = scan_bundle(raw)
+                if not scan.patient_id:
+                    manifest_rows.append(fingerprint + ('failed', None))
+                else:
+                    # Store raw bundle (replaces the patient's previous version)
+                    cursor.execute(BUNDLE_UPSERT_SQL, (scan.patient_id, raw.decode('utf-8')))
+                    clear_derived_rows(cursor, [scan.patient_id])
+                    
+                    scans[scan.patient_id] = scan
+                    manifest_rows.append(fingerprint + ('loaded', scan.patient_id))
+                    loaded += 1
+            cursor.execute("RELEASE SAVEPOINT bundle_file")
         
         except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT bundle_file")
+            cursor.execute("RELEASE SAVEPOINT bundle_file")
             print(f"⚠️  Error processing {json_file.name}: {e}")
-            continue
+            try:
+                stat = json_file.stat()
+                manifest_rows.append((manifest_key(json_file), stat.st_size, stat.st_mtime, None, 'failed', None))
+            except OSError:
+                pass
+        
+        # Outside the per-file savepoint: a failed flush aborts the load
+        if i % 100 == 0:
+            flush_rows()
+            conn.commit()
+            print(f"   Processed {i}/{len(json_files)} files...")
     
+    flush_rows()
     conn.commit()
-    print(f"✅ Loaded {len(json_files)} patients with {total_notes} clinical notes")
+    print(f"✅ Loaded {loaded} patients with {total_notes} clinical notes ({new_bodies} new distinct note bodies)")
+    print(f"✅ Observation facts: {total_facts}")
+    print(f"✅ FHIR resources: {total_resources}")
 
 def main():
     """Main execution"""
@@ -208,9 +198,12 @@ def main():
     cursor.execute("SELECT AVG(LENGTH(note_text)) FROM clinical_notes")
     avg_note_length = cursor.fetchone()[0]
     
+    cursor.execute("SELECT COUNT(*) FROM note_bodies")
+    body_count = cursor.fetchone()[0]
+    
     print("\n📊 Database Statistics:")
     print(f"   Patients loaded: {patient_count}")
-    print(f"   Clinical notes: {note_count}")
+    print(f"   Clinical notes: {note_count} ({body_count} distinct bodies)")
     print(f"   Avg note length: {int(avg_note_length) if avg_note_length else 0} characters")
     
     conn.close()
@@ -1,28 +1,44 @@
 #!/usr/bin/env python3
 """
 Memory-optimized parallel FHIR data loader
-Uses multiprocessing with controlled memory usage
+Producer/consumer pipeline with bounded queues:
+
+  feeder thread --(paths, bounded)--> worker processes --COPY--> PostgreSQL
+                                            |
+                 parent <--(counters, bounded)--+
+
+Each worker parses files and writes its own batches over its own connection,
+so bundle JSON never travels back to the parent, which only sums counters.
+A full path queue blocks the feeder (backpressure) instead of piling up work.
 """
 
-import json
 import os
 import sys
-import base64
-import gc
+import queue
+import threading
+import time
 from pathlib import Path
 from typing import List, Dict, Iterator
 import psycopg2
-from psycopg2.extras import execute_batch
-from multiprocessing import Pool, cpu_count
-from functools import partial
+from multiprocessing import Process, Queue, cpu_count
+
+from fhir_ingest import (
+    BUNDLE_RESOURCES_COLUMNS, BUNDLE_RESOURCES_DDL, INGEST_MANIFEST_DDL,
+    OBSERVATION_FACTS_COLUMNS, OBSERVATION_FACTS_DDL, clear_derived_rows, copy_note_rows, copy_rows,
+    ensure_bundle_upsert_key, ensure_note_tables, is_loaded, load_manifest, manifest_key,
+    read_raw_file, record_manifest, scan_bundle, upsert_bundles_copy
+)
 
 # Memory optimization settings
 MEMORY_CONFIG = {
-    'batch_size': 20,        # Files per batch insert (was 50)
-    'chunk_size': 2,         # Files per worker chunk (was 5)
-    'max_workers': 6,        # Maximum parallel workers (was cpu_count)
-    'min_workers': 4,        # Minimum parallel workers
-    'progress_interval': 50  # Show progress every N files
+    'batch_size': 20,                      # Files per worker COPY transaction
+    'batch_bytes': 64 * 1024 * 1024,       # ...or fewer when their bundles exceed this
+    'queue_files_per_worker': 4,           # Paths queued ahead per worker (backpressure)
+    'max_workers': 16,                     # Maximum parallel workers (further capped by memory)
+    'min_workers': 4,                      # Minimum parallel workers (if memory allows)
+    'large_bundle_bytes': 64 * 1024 * 1024,  # Largest bundle expected (worker memory sizing)
+    'memory_fraction': 0.5,                # Share of physical RAM the workers may use
+    'progress_interval': 50                # Show progress every N files
 }
 
 # Database configuration
@@ -47,205 +63,262 @@ def create_tables(conn):
     """Create tables for storing FHIR data and clinical notes"""
     cursor = conn.cursor()
     
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS clinical_notes (
-            id SERIAL PRIMARY KEY,
-            patient_id VARCHAR(255) NOT NULL,
-            encounter_id VARCHAR(255),
-            note_date TIMESTAMP,
-            note_type VARCHAR(100),
-            note_text TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        
-        CREATE INDEX IF NOT EXISTS idx_clinical_notes_patient 
-        ON clinical_notes(patient_id);
-    """)
+    ensure_note_tables(cursor)
     
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS fhir_bundles (
             id SERIAL PRIMARY KEY,
             patient_id VARCHAR(255) NOT NULL,
             bundle_data JSONB NOT NULL,
-            loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            loaded_at TIMESTAMP DEFAULT clock_timestamp()
         );
         
         CREATE INDEX IF NOT EXISTS idx_fhir_bundles_patient 
         ON fhir_bundles(patient_id);
     """)
     
-    conn.commit()
-    print("✅ Tables created/verified")
-
-def extract_clinical_notes(bundle: Dict) -> List[Dict]:
-    """Extract clinical notes from FHIR bundle"""
-    notes = []
-    patient_id = None
+    cursor.execute(OBSERVATION_FACTS_DDL)
+    cursor.execute(BUNDLE_RESOURCES_DDL)
     
-    for entry in bundle.get('entry', []):
-        resource = entry.get('resource', {})
-        if resource.get('resourceType') == 'Patient':
-            patient_id = resource.get('id')
-            break
+    ensure_bundle_upsert_key(cursor)
+    cursor.execute(INGEST_MANIFEST_DDL)
     
-    if not patient_id:
-        return notes
-    
-    for entry in bundle.get('entry', []):
-        resource = entry.get('resource', {})
-        
-        if resource.get('resourceType') == 'DocumentReference':
-            note_id = resource.get('id')
-            note_date = resource.get('date')
-            note_type = resource.get('type', {}).get('text', 'Clinical Note')
-            
-            for content in resource.get('content', []):
-                attachment = content.get('attachment', {})
-                
-                if 'data' in attachment:
-                    try:
-                        note_text = base64.b64decode(attachment['data']).decode('utf-8')
-                        
-                        notes.append({
-                            'patient_id': patient_id,
-                            'encounter_id': note_id,
-                            'note_date': note_date,
-                            'note_type': note_type,
-                            'note_text': note_text
-                        })
-                    except Exception:
-                        pass
-    
-    return notes
+    conn.commit()
+    print("✅ Tables created/verified")
 
 def process_file(json_file: Path) -> Dict:
-    """Process a single FHIR JSON file (worker function) - memory optimized"""
+    """
+    Process a single FHIR JSON file (worker function) - memory optimized
+    
+    The bundle is stored as its raw text (JSONB parses it server-side) and
+    entries are streamed one at a time for extraction, so it is never
+    materialized as nested dicts. It is not free either: while the file is
+    processed the worker holds the raw bytes, their decoded str and one
+    re-serialized bundle_resources row per entry, about 3x the file size;
+    the str and the resource rows (~2x) then stay until the batch is written.
+    """
     try:
-        with open(json_file, 'r') as f:
-            bundle = json.load(f)
-
-        # Extract patient ID
-        patient_id = None
-        for entry in bundle.get('entry', []):
-            resource = entry.get('resource', {})
-            if resource.get('resourceType') == 'Patient':
-                patient_id = resource.get('id')
-                break
-
-        if not patient_id:
-            return None
-
-        # Extract clinical notes before storing bundle
-        notes = extract_clinical_notes(bundle)
+        fingerprint, raw = read_raw_file(json_file)
+        scan = scan_bundle(raw)
 
-        # Convert bundle to JSON string immediately to reduce object overhead
-        bundle_json = json.dumps(bundle)
-
-        # Clear the bundle dict from memory
-        del bundle
+        if not scan.patient_id:
+            return {'patient_id': None, 'file': fingerprint}
 
         return {
-            'patient_id': patient_id,
-            'bundle_json': bundle_json,  # Store as string, not dict
-            'notes': notes
+            'patient_id': scan.patient_id,
+            'file': fingerprint,  # (file_path, size, mtime, sha1) for the manifest
+            'bundle_json': raw.decode('utf-8'),  # Store as string, not dict
+            'note_refs': scan.note_refs,
+            'note_bodies': scan.note_bodies,
+            'observation_facts': scan.observation_facts,
+            'resources': scan.resources
         }
 
     except Exception as e:
         return None
 
-def load_fhir_files_parallel(conn, fhir_dir: str, num_workers: int = None):
-    """Load FHIR files in parallel using multiprocessing with optimized memory usage"""
-    fhir_path = Path(fhir_dir)
+def feed_paths(fhir_path: Path, manifest: Dict, task_queue, num_workers: int, counters: Dict):
+    """
+    Feeder thread: walk the directory lazily and queue the files to load.
+
+    Files already loaded with the same size/mtime are skipped after a stat().
+    Each task carries the sha1 recorded for the file, if any, so workers can
+    recognize touched-but-identical files. put() blocks while the queue is
+    full. Ends with one None per worker.
+    """
+    for json_file in fhir_path.glob('*.json'):
+        counters['found'] += 1
+        if is_loaded(json_file, manifest):
+            counters['skipped'] += 1
+            continue
+        entry = manifest.get(manifest_key(json_file))
+        task_queue.put((str(json_file), entry[2] if entry and entry[3] == 'loaded' else None))
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+
+def _flush_batch(conn, results: Dict[str, Dict], manifest_rows: List) -> Dict:
+    """
+    Write one worker batch in a single transaction, COPY only.
+    
+    results holds one file per patient_id (the last one read). Bundles are
+    upserted on patient_id and the patients' previous notes/facts replaced,
+    so re-loading a file never duplicates rows. The files' manifest rows
+    commit with the data.
+    """
+    cursor = conn.cursor()
+    results = list(results.values())
+    bundles = upsert_bundles_copy(cursor, ((r['patient_id'], r['bundle_json']) for r in results))
+    clear_derived_rows(cursor, [r['patient_id'] for r in results])
+    # Texts repeated across the batch are sent once; already stored ones are not sent
+    note_bodies = {}
+    for r in results:
+        note_bodies.update(r['note_bodies'])
+    bodies, notes = copy_note_rows(cursor, note_bodies, (ref for r in results for ref in r['note_refs']))
+    facts = copy_rows(
+        cursor, 'observation_facts', OBSERVATION_FACTS_COLUMNS,
+        (row for r in results for row in r['observation_facts'])
+    )
+    resources = copy_rows(
+        cursor, 'bundle_resources', BUNDLE_RESOURCES_COLUMNS,
+        (row for r in results for row in r['resources'])
+    )
+    record_manifest(cursor, manifest_rows + [r['file'] + ('loaded', r['patient_id']) for r in results])
+    conn.commit()
+    return {'bundles': bundles, 'notes': notes, 'bodies': bodies, 'facts': facts, 'resources': resources}
+
+
+def ingest_worker(task_queue, result_queue, batch_size: int, batch_bytes: int):
+    """
+    Worker process: parse queued files and COPY them in batches over its own
+    connection. Sends one counters dict per batch, then None when done.
+    """
+    conn = psycopg2.connect(**DB_CONFIG)
+    results, manifest_rows, pending_bytes = {}, [], 0
+    counts = dict.fromkeys(('files', 'bundles', 'notes', 'bodies', 'facts', 'resources', 'unchanged', 'failed'), 0)
+
+    def flush():
+        nonlocal results, manifest_rows, pending_bytes, counts
+        if results or manifest_rows:
+            try:
+                for key, value in _flush_batch(conn, results, manifest_rows).items():
+                    counts[key] += value
+            except Exception as e:
+                # Left out of the manifest: retried by the next run
+                conn.rollback()
+                print(f"⚠️  Batch of {len(results)} bundles failed: {e}")
+                counts['failed'] += len(results)
+        if counts['files']:
+            result_queue.put(counts)
+        results, manifest_rows, pending_bytes = {}, [], 0
+        counts = dict.fromkeys(counts, 0)
 
-    # Use iterator to avoid loading all paths at once
-    json_files_iter = fhir_path.glob('*.json')
-    json_files = list(json_files_iter)  # Still need count for progress
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            json_file, loaded_sha1 = task
+            counts['files'] += 1
+
+            result = process_file(Path(json_file))
+            if result is None:
+                counts['failed'] += 1
+            elif result['patient_id'] is None:
+                manifest_rows.append(result['file'] + ('failed', None))
+                counts['failed'] += 1
+            elif result['file'][3] == loaded_sha1:
+                # Touched but identical: only refresh the recorded stat
+                manifest_rows.append(result['file'] + ('loaded', result['patient_id']))
+                counts['unchanged'] += 1
+            else:
+                # Same patient twice in the batch: the last file wins, the
+                # earlier one's rows are dropped (only its manifest row stays)
+                previous = results.pop(result['patient_id'], None)
+                if previous:
+                    manifest_rows.append(previous['file'] + ('loaded', previous['patient_id']))
+                    pending_bytes -= 2 * previous['file'][1]
+                results[result['patient_id']] = result
+                # Decoded bundle + its per-resource copies
+                pending_bytes += 2 * result['file'][1]
+
+            if len(results) >= batch_size or pending_bytes >= batch_bytes:
+                flush()
+        flush()
+    finally:
+        conn.close()
+        result_queue.put(None)
+
+
+def default_worker_count() -> int:
+    """
+    One worker per core, capped so that the workers' peak memory fits in
+    memory_fraction of the RAM. A worker peaks at about batch_bytes (held
+    batch) plus 3x the file being processed (see process_file).
+    """
+    workers = min(MEMORY_CONFIG['max_workers'], max(MEMORY_CONFIG['min_workers'], cpu_count()))
+    try:
+        total_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):  # no sysconf (Windows)
+        return workers
+    per_worker = MEMORY_CONFIG['batch_bytes'] + 3 * MEMORY_CONFIG['large_bundle_bytes']
+    return max(1, min(workers, int(total_memory * MEMORY_CONFIG['memory_fraction']) // per_worker))
 
-    if not json_files:
-        print(f"❌ No JSON files found in {fhir_dir}")
-        return
 
-    total_files = len(json_files)
-    print(f"📂 Found {total_files} FHIR bundle files")
+def load_fhir_files_parallel(conn, fhir_dir: str, num_workers: int = None):
+    """Load FHIR files in parallel: workers COPY their own batches, the parent sums counters"""
+    fhir_path = Path(fhir_dir)
 
-    # Memory optimization: Use fewer workers (4-6 instead of all cores)
     if num_workers is None:
-        num_workers = min(6, max(4, cpu_count() // 2))
+        num_workers = default_worker_count()
 
     print(f"🚀 Using {num_workers} parallel workers (memory-optimized)")
 
-    cursor = conn.cursor()
-    total_notes_count = 0
-    processed_count = 0
-
-    # Reduced batch size for lower memory footprint
-    batch_size = 20
-    batch_results = []
-
-    # Process files in parallel with smaller chunks
-    with Pool(num_workers) as pool:
-        # Reduced chunksize from 5 to 2 for better memory distribution
-        for result in pool.imap_unordered(process_file, json_files, chunksize=2):
-            if result:
-                batch_results.append(result)
-
-            processed_count += 1
-
-            # Insert batch when full
-            if len(batch_results) >= batch_size:
-                _insert_batch(cursor, batch_results)
-                conn.commit()
-                total_notes_count += sum(len(r['notes']) for r in batch_results)
-
-                # Explicit memory cleanup
-                batch_results.clear()
-                gc.collect()
-
-                # Progress update every 50 files
-                if processed_count % 50 == 0:
-                    print(f"   Processed {processed_count}/{total_files} files... ({processed_count*100//total_files}%)")
-
-        # Insert remaining items
-        if batch_results:
-            _insert_batch(cursor, batch_results)
-            conn.commit()
-            total_notes_count += sum(len(r['notes']) for r in batch_results)
-            batch_results.clear()
-            gc.collect()
-
-    print(f"✅ Parallel processing complete. Total clinical notes inserted: {total_notes_count}")
-
-def _insert_batch(cursor, results):
-    """Helper to insert a batch of results - memory optimized"""
-    # Prepare batch data for bundles
-    bundle_data = [
-        (result['patient_id'], result['bundle_json'])
-        for result in results
-    ]
+    manifest = load_manifest(conn.cursor())
+    conn.commit()
 
-    # Batch insert bundles for better performance
-    execute_batch(
-        cursor,
-        "INSERT INTO fhir_bundles (patient_id, bundle_data) VALUES (%s, %s)",
-        bundle_data
-    )
+    # Bounded in both directions: the feeder blocks when workers fall behind,
+    # workers block if the parent stops draining counters
+    task_queue = Queue(maxsize=num_workers * MEMORY_CONFIG['queue_files_per_worker'])
+    result_queue = Queue(maxsize=num_workers * 4)
 
-    # Insert all notes in one batch
-    all_notes = []
-    for result in results:
-        all_notes.extend(result['notes'])
-
-    if all_notes:
-        execute_batch(
-            cursor,
-            """
-            INSERT INTO clinical_notes
-            (patient_id, encounter_id, note_date, note_type, note_text)
-            VALUES (%(patient_id)s, %(encounter_id)s, %(note_date)s,
-                    %(note_type)s, %(note_text)s)
-            """,
-            all_notes
-        )
+    workers = [
+        Process(target=ingest_worker, args=(task_queue, result_queue,
+                                            MEMORY_CONFIG['batch_size'], MEMORY_CONFIG['batch_bytes']))
+        for _ in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    feeder_counts = {'found': 0, 'skipped': 0}
+    feeder = threading.Thread(target=feed_paths, args=(fhir_path, manifest, task_queue, num_workers, feeder_counts),
+                              daemon=True)
+    feeder.start()
+
+    totals = dict.fromkeys(('files', 'bundles', 'notes', 'bodies', 'facts', 'resources', 'unchanged', 'failed'), 0)
+    finished = 0
+    next_report = MEMORY_CONFIG['progress_interval']
+    start = time.time()
+
+    while finished < num_workers:
+        try:
+            message = result_queue.get(timeout=5)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                print("❌ All workers exited without finishing")
+                break
+            continue
+        if message is None:
+            finished += 1
+            continue
+        for key, value in message.items():
+            totals[key] += value
+        if totals['files'] >= next_report:
+            next_report += MEMORY_CONFIG['progress_interval']
+            elapsed = time.time() - start
+            print(f"   Processed {totals['files']} files ({totals['bundles']} bundles, "
+                  f"{totals['files'] / max(elapsed, 1e-6):.1f} files/s)")
+
+    feeder.join(timeout=5)
+    for worker in workers:
+        worker.join()
+
+    if feeder_counts['found'] == 0:
+        print(f"❌ No JSON files found in {fhir_dir}")
+        return
+
+    print(f"📂 Found {feeder_counts['found']} FHIR bundle files")
+    if feeder_counts['skipped']:
+        print(f"⏭️  Skipped {feeder_counts['skipped']} unchanged files already loaded")
+    if totals['unchanged']:
+        print(f"⏭️  {totals['unchanged']} touched files have unchanged content")
+    if totals['failed']:
+        print(f"⚠️  {totals['failed']} files failed (will be retried on the next run)")
+    print(f"✅ Parallel processing complete. {totals['bundles']} bundles, "
+          f"{totals['notes']} clinical notes ({totals['bodies']} new distinct bodies), "
+          f"{totals['facts']} observation facts, "
+          f"{totals['resources']} resources "
+          f"in {time.time() - start:.1f}s")
 
 def main():
     """Main execution"""
@@ -281,9 +354,12 @@ def main():
     cursor.execute("SELECT AVG(LENGTH(note_text)) FROM clinical_notes")
     avg_note_length = cursor.fetchone()[0]
     
+    cursor.execute("SELECT COUNT(*) FROM note_bodies")
+    body_count = cursor.fetchone()[0]
+    
     print("\n📊 Database Statistics:")
     print(f"   Patients loaded: {patient_count}")
-    print(f"   Clinical notes: {note_count}")
+    print(f"   Clinical notes: {note_count} ({body_count} distinct bodies)")
     print(f"   Avg note length: {int(avg_note_length) if avg_note_length else 0} characters")
     
     conn.close()
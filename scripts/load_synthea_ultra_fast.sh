@@ -32,24 +32,60 @@ echo "📂 Found $FILE_COUNT FHIR files"
 
 # Create tables
 echo "📋 Setting up database..."
-psql -h "$DB_HOST" -p "$DB_PORT" -U "$DB_USER" -d "$DB_NAME" <<SQL
-CREATE TABLE IF NOT EXISTS clinical_notes (
-    id SERIAL PRIMARY KEY,
+psql -h "$DB_HOST" -p "$DB_PORT" -U "$DB_USER" -d "$DB_NAME" -v ON_ERROR_STOP=1 <<SQL
+-- Clinical notes: each distinct text stored once, one reference per note
+-- (same layout as scripts/fhir_ingest.py; clinical_notes is a view)
+CREATE TABLE IF NOT EXISTS note_bodies (
+    body_hash CHAR(64) PRIMARY KEY,
+    note_text TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT clock_timestamp()
+);
+
+CREATE TABLE IF NOT EXISTS clinical_note_refs (
+    id BIGSERIAL PRIMARY KEY,
     patient_id VARCHAR(255) NOT NULL,
     encounter_id VARCHAR(255),
     note_date TIMESTAMP,
     note_type VARCHAR(100),
-    note_text TEXT NOT NULL,
+    body_hash CHAR(64) NOT NULL REFERENCES note_bodies(body_hash),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX IF NOT EXISTS idx_clinical_notes_patient ON clinical_notes(patient_id);
+CREATE INDEX IF NOT EXISTS idx_clinical_note_refs_patient ON clinical_note_refs(patient_id);
+CREATE INDEX IF NOT EXISTS idx_clinical_note_refs_body ON clinical_note_refs(body_hash);
+
+-- A clinical_notes table left by an earlier version is migrated once, then
+-- replaced by the view (same migration as fhir_ingest.ensure_note_tables)
+SELECT EXISTS (
+    SELECT 1 FROM pg_class WHERE oid = to_regclass('clinical_notes') AND relkind = 'r'
+) AS legacy_clinical_notes \gset
+\if :legacy_clinical_notes
+BEGIN;
+INSERT INTO note_bodies (body_hash, note_text)
+SELECT encode(sha256(convert_to(note_text, 'UTF8')), 'hex'), note_text
+FROM clinical_notes WHERE note_text IS NOT NULL
+ON CONFLICT (body_hash) DO NOTHING;
+
+INSERT INTO clinical_note_refs (patient_id, encounter_id, note_date, note_type, body_hash, created_at)
+SELECT patient_id, encounter_id, note_date, note_type,
+       encode(sha256(convert_to(note_text, 'UTF8')), 'hex'), created_at
+FROM clinical_notes WHERE note_text IS NOT NULL ORDER BY id;
+
+DROP TABLE clinical_notes;
+COMMIT;
+\endif
+
+CREATE OR REPLACE VIEW clinical_notes AS
+SELECT r.id, r.patient_id, r.encounter_id, r.note_date, r.note_type,
+       b.note_text, r.created_at, r.body_hash
+FROM clinical_note_refs r
+JOIN note_bodies b ON b.body_hash = r.body_hash;
 
 CREATE TABLE IF NOT EXISTS fhir_bundles (
     id SERIAL PRIMARY KEY,
     patient_id VARCHAR(255) NOT NULL,
     bundle_data JSONB NOT NULL,
-    loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    loaded_at TIMESTAMP DEFAULT clock_timestamp()
 );
 
 CREATE INDEX IF NOT EXISTS idx_fhir_bundles_patient ON fhir_bundles(patient_id);
@@ -81,7 +117,7 @@ psql -h "$DB_HOST" -p "$DB_PORT" -U "$DB_USER" -d "$DB_NAME" -f "$TEMP_SQL"
 
 # Process staged data with pure SQL
 echo "🔄 Processing bundles and extracting notes with SQL..."
-psql -h "$DB_HOST" -p "$DB_PORT" -U "$DB_USER" -d "$DB_NAME" <<SQL
+psql -h "$DB_HOST" -p "$DB_PORT" -U "$DB_USER" -d "$DB_NAME" -v ON_ERROR_STOP=1 <<SQL
 -- Insert FHIR bundles
 INSERT INTO fhir_bundles (patient_id, bundle_data)
 SELECT
@@ -99,42 +135,53 @@ LATERAL (
 ) AS patient_data
 WHERE (patient_resource->>'id') IS NOT NULL;
 
--- Insert clinical notes
-INSERT INTO clinical_notes (patient_id, encounter_id, note_date, note_type, note_text)
-SELECT
-    patient_id,
-    doc_resource->>'id' AS encounter_id,
-    (doc_resource->>'date')::timestamp AS note_date,
-    COALESCE(doc_resource->'type'->>'text', 'Clinical Note') AS note_type,
-    convert_from(decode(content->'attachment'->>'data', 'base64'), 'UTF8') AS note_text
-FROM (
+-- Insert clinical notes: decode once, store each distinct text once
+CREATE TEMPORARY TABLE staged_notes AS
     SELECT
-        (patient_resource->>'id')::varchar(255) as patient_id,
-        bundle_data
-    FROM temp_json_staging,
-    LATERAL jsonb_array_elements(bundle_data->'entry') AS patient_entries(entry),
+        patient_id,
+        doc_resource->>'id' AS encounter_id,
+        (doc_resource->>'date')::timestamp AS note_date,
+        COALESCE(doc_resource->'type'->>'text', 'Clinical Note') AS note_type,
+        decode(content->'attachment'->>'data', 'base64') AS payload
+    FROM (
+        SELECT
+            (patient_resource->>'id')::varchar(255) as patient_id,
+            bundle_data
+        FROM temp_json_staging,
+        LATERAL jsonb_array_elements(bundle_data->'entry') AS patient_entries(entry),
+        LATERAL (
+            SELECT entry->'resource' AS resource
+            WHERE (entry->'resource'->>'resourceType') = 'Patient'
+            LIMIT 1
+        ) AS patient_resources(resource),
+        LATERAL (
+            SELECT resource AS patient_resource
+        ) AS patient_data
+        WHERE (patient_resource->>'id') IS NOT NULL
+    ) AS patients,
+    LATERAL jsonb_array_elements(bundle_data->'entry') AS doc_entries(entry),
     LATERAL (
         SELECT entry->'resource' AS resource
-        WHERE (entry->'resource'->>'resourceType') = 'Patient'
-        LIMIT 1
-    ) AS patient_resources(resource),
-    LATERAL (
-        SELECT resource AS patient_resource
-    ) AS patient_data
-    WHERE (patient_resource->>'id') IS NOT NULL
-) AS patients,
-LATERAL jsonb_array_elements(bundle_data->'entry') AS doc_entries(entry),
-LATERAL (
-    SELECT entry->'resource' AS resource
-    WHERE (entry->'resource'->>'resourceType') = 'DocumentReference'
-) AS doc_resources(doc_resource),
-LATERAL jsonb_array_elements(doc_resource->'content') AS contents(content)
-WHERE content->'attachment'->>'data' IS NOT NULL;
+        WHERE (entry->'resource'->>'resourceType') = 'DocumentReference'
+    ) AS doc_resources(doc_resource),
+    LATERAL jsonb_array_elements(doc_resource->'content') AS contents(content)
+    WHERE content->'attachment'->>'data' IS NOT NULL;
+
+INSERT INTO note_bodies (body_hash, note_text)
+SELECT DISTINCT ON (body_hash) body_hash, convert_from(payload, 'UTF8')
+FROM (SELECT encode(sha256(payload), 'hex') AS body_hash, payload FROM staged_notes) n
+ORDER BY body_hash
+ON CONFLICT (body_hash) DO NOTHING;
+
+INSERT INTO clinical_note_refs (patient_id, encounter_id, note_date, note_type, body_hash)
+SELECT patient_id, encounter_id, note_date, note_type, encode(sha256(payload), 'hex')
+FROM staged_notes;
 
 -- Show statistics
 SELECT
     (SELECT COUNT(*) FROM fhir_bundles) AS bundles_loaded,
     (SELECT COUNT(*) FROM clinical_notes) AS notes_extracted,
+    (SELECT COUNT(*) FROM note_bodies) AS distinct_note_bodies,
     (SELECT AVG(LENGTH(note_text))::int FROM clinical_notes) AS avg_note_length;
 SQL
 
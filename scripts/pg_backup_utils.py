@@ -0,0 +1,145 @@
+"""
+Shared helpers for backup_database.py and restore_database.py
+
+pg_dump / pg_restore run inside the PostgreSQL container (docker exec), so
+the client tools always match the server version.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import deque
+
+# Configuration
+DB_NAME = "healthflow_fhir"
+DB_USER = "postgres"
+DB_PASSWORD = "qwerty"
+CONTAINER_NAME = "postgres"  # Docker Compose service name
+BACKUP_DIR = "database_backups"
+
+# Metadata written next to each directory-format dump
+BACKUP_INFO_FILE = "backup_info.json"
+
+# pg_dump / pg_restore --verbose lines marking one table's data as done
+TABLE_DONE_PATTERN = re.compile(
+    r'finished item \d+ TABLE DATA (?P<table>\S+)'
+    r'|(?:dumping contents of|processing data for) table "?(?P<plain>[^"\s]+)'
+)
+
+
+def run_command(cmd, check=True):
+    """Run shell command and return output"""
+    try:
+        result = subprocess.run(
+            cmd,
+            shell=True,
+            check=check,
+            capture_output=True,
+            text=True
+        )
+        return result.stdout
+    except subprocess.CalledProcessError as e:
+        print(f"❌ Error: {e.stderr}")
+        sys.exit(1)
+
+
+def find_container() -> str:
+    """Name of the running PostgreSQL container (exits if none)"""
+    print("🔍 Finding PostgreSQL container...")
+    container_cmd = f"docker ps --filter name={CONTAINER_NAME} --format '{{{{.Names}}}}'"
+    container_name = run_command(container_cmd).strip().splitlines()
+
+    if not container_name:
+        print(f"❌ Error: PostgreSQL container '{CONTAINER_NAME}' not found")
+        print("   Make sure Docker is running: docker-compose up -d")
+        sys.exit(1)
+
+    print(f"   Found: {container_name[0]}")
+    return container_name[0]
+
+
+def psql_value(container_name: str, sql: str, database: str = DB_NAME) -> str:
+    """Run one query in the container and return its unaligned output"""
+    sql = sql.replace('"', '\\"')
+    return run_command(
+        f'docker exec {container_name} psql -U {DB_USER} -d {database} -tAc "{sql}"'
+    ).strip()
+
+
+def tool_major_version(container_name: str, tool: str) -> int:
+    """Major version of pg_dump / pg_restore in the container (e.g. 15)"""
+    output = run_command(f"docker exec {container_name} {tool} --version")
+    match = re.search(r'(\d+)(?:\.\d+)?', output)
+    return int(match.group(1)) if match else 0
+
+
+def pg_env():
+    """Environment with PGPASSWORD set"""
+    env = os.environ.copy()
+    env['PGPASSWORD'] = DB_PASSWORD
+    return env
+
+
+def run_with_progress(cmd: str, label: str, total_tables: int = 0, total_bytes: int = 0) -> float:
+    """
+    Run a --verbose pg_dump / pg_restore and print one line per finished table.
+
+    Args:
+        total_tables: tables expected (for the i/N counter), 0 if unknown
+        total_bytes: bytes to process, used for the throughput estimate
+
+    Returns:
+        elapsed seconds (exits on failure)
+    """
+    start = time.time()
+    done = 0
+    tail = deque(maxlen=20)
+    process = subprocess.Popen(
+        cmd, shell=True, env=pg_env(),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    for line in process.stderr:
+        tail.append(line.rstrip())
+        match = TABLE_DONE_PATTERN.search(line)
+        if match:
+            done += 1
+            table = match.group('table') or match.group('plain')
+            counter = f"{done}/{total_tables}" if total_tables else f"{done}"
+            print(f"   [{counter}] {table} ({time.time() - start:.1f}s)")
+    process.wait()
+    elapsed = time.time() - start
+
+    if process.returncode != 0:
+        errors = [line for line in tail if 'error' in line.lower()] or list(tail)
+        print(f"❌ {label} failed:")
+        for line in errors[-10:]:
+            print(f"   {line}")
+        sys.exit(1)
+
+    if total_bytes:
+        print(f"📈 {label}: {format_size(total_bytes)} in {elapsed:.1f}s "
+              f"({format_size(total_bytes / max(elapsed, 1e-6))}/s)")
+    else:
+        print(f"📈 {label}: {elapsed:.1f}s")
+    return elapsed
+
+
+def dir_size(path: str) -> int:
+    """Total size in bytes of the files under path"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def format_size(num_bytes: float) -> str:
+    """Human-readable size (B, KB, MB, GB)"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024 or unit == 'GB':
+            return f"{num_bytes:.1f} {unit}" if unit != 'B' else f"{int(num_bytes)} B"
+        num_bytes /= 1024
@@ -2,71 +2,127 @@
 """
 PostgreSQL Database Restore Script (Cross-platform)
 Works on Mac, Linux, and Windows
+
+Directory-format dumps (backup_database.py default) are restored with
+parallel pg_restore jobs in three passes: schema, table data, then
+indexes/constraints, so indexes are built once after the load instead of
+being maintained row by row. Plain .sql / .sql.gz files are replayed with psql.
+An incremental chain directory (backup_database.py --incremental) restores
+its base snapshot, then replays the increments in order.
 """
 
-import subprocess
-import os
-import sys
+import argparse
 import gzip
+import json
+import os
 import shutil
+import subprocess
+import sys
+import time
+from multiprocessing import cpu_count
 
-# Configuration
-DB_NAME = "healthflow_fhir"
-DB_USER = "postgres"
-DB_PASSWORD = "qwerty"
-CONTAINER_NAME = "postgres"  # Docker Compose service name
+from incremental_backup import chain_layout, connect, read_manifest, replay_increment
+from pg_backup_utils import (
+    BACKUP_INFO_FILE, CONTAINER_NAME, DB_NAME, DB_USER,
+    dir_size, find_container, format_size, pg_env, run_command, run_with_progress
+)
 
-def run_command(cmd, check=True):
-    """Run shell command and return output"""
-    try:
-        result = subprocess.run(
-            cmd, 
-            shell=True, 
-            check=check, 
-            capture_output=True, 
-            text=True
-        )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Error: {e.stderr}")
-        sys.exit(1)
+# Dump directory inside the container, removed once restored
+CONTAINER_RESTORE_DIR = "/tmp/healthflow_restore"
 
-def main():
-    print("📥 HealthFlow PostgreSQL Database Restore")
-    print("=" * 50)
-    
-    # Check if backup file provided
-    if len(sys.argv) < 2:
-        print("❌ Error: No backup file specified")
-        print("\nUsage: python restore_database.py <backup_file.sql.gz>")
-        print("Example: python restore_database.py database_backups/healthflow_db_20251221_150000.sql.gz")
-        sys.exit(1)
-    
-    backup_file = sys.argv[1]
-    
-    # Check if file exists
-    if not os.path.exists(backup_file):
-        print(f"❌ Error: Backup file not found: {backup_file}")
-        sys.exit(1)
-    
-    print(f"\n🔧 Configuration:")
-    print(f"   Backup file: {backup_file}")
-    print(f"   Database: {DB_NAME}")
-    print(f"   Container: {CONTAINER_NAME}")
-    print()
-    
-    # Find Docker container
-    print("🔍 Finding PostgreSQL container...")
-    container_cmd = f"docker ps --filter name={CONTAINER_NAME} --format '{{{{.Names}}}}'"
-    container_name = run_command(container_cmd).strip()
-    
-    if not container_name:
-        print(f"❌ Error: PostgreSQL container '{CONTAINER_NAME}' not found")
-        print("   Make sure Docker is running: docker-compose up -d")
+
+def restore_directory(container_name: str, backup_dir: str, jobs: int):
+    """
+    pg_restore -j in three sections.
+
+    A full dump recreates the database (--clean --create). A per-table dump
+    (backup_info.json lists its tables) replaces only those tables in the
+    existing database.
+    """
+    info = {}
+    info_path = os.path.join(backup_dir, BACKUP_INFO_FILE)
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+    dump_bytes = dir_size(backup_dir)
+    if info.get('created_at'):
+        print(f"   Dump created: {info['created_at']}")
+
+    print(f"\n📦 Copying dump into the container ({format_size(dump_bytes)})...")
+    start = time.time()
+    run_command(f"docker exec {container_name} rm -rf {CONTAINER_RESTORE_DIR}")
+    run_command(f"docker cp {backup_dir} {container_name}:{CONTAINER_RESTORE_DIR}")
+    print(f"📈 Copy: {time.time() - start:.1f}s")
+
+    restore = f"docker exec {container_name} pg_restore -U {DB_USER} --verbose"
+    if info.get('tables'):
+        print(f"   Per-table dump: replacing {', '.join(info['tables'])}")
+        schema_cmd = f"{restore} -d {DB_NAME} --clean --if-exists --section=pre-data"
+    else:
+        schema_cmd = f"{restore} -d postgres --clean --if-exists --create --section=pre-data"
+
+    start = time.time()
+    print("\n📐 Restoring schema...")
+    run_with_progress(f"{schema_cmd} {CONTAINER_RESTORE_DIR}", "Schema")
+
+    print(f"\n📥 Loading table data with {jobs} parallel jobs...")
+    run_with_progress(
+        f"{restore} -d {DB_NAME} --section=data --jobs={jobs} {CONTAINER_RESTORE_DIR}",
+        "Data", total_bytes=dump_bytes
+    )
+
+    print(f"\n🗂️  Building indexes and constraints with {jobs} parallel jobs...")
+    run_with_progress(
+        f"{restore} -d {DB_NAME} --section=post-data --jobs={jobs} {CONTAINER_RESTORE_DIR}",
+        "Indexes"
+    )
+
+    # pg_restore does not restore planner statistics
+    print("\n📊 Analyzing restored tables...")
+    analyze_start = time.time()
+    run_command(f"docker exec {container_name} vacuumdb -U {DB_USER} -d {DB_NAME} --analyze-only --jobs={jobs}")
+    print(f"📈 Analyze: {time.time() - analyze_start:.1f}s")
+
+    elapsed = time.time() - start
+    print(f"📈 Restore: {format_size(dump_bytes)} in {elapsed:.1f}s "
+          f"({format_size(dump_bytes / max(elapsed, 1e-6))}/s)")
+
+    # Cleanup
+    run_command(f"docker exec {container_name} rm -rf {CONTAINER_RESTORE_DIR}", check=False)
+
+
+def restore_chain(container_name: str, chain_dir: str, jobs: int, until: int = None):
+    """Base snapshot, then increments 1..until (all by default)"""
+    base, increments = chain_layout(chain_dir)
+    if base is None:
+        print(f"❌ Error: no base snapshot in {chain_dir}")
         sys.exit(1)
-    
-    print(f"   Found: {container_name}")
-    
+    if until is not None:
+        increments = increments[:until]
+
+    print(f"\n🧱 Restoring base snapshot ({read_manifest(base)['created_at']})...")
+    restore_directory(container_name, base, jobs)
+
+    conn = connect()
+    try:
+        for i, increment in enumerate(increments, 1):
+            manifest = read_manifest(increment)
+            chunk_bytes = sum(f['bytes'] for t in manifest['tables'].values() for f in t['files'])
+            print(f"\n➕ Replaying increment {i}/{len(increments)} ({manifest['created_at']}, "
+                  f"{format_size(chunk_bytes)})...")
+            start = time.time()
+            loaded = replay_increment(conn, increment)
+            elapsed = time.time() - start
+            for table, rows in loaded.items():
+                print(f"   {table}: {rows} rows")
+            print(f"📈 Increment {i}: {format_size(chunk_bytes)} in {elapsed:.1f}s "
+                  f"({format_size(chunk_bytes / max(elapsed, 1e-6))}/s)")
+    finally:
+        conn.close()
+
+
+def restore_plain(container_name: str, backup_file: str):
+    """Replay a plain .sql / .sql.gz dump with psql"""
     # Decompress if needed
     sql_file = backup_file
     if backup_file.endswith('.gz'):
@@ -75,50 +131,89 @@ def main():
         with gzip.open(backup_file, 'rb') as f_in:
             with open(sql_file, 'wb') as f_out:
                 shutil.copyfileobj(f_in, f_out)
-    
+
     # Restore database
     print("\n📥 Restoring database...")
     print("   This may take a few minutes...")
-    
+    start = time.time()
+
     # Copy SQL file to container
     copy_cmd = f"docker cp {sql_file} {container_name}:/tmp/restore.sql"
     run_command(copy_cmd)
-    
+
     # Restore from SQL file
     restore_cmd = (
         f"docker exec {container_name} "
         f"psql -U {DB_USER} -f /tmp/restore.sql"
     )
-    
-    env = os.environ.copy()
-    env['PGPASSWORD'] = DB_PASSWORD
-    
+
     try:
         subprocess.run(
             restore_cmd,
             shell=True,
             check=True,
-            env=env,
+            env=pg_env(),
             capture_output=True,
             text=True
         )
     except subprocess.CalledProcessError as e:
         print(f"❌ Restore failed: {e.stderr}")
         sys.exit(1)
-    
+
+    sql_bytes = os.path.getsize(sql_file)
+    elapsed = time.time() - start
+    print(f"📈 Restore: {format_size(sql_bytes)} in {elapsed:.1f}s "
+          f"({format_size(sql_bytes / max(elapsed, 1e-6))}/s)")
+
     # Cleanup
     cleanup_cmd = f"docker exec {container_name} rm /tmp/restore.sql"
     run_command(cleanup_cmd, check=False)
-    
+
     if backup_file.endswith('.gz') and os.path.exists(sql_file):
         os.remove(sql_file)
-    
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restore the HealthFlow PostgreSQL database")
+    parser.add_argument("backup", help="Dump directory (healthflow_db.dir), incremental chain directory "
+                                       "or .sql / .sql.gz file")
+    parser.add_argument("--jobs", "-j", type=int, default=min(cpu_count(), 8),
+                        help="Parallel pg_restore jobs (directory dumps)")
+    parser.add_argument("--until", type=int,
+                        help="Incremental chain: stop after this increment (default: all)")
+    args = parser.parse_args()
+
+    print("📥 HealthFlow PostgreSQL Database Restore")
+    print("=" * 50)
+
+    backup_file = args.backup
+
+    # Check if file exists
+    if not os.path.exists(backup_file):
+        print(f"❌ Error: Backup file not found: {backup_file}")
+        sys.exit(1)
+
+    print(f"\n🔧 Configuration:")
+    print(f"   Backup: {backup_file}")
+    print(f"   Database: {DB_NAME}")
+    print(f"   Container: {CONTAINER_NAME}")
+    print()
+
+    container_name = find_container()
+
+    if chain_layout(backup_file)[0] is not None:
+        restore_chain(container_name, backup_file, args.jobs, args.until)
+    elif os.path.isdir(backup_file):
+        restore_directory(container_name, backup_file, args.jobs)
+    else:
+        restore_plain(container_name, backup_file)
+
     print("\n✅ Restore complete!")
-    
+
     # Verify restoration
     print("\n📊 Verifying database:")
     stats_cmd = f"""docker exec {container_name} psql -U {DB_USER} -d {DB_NAME} -c "
-SELECT 
+SELECT
     'Patients' as table_name, COUNT(*) as records FROM raw_patients
 UNION ALL
 SELECT 'Encounters', COUNT(*) FROM raw_encounters
@@ -133,9 +228,9 @@ SELECT 'Readmissions', COUNT(*) FROM patient_readmissions
 UNION ALL
 SELECT 'FHIR Bundles', COUNT(*) FROM fhir_bundles;
 " """
-    
-    print(run_command(stats_cmd))
-    
+
+    print(run_command(stats_cmd, check=False))
+
     print("\n🎉 Database ready to use!")
     print("\n💡 Next steps:")
     print("   1. Verify data: docker exec -it <container> psql -U postgres -d healthflow_fhir")
@@ -0,0 +1,105 @@
+import itertools
+import sys
+import pytest
+
+pytest.importorskip("psycopg2")
+import compress_bundle_storage
+
+
+class FakeCursor:
+    """Minimal cursor answering the catalog queries of compress_bundle_storage"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        if 'VACUUM' in sql:
+            assert self.conn.autocommit, "VACUUM outside autocommit"
+        else:
+            self.conn.in_transaction = not self.conn.autocommit
+        self.conn.statements.append(sql)
+        if 'MIN(id)' in sql:
+            table = sql.split('FROM')[-1].strip()
+            assert table != 'document_payloads', "document_payloads has no id column"
+            self._rows = [(1, 3)]
+        elif 'server_version_num' in sql:
+            self._rows = [('150000',)]
+        elif 'FROM pg_class WHERE relkind' in sql:
+            self._rows = [(t,) for t in params[0] if t in self.conn.tables]
+        elif 'format_type' in sql:
+            self._rows = [('bytea',) if params[0] == 'document_payloads' else ('jsonb',)]
+        elif 'pg_relation_size' in sql:
+            self._rows = [(8192, 8192, 8192)]
+        elif 'document_payloads' in sql and 'COUNT(*)' in sql:
+            self._rows = [(0, 0)]
+        else:
+            self._rows = []
+
+    def fetchone(self):
+        return self._rows[0]
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeConnection:
+    def __init__(self, tables):
+        self.tables = set(tables)
+        self.statements = []
+        self.in_transaction = False
+        self._autocommit = False
+
+    @property
+    def autocommit(self):
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        # psycopg2 refuses to switch inside a transaction
+        assert not self.in_transaction, "autocommit changed inside a transaction"
+        self._autocommit = value
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.in_transaction = False
+
+    def rollback(self):
+        self.in_transaction = False
+
+    def close(self):
+        pass
+
+
+FLAGS = ['--lz4', '--externalize', '--minify', '--vacuum-full', '--report']
+ALL_TABLES = [table for table, *_ in compress_bundle_storage.LZ4_TARGETS]
+
+
+@pytest.mark.parametrize('tables', [ALL_TABLES, ['fhir_bundles']], ids=['all-tables', 'bundles-only'])
+@pytest.mark.parametrize('flags', [
+    list(combo) for n in range(len(FLAGS) + 1) for combo in itertools.combinations(FLAGS, n)
+], ids=lambda flags: ' '.join(flags) or 'no-flags')
+def test_every_flag_combination_runs(monkeypatch, flags, tables):
+    """Chaque combinaison d'options s'exécute sans transaction laissée ouverte"""
+    conn = FakeConnection(tables)
+    monkeypatch.setattr(compress_bundle_storage, 'connect_db', lambda: conn)
+    monkeypatch.setattr(sys, 'argv', ['compress_bundle_storage.py'] + flags)
+
+    compress_bundle_storage.main()
+
+    assert not conn.in_transaction
+
+
+def test_document_payloads_rewritten_by_key(monkeypatch):
+    """document_payloads est réécrite par clé sha256, sans colonne id"""
+    conn = FakeConnection(ALL_TABLES)
+    monkeypatch.setattr(compress_bundle_storage, 'connect_db', lambda: conn)
+    monkeypatch.setattr(sys, 'argv', ['compress_bundle_storage.py', '--lz4'])
+
+    compress_bundle_storage.main()
+
+    updates = [s for s in conn.statements if 'UPDATE document_payloads' in s]
+    assert updates and all('ORDER BY sha256' in s for s in updates)
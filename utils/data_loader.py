@@ -4,15 +4,31 @@ from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 import os
 
+from utils.feature_store import STORE_PREFIX, load_dataframe, parse_store_path
+
 CSV_PATH = "dataset_with_nlp.csv"
 TARGET_COL = 'label_readmission'
 
-def load_and_preprocess_data(csv_path=CSV_PATH, target_col=TARGET_COL, impute_missing=True):
+def load_dataset(csv_path=CSV_PATH):
+    """
+    Load a raw dataset from a CSV file, a Parquet file, or a feature store
+    snapshot ("store:<name>[@<version>]", see utils/feature_store.py).
+    """
+    if csv_path.startswith(STORE_PREFIX):
+        name, version = parse_store_path(csv_path)
+        print(f"📂 Loading feature store snapshot {name}@{version or 'latest'}...")
+        return load_dataframe(name, version)
+    
     if not os.path.exists(csv_path):
         raise FileNotFoundError(f"❌ File not found: {csv_path}")
     
-    print(f"📂 Loading {csv_path} (impute_missing={impute_missing})...")
-    df = pd.read_csv(csv_path)
+    print(f"📂 Loading {csv_path}...")
+    if csv_path.endswith('.parquet'):
+        return pd.read_parquet(csv_path, memory_map=True)
+    return pd.read_csv(csv_path)
+
+def load_and_preprocess_data(csv_path=CSV_PATH, target_col=TARGET_COL, impute_missing=True):
+    df = load_dataset(csv_path)
     
     # 1. Drop high null columns (>80%)
     null_threshold = 0.8